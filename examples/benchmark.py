@@ -0,0 +1,196 @@
+"""
+End-to-end benchmark of the pipeline on a synthetic night.
+
+Generates synthetic raw frames with :func:`excalibuhr.synthetic.make_night`,
+runs the reduction recipes with profiling enabled, and appends the timing
+of each recipe and kernel to a JSON-lines file, so that the performance
+can be tracked over commits. The results are compared with the last
+entry of the same configuration.
+
+Example::
+
+    python examples/benchmark.py --workdir /tmp/bench --n-pixel 2048 \
+        --num-processes 4 --results benchmark_results.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+
+
+# the default chain of `run_recipes`; `refine_wlen_solution` also
+# saves the extracted spectra
+STEPS = ['extract_header', 'calibration', 'obs_nodding',
+         'obs_nodding_combine', 'obs_extract', 'refine_wlen_solution']
+
+# modules which should only be imported at their first use
+LAZY_MODULES = ['matplotlib', 'pandas', 'astroquery', 'skycalc_ipy',
+                'requests', 'astropy.modeling']
+
+
+def import_time(module, repeat=3):
+    """
+    Time the import of `module` in a fresh interpreter, and list the
+    heavy optional dependencies it imported.
+    """
+    code = ("import sys, time; t = time.perf_counter(); "
+            f"import {module}; t = time.perf_counter() - t; "
+            f"print(t, *[m for m in {LAZY_MODULES!r} if m in sys.modules])")
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                    capture_output=True, text=True).stdout.split()
+        times.append(float(out[0]))
+    return min(times), out[1:]
+
+
+def git_info():
+    """ current commit of the repository, and if the tree is modified """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                    cwd=cwd, capture_output=True, text=True,
+                    check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain',
+                    '--untracked-files=no'], cwd=cwd, capture_output=True,
+                    text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return commit, dirty
+
+
+def versions():
+    import numpy, scipy, astropy
+    return {'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'scipy': scipy.__version__,
+            'astropy': astropy.__version__}
+
+
+def run(args):
+    import matplotlib
+    matplotlib.use('Agg')
+    from excalibuhr import profiling
+    from excalibuhr.synthetic import make_night, make_transmission
+    from excalibuhr.pipeline import CriresPipeline
+
+    night = 'synthetic'
+    nightpath = os.path.join(args.workdir, night)
+    if os.path.exists(nightpath):
+        shutil.rmtree(nightpath)
+
+    timing = {}
+    t0 = time.time()
+    layout = make_night(os.path.join(nightpath, 'raw'), n_pixel=args.n_pixel,
+                        n_cycles=args.n_cycles, seed=args.seed)
+    timing['make_night'] = time.time() - t0
+
+    ppl = CriresPipeline(args.workdir, night, clean_start=True,
+                         num_processes=args.num_processes,
+                         incremental=False, profile=True, dtype=args.dtype)
+    # telluric template of the synthetic night instead of SkyCalc
+    make_transmission(os.path.join(ppl.calpath, 'TRANSM_SPEC.fits'),
+                      layout, seed=args.seed)
+    for step in STEPS:
+        t0 = time.time()
+        getattr(ppl, step)()
+        timing[step] = time.time() - t0
+
+    ppl.save_profile()
+    stats = profiling.summary(profiling.load_events())
+    profiling.disable()
+    return timing, stats
+
+
+def compare(record, results_file):
+    """ print the ratio of the timing to the last run of the same setup """
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['params'] == record['params']:
+                    previous = entry
+    if previous is None:
+        print('No previous result with the same parameters.')
+        return
+
+    print(f"\nCompared to commit {previous['commit']} ({previous['date']}):")
+    print(f"{'step':<48s} {'before':>9s} {'now':>9s} {'ratio':>7s}")
+    rows = [(k, previous['steps'].get(k), v) for k, v in record['steps'].items()]
+    rows += [(k, previous['profile'].get(k, {}).get('wall_s'), v['wall_s'])
+             for k, v in record['profile'].items() if not k.startswith('recipe:')]
+    for key, before, now in rows:
+        if before:
+            print(f"{key[:48]:<48s} {before:9.2f} {now:9.2f} {now/before:7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', default='./benchmark',
+                        help='directory to write the synthetic night')
+    parser.add_argument('--n-pixel', type=int, default=2048,
+                        help='size of the synthetic detectors')
+    parser.add_argument('--n-cycles', type=int, default=2,
+                        help='number of ABBA nodding cycles')
+    parser.add_argument('--num-processes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'],
+                        help='precision of the images in the pipeline')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='JSON-lines file to append the results')
+    parser.add_argument('--no-save', action='store_true',
+                        help='only compare, do not append the results')
+    args = parser.parse_args()
+
+    imports = {}
+    for module in ['excalibuhr.utils', 'excalibuhr.pipeline']:
+        t, loaded = import_time(module)
+        imports[f'import {module}'] = t
+        print(f"import {module}: {t:.2f} s")
+        if loaded:
+            print(f"  WARNING: eagerly imported {', '.join(loaded)}")
+
+    timing, stats = run(args)
+    timing = {**imports, **timing}
+    commit, dirty = git_info()
+    record = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions(),
+        'params': {'n_pixel': args.n_pixel, 'n_cycles': args.n_cycles,
+                   'num_processes': args.num_processes, 'seed': args.seed,
+                   'dtype': args.dtype},
+        'steps': timing,
+        'profile': stats,
+    }
+
+    print(f"\n{'step':<48s} {'wall [s]':>9s}")
+    for key, value in timing.items():
+        print(f"{key:<48s} {value:9.2f}")
+    print(f"\n{'kernel':<48s} {'calls':>6s} {'wall [s]':>9s} {'cpu [s]':>9s}")
+    for key, s in stats.items():
+        if key.startswith('kernel:'):
+            print(f"{key[7:55]:<48s} {s['calls']:6d} "
+                  f"{s['wall_s']:9.2f} {s['cpu_s']:9.2f}")
+
+    compare(record, args.results)
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,387 @@
+# File: src/excalibuhr/archive.py
+__all__ = ['Archive', 'EsoArchive', 'LocalArchive', 'query_concurrent',
+           'download_files']
+
+import os
+import re
+import glob
+import datetime
+import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.io import fits
+from excalibuhr.compress import read_header
+
+
+# Header keywords of the query filters of the ESO archive form
+FILTER_KEYS = {
+    'dp_type': 'ESO DPR TYPE',
+    'dp_cat': 'ESO DPR CATG',
+    'dp_tech': 'ESO DPR TECH',
+    'ins_wlen_id': 'ESO INS WLEN ID',
+    'det_dit': 'ESO DET SEQ1 DIT',
+    'prog_id': 'ESO OBS PROG ID',
+    'obs_name': 'ESO OBS NAME',
+    'target': 'ESO OBS TARG NAME',
+    'object': 'OBJECT',
+}
+
+RAW_EXTENSIONS = ('.fits', '.fits.gz', '.fits.Z')
+
+CHUNK_SIZE = 1 << 20
+
+
+def _night(mjd):
+    """ ESO night (the date at the start of the night) of an MJD """
+    date = datetime.datetime(1858, 11, 17) + datetime.timedelta(days=mjd - 0.5)
+    return date.strftime('%Y-%m-%d')
+
+
+def _strip_extension(filename):
+    for ext in RAW_EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+class Archive:
+    """
+    Interface of the archives from which raw data are downloaded by
+    :func:`download_files`. The datasets are identified by strings,
+    e.g. the `DP.ID` of the ESO archive.
+    """
+
+    def query(self, column_filters):
+        """
+        Method for finding the datasets matching the filters.
+
+        Parameters
+        ----------
+        column_filters: dict
+            filters of the ESO archive form, e.g. `night`, `dp_type`,
+            `ins_wlen_id`, or `det_dit`
+
+        Returns
+        -------
+        datasets: list
+            identifiers of the matching datasets
+        """
+        raise NotImplementedError
+
+    def associated(self, datasets, mode='raw'):
+        """
+        Method for finding the calibrations associated to datasets.
+
+        Returns
+        -------
+        datasets: list
+            identifiers of the calibration datasets
+        """
+        raise NotImplementedError
+
+    def open(self, dataset, offset=0):
+        """
+        Method for starting the transfer of a dataset.
+
+        Parameters
+        ----------
+        dataset: str
+            identifier of the dataset
+        offset: int
+            number of bytes already transferred, to resume the transfer
+
+        Returns
+        -------
+        filename: str
+            name of the file of the dataset
+        size: int or None
+            total size of the file, if known
+        start: int
+            position of the first byte of the transfer, either `offset`
+            if the transfer is resumed, or 0 if it restarts
+        chunks: iterator
+            content of the file from `start` as bytes
+        """
+        raise NotImplementedError
+
+
+class EsoArchive(Archive):
+    """
+    ESO Science Archive, queried with `astroquery`. The files are
+    downloaded by HTTP range requests, so that partial transfers are
+    resumed.
+
+    Parameters
+    ----------
+    login: str, optional
+        username of the ESO User Portal Services, required for
+        proprietary data
+    instrument: str
+        name of the instrument in the archive
+    """
+
+    def __init__(self, login=None, instrument='crires'):
+        from astroquery.eso import Eso
+        self.eso = Eso()
+        if login is not None:
+            self.eso.login(login)
+        self.instrument = instrument
+
+    def query(self, column_filters):
+        table = self.eso.query_instrument(self.instrument,
+                                          column_filters=column_filters)
+        if table is None:
+            return []
+        return list(table['DP.ID'])
+
+    def associated(self, datasets, mode='raw'):
+        # batch the requests to avoid possible issues on the ESO server
+        files = []
+        datasets = sorted(datasets)
+        for i in range(0, len(datasets), 100):
+            files += self.eso.get_associated_files(datasets[i:i+100], mode=mode)
+        return sorted(set(files) - set(datasets))
+
+    def open(self, dataset, offset=0):
+        headers = {}
+        if hasattr(self.eso, '_get_auth_header'):
+            headers.update(self.eso._get_auth_header())
+        if offset > 0:
+            headers['Range'] = f'bytes={offset}-'
+        response = self.eso._session.get(self.eso.DOWNLOAD_URL + dataset,
+                                         stream=True, headers=headers)
+        if response.status_code == 416:
+            # the partial file is already complete
+            response.close()
+            return f"{dataset}.fits.Z", offset, offset, iter([])
+        response.raise_for_status()
+        start = offset if response.status_code == 206 else 0
+
+        size = response.headers.get('Content-Length')
+        if size is not None:
+            size = int(size) + start
+        match = re.search(r'filename="?([^";]+)',
+                          response.headers.get('Content-Disposition', ''))
+        filename = match.group(1) if match else f"{dataset}.fits.Z"
+
+        def chunks():
+            with response:
+                yield from response.iter_content(chunk_size=CHUNK_SIZE)
+        return filename, size, start, chunks()
+
+
+class LocalArchive(Archive):
+    """
+    Archive backed by a local folder of raw files, e.g. a mirror of the
+    ESO archive or test data. The datasets are queried by the keywords
+    in the primary headers (see `FILTER_KEYS`), and the night is derived
+    from `MJD-OBS`. Files are identified by their `ARCFILE` keyword, or
+    by their name without extension.
+
+    Parameters
+    ----------
+    path: str
+        folder of the raw files, searched recursively
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """ Internal method for reading the headers of the files once. """
+        with self._lock:
+            if self._index is None:
+                self._index = self._read_headers()
+        return self._index
+
+    def _read_headers(self):
+        index = {}
+        for ext in RAW_EXTENSIONS:
+            pattern = os.path.join(self.path, '**', f'*{ext}')
+            for file in sorted(glob.glob(pattern, recursive=True)):
+                try:
+                    if file.endswith('.Z'):
+                        # not readable by astropy
+                        header = read_header(file)
+                    else:
+                        header = fits.getheader(file)
+                except (OSError, ValueError):
+                    warnings.warn(f"Cannot read the header of {file}")
+                    continue
+                name = header.get('ARCFILE', os.path.basename(file))
+                index[_strip_extension(name)] = (file, header)
+        return index
+
+    def _match(self, header, column_filters):
+        for key, value in column_filters.items():
+            if key == 'night':
+                if header.get('MJD-OBS') is None or \
+                        _night(header['MJD-OBS']) != value:
+                    return False
+            elif key == 'det_dit':
+                dit = header.get(FILTER_KEYS[key])
+                if dit is None or not np.isclose(dit, float(value)):
+                    return False
+            elif key in FILTER_KEYS:
+                if str(header.get(FILTER_KEYS[key], '')).strip() != str(value):
+                    return False
+            else:
+                raise ValueError(f"Unknown query filter: {key}")
+        return True
+
+    def query(self, column_filters):
+        return [dataset for dataset, (_, header) in self._scan().items()
+                if self._match(header, column_filters)]
+
+    def associated(self, datasets, mode='raw'):
+        """
+        The raw calibrations of the same night as the datasets: the flats
+        and lamp frames of their wavelength settings, and the darks of
+        their DITs and of the DITs of those calibrations.
+        """
+        if mode != 'raw':
+            raise ValueError("Only raw calibrations are available locally")
+        index = self._scan()
+        settings = {(_night(index[d][1]['MJD-OBS']),
+                     index[d][1].get(FILTER_KEYS['ins_wlen_id']),
+                     index[d][1].get(FILTER_KEYS['det_dit']))
+                    for d in datasets}
+        nights = {night for night, _, _ in settings}
+        wlens = {(night, wlen) for night, wlen, _ in settings}
+
+        calib = {}
+        for dataset, (_, header) in index.items():
+            if dataset in datasets or header.get('MJD-OBS') is None or \
+                    header.get(FILTER_KEYS['dp_cat']) != 'CALIB':
+                continue
+            night = _night(header['MJD-OBS'])
+            if night in nights:
+                calib[dataset] = (night, header)
+
+        files = {d for d, (night, header) in calib.items()
+                 if header.get(FILTER_KEYS['dp_type']) != 'DARK' and
+                 (night, header.get(FILTER_KEYS['ins_wlen_id'])) in wlens}
+        dits = {(night, dit) for night, _, dit in settings} | \
+               {(calib[d][0], calib[d][1].get(FILTER_KEYS['det_dit']))
+                for d in files}
+        files |= {d for d, (night, header) in calib.items()
+                  if header.get(FILTER_KEYS['dp_type']) == 'DARK' and
+                  (night, header.get(FILTER_KEYS['det_dit'])) in dits}
+        return sorted(files)
+
+    def open(self, dataset, offset=0):
+        file = self._scan()[dataset][0]
+        size = os.path.getsize(file)
+        if offset > size:
+            offset = 0
+
+        def chunks():
+            with open(file, 'rb') as f:
+                f.seek(offset)
+                yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+        return os.path.basename(file), size, offset, chunks()
+
+
+def query_concurrent(archive, filters, max_workers=8):
+    """
+    Run several queries of an archive concurrently.
+
+    Parameters
+    ----------
+    archive: `Archive`
+        the archive to query
+    filters: list
+        column filters of each query
+    max_workers: int
+        maximum number of queries at the same time
+
+    Returns
+    -------
+    results: list
+        datasets found by each query, in the order of `filters`
+    """
+    if len(filters) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filters))) as pool:
+        return list(pool.map(archive.query, filters))
+
+
+def _download(archive, dataset, destination, retries, overwrite):
+    """
+    Internal function for downloading a dataset to a partial file,
+    resuming the transfer after a failure, and renaming the file once
+    it is complete.
+    """
+    if not overwrite:
+        for ext in RAW_EXTENSIONS:
+            file = os.path.join(destination, dataset + ext)
+            if os.path.isfile(file):
+                return file
+
+    part_file = os.path.join(destination, f"{dataset}.part")
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+        try:
+            filename, size, start, chunks = archive.open(dataset, offset)
+            if size is not None and start == size:
+                break
+            with open(part_file, 'ab' if start > 0 else 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            if size is None or os.path.getsize(part_file) == size:
+                break
+            raise IOError(f"Incomplete transfer of {dataset}")
+        except Exception:
+            if attempt == retries:
+                raise
+
+    file = os.path.join(destination, filename)
+    os.replace(part_file, file)
+    return file
+
+
+def download_files(archive, datasets, destination, max_workers=4,
+                   retries=3, overwrite=False):
+    """
+    Download datasets from an archive in parallel. Each file is written
+    to `<dataset>.part` and renamed when it is complete; interrupted
+    transfers are resumed, also by a later call. Files present in
+    `destination` are skipped unless `overwrite` is True.
+
+    Parameters
+    ----------
+    archive: `Archive`
+        the archive to download from
+    datasets: list
+        identifiers of the datasets
+    destination: str
+        folder of the downloaded files
+    max_workers: int
+        maximum number of transfers at the same time
+    retries: int
+        number of times a failed transfer is resumed
+    overwrite: bool
+        download the files present in `destination` again
+
+    Returns
+    -------
+    files: list
+        paths to the downloaded files, in the order of `datasets`.
+        The datasets failing after `retries` are reported and skipped.
+    """
+    os.makedirs(destination, exist_ok=True)
+    if len(datasets) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(datasets))) as pool:
+        jobs = [pool.submit(_download, archive, dataset, destination,
+                            retries, overwrite) for dataset in datasets]
+        files = []
+        for dataset, job in zip(datasets, jobs):
+            try:
+                files.append(job.result())
+            except Exception as err:
+                warnings.warn(f"Failed to download {dataset}: {err}")
+    return files
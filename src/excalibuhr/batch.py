@@ -0,0 +1,442 @@
+# File: src/excalibuhr/batch.py
+"""
+Reduction of many nights sharing a single pool of workers.
+
+Example::
+
+    python -m excalibuhr.batch ./ 2023-02-26 2023-02-27 \
+        --num-processes 8 --max-nights 2 --memory-budget 16
+"""
+__all__ = ['BatchRunner', 'estimate_memory', 'main']
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import threading
+import warnings
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import Pool
+import numpy as np
+from astropy.io import fits
+from excalibuhr.compress import read_headers, COMPRESSED_EXTENSIONS
+
+
+RAW_PATTERNS = ('.fits', '.fits.Z', '.fits.gz', '.fits.fz')
+
+
+def _frame_size(filename):
+    """
+    Internal function giving the number of pixels of the images of a
+    raw file, from its headers only.
+    """
+    if filename.endswith(COMPRESSED_EXTENSIONS):
+        headers = read_headers(filename)
+    else:
+        # the data are only read when accessed
+        with fits.open(filename) as hdul:
+            headers = [hdu.header for hdu in hdul]
+    size = 0
+    for header in headers:
+        if header.get('XTENSION', 'IMAGE') != 'IMAGE':
+            continue
+        naxis = header.get('NAXIS', 0)
+        if naxis > 0:
+            size += int(np.prod([header[f'NAXIS{i}']
+                                 for i in range(1, naxis + 1)]))
+    return size
+
+
+def estimate_memory(rawpath, dtype='float64', max_stack=16, overhead=6,
+                    n_pixel=2048, n_det=3):
+    """
+    Rough estimate of the peak memory used by the reduction of a night
+    in the main process: a stack of at most `max_stack` raw frames, plus
+    `overhead` frames for the calibrations and products in use.
+    The memory of the workers is bounded by the size of the worker pool.
+
+    Parameters
+    ----------
+    rawpath: str
+        folder of the raw frames. If it contains no frames, e.g. before
+        downloading, full stacks of detectors of `n_pixel` are assumed.
+        The size of the frames is read from the headers of the largest
+        file, or assumed as well if the headers cannot be read.
+    dtype: str
+        precision of the images in the pipeline
+    max_stack: int
+        maximum number of frames combined at once
+    overhead: int
+        number of additional frames in memory
+    n_pixel: int
+        size of the detectors if no frame is found
+    n_det: int
+        number of detectors if no frame is found
+
+    Returns
+    -------
+    memory: float
+        estimated memory in GB
+    """
+    itemsize = np.dtype(dtype).itemsize
+    files = []
+    if os.path.isdir(rawpath):
+        files = [os.path.join(rawpath, f) for f in os.listdir(rawpath)
+                 if f.endswith(RAW_PATTERNS)]
+
+    frame_size = n_det * n_pixel**2
+    if files:
+        # the headers of the largest file give the size of a frame
+        try:
+            frame_size = _frame_size(max(files, key=os.path.getsize)) \
+                or frame_size
+        except Exception as err:
+            warnings.warn(f"Cannot read the size of the frames in "
+                          f"{rawpath}, assuming {n_det} detectors of "
+                          f"{n_pixel} pixels: {err}")
+        n_stack = min(len(files), max_stack)
+    else:
+        n_stack = max_stack
+
+    return frame_size * itemsize * (n_stack + overhead) / 1024**3
+
+
+class _ThreadStream:
+    """
+    Text stream forwarding the output of each thread to its own file,
+    and the output of the other threads to `stream`.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.targets = {}
+
+    def _target(self):
+        return self.targets.get(threading.get_ident(), self.stream)
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class BatchRunner:
+    """
+    Scheduler reducing independent nights concurrently. Each night is
+    reduced by its own :class:`excalibuhr.pipeline.CriresPipeline` in a
+    thread of the main process, and the worker jobs of all nights are
+    submitted to a single pool of `num_processes` workers. A night is
+    started once fewer than `max_nights` are running and its memory
+    estimate fits in the remaining `memory_budget`; a night exceeding
+    the budget is run alone. A failing night is recorded in the summary
+    without stopping the others.
+
+    Parameters
+    ----------
+    workpath: str
+        path of the main reduction folder
+    nights: list
+        nights to reduce, given by their names or by dicts with the key
+        `night` and the optional keys `memory` (estimate in GB),
+        `steps`, and `kwargs` (arguments of the pipeline of this night)
+    steps: list
+        recipes run for each night, given by the names of the methods of
+        the pipeline, tuples of a name and a dict of its arguments, or
+        callables taking the pipeline. By default, :meth:`run_recipes`.
+    num_processes: int
+        number of worker processes shared by all nights
+    max_nights: int
+        maximum number of nights reduced at the same time
+    memory_budget: float, optional
+        memory in GB available to the nights, no limit if None
+    log: bool
+        write the output of each night to `batch.log` in its folder,
+        instead of the terminal. Only the output of the main process is
+        redirected, see the notes.
+    summary_file: str
+        name of the JSON summary saved in `workpath`
+    pipeline_kwargs:
+        arguments of the pipeline shared by all nights
+
+    Notes
+    -----
+    The output is redirected by replacing `sys.stdout` while the nights
+    run, with the output of each night's thread sent to its `batch.log`.
+    The jobs run in the worker processes print to the terminal instead,
+    and the output of the other threads of the host program is printed
+    as usual. Missing calibrations are reused from the `calib_library`,
+    or downloaded with `eso_login`.
+    Profiling records the events of the whole process, so it is only
+    available with `max_nights=1`.
+    """
+
+    def __init__(self, workpath, nights, steps=None, num_processes=4,
+                 max_nights=2, memory_budget=None, log=True,
+                 summary_file='batch_summary.json', **pipeline_kwargs):
+
+        self.workpath = os.path.abspath(workpath)
+        self.nights = [n if isinstance(n, dict) else {'night': n}
+                       for n in nights]
+        names = [n['night'] for n in self.nights]
+        if len(set(names)) != len(names):
+            raise ValueError("Each night can only be given once")
+        self.steps = [('run_recipes', {})] if steps is None else steps
+        self.num_processes = num_processes
+        self.max_nights = max(1, max_nights)
+        self.memory_budget = memory_budget
+        self.log = log
+        self.summary_file = os.path.join(self.workpath, summary_file)
+        self.pipeline_kwargs = pipeline_kwargs
+        if self.max_nights > 1:
+            if pipeline_kwargs.get('profile', False):
+                raise ValueError("Profiling requires max_nights=1")
+            if not pipeline_kwargs.get('qa_background', True):
+                raise ValueError("QA plots must be rendered in the "
+                                 "background with max_nights > 1")
+        self.results = []
+        self._stream = None
+
+
+    def _memory(self, item):
+        if item.get('memory') is not None:
+            return item['memory']
+        kwargs = {**self.pipeline_kwargs, **item.get('kwargs', {})}
+        rawpath = os.path.join(self.workpath, item['night'], 'raw')
+        return estimate_memory(rawpath, dtype=kwargs.get('dtype', 'float64'))
+
+
+    def _run_steps(self, ppl, steps, record):
+        for step in steps:
+            if callable(step):
+                name, kwargs = getattr(step, '__name__', repr(step)), {}
+                step(ppl)
+            else:
+                name, kwargs = (step, {}) if isinstance(step, str) else step
+                getattr(ppl, name)(**kwargs)
+            record['steps'].append(name)
+
+
+    def _run_night(self, item, pool):
+        """
+        Internal method for reducing a night in the current thread.
+        """
+        from excalibuhr.pipeline import CriresPipeline
+
+        start_time = time.time()
+        night = item['night']
+        record = {'night': night, 'status': 'running', 'steps': [],
+                  'memory_gb': item['memory_gb'], 'runtime_s': None,
+                  'error': None, 'traceback': None}
+        nightpath = os.path.join(self.workpath, night)
+        os.makedirs(nightpath, exist_ok=True)
+        logfile = None
+        if self._stream is not None:
+            logfile = open(os.path.join(nightpath, 'batch.log'), 'a')
+            self._stream.targets[threading.get_ident()] = logfile
+
+        ppl = None
+        try:
+            kwargs = {**self.pipeline_kwargs, **item.get('kwargs', {})}
+            kwargs['num_processes'] = self.num_processes
+            ppl = CriresPipeline(self.workpath, night, pool=pool, **kwargs)
+            self._run_steps(ppl, item.get('steps', self.steps), record)
+            # wait for the products and plots, and release the writer 
+            # thread and the renderer process of this night
+            ppl.writer.close()
+            ppl.qa_plotter.close()
+            record['status'] = 'done'
+        except Exception as err:
+            record['status'] = 'failed'
+            record['error'] = f"{type(err).__name__}: {err}"
+            record['traceback'] = traceback.format_exc()
+            print(record['traceback'])
+        finally:
+            if ppl is not None and record['status'] == 'failed':
+                for closing in (ppl.writer.close, ppl.qa_plotter.close):
+                    try:
+                        closing()
+                    except Exception:
+                        pass
+            record['runtime_s'] = time.time() - start_time
+            if logfile is not None:
+                del self._stream.targets[threading.get_ident()]
+                logfile.close()
+        return record
+
+
+    def run(self):
+        """
+        Method for reducing all the nights.
+
+        Returns
+        -------
+        results: list
+            summary of each night, in the order of `nights`, with the keys
+            `night`, `status` (`done` or `failed`), `steps` completed,
+            `memory_gb` estimate, `runtime_s`, `error`, and `traceback`.
+        """
+        pending = deque()
+        for item in self.nights:
+            pending.append({**item, 'memory_gb': self._memory(item)})
+        budget = np.inf if self.memory_budget is None else self.memory_budget
+        records = {}
+        running = {}
+
+        # import the lazily imported modules before starting the nights, 
+        # so that the processes forked by a night do not inherit an import
+        # in progress in another thread
+        importlib.import_module('pandas')
+        importlib.import_module('matplotlib.pyplot')
+
+        if self.log:
+            self._stream = _ThreadStream(sys.stdout)
+            sys.stdout = self._stream
+        start_time = time.time()
+        try:
+            with Pool(processes=self.num_processes) as pool, \
+                    ThreadPoolExecutor(max_workers=self.max_nights) as threads:
+                while pending or running:
+                    used = sum(item['memory_gb'] for item in running.values())
+                    while pending and len(running) < self.max_nights and \
+                            (not running or
+                             used + pending[0]['memory_gb'] <= budget):
+                        item = pending.popleft()
+                        used += item['memory_gb']
+                        self._report(f"Start {item['night']} "
+                                     f"(~{item['memory_gb']:.1f} GB)")
+                        future = threads.submit(self._run_night, item, pool)
+                        running[future] = item
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        item = running.pop(future)
+                        record = future.result()
+                        records[item['night']] = record
+                        self._report(f"Finished {item['night']}: "
+                                     f"{record['status']} in "
+                                     f"{record['runtime_s']:.1f} s")
+        finally:
+            if self._stream is not None:
+                sys.stdout = self._stream.stream
+                self._stream = None
+
+        self.runtime = time.time() - start_time
+        self.results = [records[item['night']] for item in self.nights]
+        self.save_summary()
+        print(self.summary())
+        return self.results
+
+
+    def _report(self, text):
+        stream = sys.stdout if self._stream is None else self._stream.stream
+        print(f"[batch {time.strftime('%H:%M:%S')}] {text}", file=stream,
+              flush=True)
+
+
+    def summary(self):
+        """
+        Method for formatting the summary of the last run as a table.
+
+        Returns
+        -------
+        table: str
+            runtime, status, and error of each night
+        """
+        lines = [f"{'night':<20s} {'status':<8s} {'memory [GB]':>11s} "
+                 f"{'runtime [s]':>11s}  error"]
+        for res in self.results:
+            lines.append(f"{res['night']:<20s} {res['status']:<8s} "
+                         f"{res['memory_gb']:11.1f} {res['runtime_s']:11.1f}"
+                         f"  {res['error'] or ''}")
+        n_failed = sum(res['status'] != 'done' for res in self.results)
+        lines.append(f"{len(self.results)} nights, {n_failed} failed, "
+                     f"total runtime {self.runtime:.1f} s")
+        return '\n'.join(lines)
+
+
+    def save_summary(self, filename=None):
+        """
+        Method for saving the summary of the last run to a JSON file.
+
+        Parameters
+        ----------
+        filename: str, optional
+            name of the file, `summary_file` in `workpath` by default
+        """
+        if filename is None:
+            filename = self.summary_file
+        summary = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'num_processes': self.num_processes,
+                   'max_nights': self.max_nights,
+                   'memory_budget_gb': self.memory_budget,
+                   'runtime_s': self.runtime,
+                   'nights': self.results}
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description=__doc__.strip().split('\n\n')[0],
+                epilog=__doc__.strip().split('\n\n', 1)[1],
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('workpath', help='main reduction folder')
+    parser.add_argument('nights', nargs='*', help='nights to reduce')
+    parser.add_argument('--nights-file',
+                        help='text file listing one night per line')
+    parser.add_argument('--steps', default='run_recipes',
+                        help='comma-separated recipes run for each night')
+    parser.add_argument('--num-processes', type=int, default=4,
+                        help='number of worker processes of all nights')
+    parser.add_argument('--max-nights', type=int, default=2,
+                        help='maximum number of nights run at the same time')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='memory in GB available to the nights')
+    parser.add_argument('--obs-mode', default='nod', choices=['nod', 'stare'])
+    parser.add_argument('--clean-start', action='store_true')
+    parser.add_argument('--qa-plots', default='full',
+                        choices=['off', 'summary', 'full'])
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'])
+    parser.add_argument('--calib-library',
+                        help='folder of the calibration library shared by '
+                             'the nights')
+    parser.add_argument('--eso-login',
+                        help='ESO username to download missing calibrations')
+    parser.add_argument('--no-log', action='store_true',
+                        help='print the output of the nights to the terminal')
+    args = parser.parse_args(argv)
+
+    nights = list(args.nights)
+    if args.nights_file:
+        with open(args.nights_file) as f:
+            nights += [l.strip() for l in f
+                       if l.strip() and not l.startswith('#')]
+    if not nights:
+        parser.error('no night given')
+
+    runner = BatchRunner(args.workpath, nights,
+                         steps=[s.strip() for s in args.steps.split(',')],
+                         num_processes=args.num_processes,
+                         max_nights=args.max_nights,
+                         memory_budget=args.memory_budget,
+                         log=not args.no_log,
+                         obs_mode=args.obs_mode,
+                         clean_start=args.clean_start,
+                         qa_plots=args.qa_plots, dtype=args.dtype,
+                         calib_library=args.calib_library,
+                         eso_login=args.eso_login)
+    results = runner.run()
+    return int(any(res['status'] != 'done' for res in results))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
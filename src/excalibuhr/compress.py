@@ -0,0 +1,431 @@
+# File: src/excalibuhr/compress.py
+__all__ = ['iter_decompress', 'read_header', 'read_headers',
+           'decompress_file',
+           'decompress_files', 'COMPRESSED_EXTENSIONS']
+
+import os
+import zlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.io import fits
+
+
+COMPRESSED_EXTENSIONS = ('.Z', '.gz')
+
+LZW_MAGIC = b'\x1f\x9d'
+GZIP_MAGIC = b'\x1f\x8b'
+
+CHUNK_SIZE = 1 << 20
+
+# Number of LZW codes decoded between two output chunks
+CODE_BATCH = 1 << 16
+
+FITS_BLOCK = 2880
+
+
+def _unpack_codes(buf, posbits, n_bits, count):
+    """
+    Internal function for extracting `count` codes of `n_bits` bits,
+    stored least significant bit first, from bit `posbits` of `buf`.
+    """
+    pos = posbits + n_bits * np.arange(count, dtype=np.int64)
+    idx = pos >> 3
+    word = buf[idx].astype(np.uint32) | \
+           (buf[idx+1].astype(np.uint32) << 8) | \
+           (buf[idx+2].astype(np.uint32) << 16)
+    word >>= (pos & 7).astype(np.uint32)
+    word &= (1 << n_bits) - 1
+    return word
+
+
+def _decode(codes, table, prev, out):
+    """
+    Internal function for decoding LZW codes that add an entry to the
+    string table, appending the strings to `out`. Returns the last string.
+    """
+    append = out.append
+    add = table.append
+    n = len(table)
+    for code in codes:
+        if code < n:
+            entry = table[code]
+            add(prev + entry[:1])
+        elif code == n:
+            entry = prev + prev[:1]
+            add(entry)
+        else:
+            raise ValueError("Corrupt LZW data: code out of range")
+        n += 1
+        append(entry)
+        prev = entry
+    return prev
+
+
+def _flatten(table):
+    """
+    Internal function for concatenating the strings of a full table,
+    returning the concatenated bytes and the offset and length of each
+    string.
+    """
+    lengths = np.array([len(entry) for entry in table], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    return np.frombuffer(b''.join(table), dtype=np.uint8), offsets, lengths
+
+
+def _gather(flat, offsets, lengths, codes):
+    """
+    Internal function for decoding codes of a full table at once,
+    by gathering their strings from the concatenated table.
+    """
+    lens = lengths[codes]
+    ends = np.cumsum(lens)
+    idx = np.arange(ends[-1]) + np.repeat(offsets[codes] - ends + lens, lens)
+    return flat[idx].tobytes()
+
+
+def _iter_lzw(data):
+    """
+    Internal generator decompressing the content of a `.Z` file, as
+    written by the unix `compress`: LZW codes of 9 to `maxbits` bits,
+    read in groups of 8 codes, where the rest of a group is skipped when
+    the code width changes or the table is cleared.
+    """
+    if data[:2] != LZW_MAGIC or len(data) < 3:
+        raise ValueError("Not a .Z file")
+    maxbits = data[2] & 0x1f
+    block_mode = bool(data[2] & 0x80)
+    if not 9 <= maxbits <= 16:
+        raise ValueError(f"Unsupported LZW code width: {maxbits} bits")
+    maxmaxcode = 1 << maxbits
+    first = 257 if block_mode else 256
+
+    # padding for reading the last codes three bytes at a time
+    buf = np.frombuffer(bytes(data) + b'\0\0\0', dtype=np.uint8)
+    n_total = len(data) * 8
+
+    # index 256 is the clear code in block mode
+    table = [bytes([i]) for i in range(256)] + [b''] * (first - 256)
+    prev = None
+    full = None
+    n_bits = 9
+    posbits = seg_start = 24
+    while True:
+        if n_bits < maxbits and len(table) > (1 << n_bits) - 1:
+            # wider codes start at the next group of codes
+            group = n_bits * 8
+            posbits = seg_start + -(-(posbits - seg_start) // group) * group
+            seg_start = posbits
+            n_bits += 1
+
+        count = (n_total - posbits) // n_bits
+        if count <= 0:
+            break
+        if n_bits < maxbits:
+            count = min(count, (1 << n_bits) - len(table) + (prev is None))
+        count = min(count, CODE_BATCH)
+        codes = _unpack_codes(buf, posbits, n_bits, count)
+
+        clear = False
+        if block_mode:
+            clears = np.flatnonzero(codes == 256)
+            if len(clears) > 0:
+                clear = True
+                codes = codes[:clears[0]+1]
+        posbits += len(codes) * n_bits
+        if clear:
+            codes = codes[:-1]
+
+        out = []
+        if len(codes) > 0 and prev is None:
+            if codes[0] >= 256:
+                raise ValueError("Corrupt LZW data: first code out of range")
+            prev = table[codes[0]]
+            out.append(prev)
+            codes = codes[1:]
+        n_add = max(maxmaxcode - len(table), 0)
+        prev = _decode(codes[:n_add].tolist(), table, prev, out)
+        if len(codes) > n_add:
+            # the table is full, the codes only refer to existing strings
+            if full is None:
+                full = _flatten(table)
+            out.append(_gather(*full, codes[n_add:]))
+            prev = table[codes[-1]]
+        if out:
+            yield b''.join(out)
+
+        if clear:
+            group = n_bits * 8
+            posbits = seg_start + -(-(posbits - seg_start) // group) * group
+            seg_start = posbits
+            n_bits = 9
+            del table[first:]
+            prev = None
+            full = None
+
+
+def _iter_gzip(f):
+    """
+    Internal generator decompressing a gzip file with `zlib`,
+    which releases the GIL, including files of several members.
+    """
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        while chunk:
+            yield decomp.decompress(chunk)
+            chunk = decomp.unused_data
+            if chunk:
+                yield decomp.flush()
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decomp.flush()
+
+
+def iter_decompress(filename):
+    """
+    Decompress a `.Z` (unix compress) or `.gz` file chunk by chunk,
+    without any external program. The format is given by the magic
+    bytes of the file. `.Z` files are read in memory at once, while
+    gzip files are streamed.
+
+    Parameters
+    ----------
+    filename: str
+        path to the compressed file
+
+    Yields
+    ------
+    chunk: bytes
+        successive parts of the decompressed content
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+        f.seek(0)
+        if magic == GZIP_MAGIC:
+            yield from _iter_gzip(f)
+        elif magic == LZW_MAGIC:
+            yield from _iter_lzw(f.read())
+        else:
+            raise ValueError(f"{filename} is not a .Z or gzip file")
+
+
+def _header_end(data, start=0):
+    """
+    Internal function giving the end of the FITS header at the beginning
+    of `data`, i.e. the end of the block holding the END card, or None if
+    the header is not complete. The blocks before `start` are not checked.
+    """
+    for i in range(start, len(data) // FITS_BLOCK):
+        block = data[i * FITS_BLOCK:(i + 1) * FITS_BLOCK]
+        if any(block[j:j+8] == b'END     '
+               for j in range(0, FITS_BLOCK, 80)):
+            return (i + 1) * FITS_BLOCK
+    return None
+
+
+def _data_size(header):
+    """
+    Internal function giving the size in bytes of the data following
+    `header`, including the padding to a whole FITS block.
+    """
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for i in range(1, naxis + 1):
+        size *= header[f'NAXIS{i}']
+    size = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * \
+           (header.get('PCOUNT', 0) + size)
+    return -(-size // FITS_BLOCK) * FITS_BLOCK
+
+
+class _HeaderScan:
+    """
+    Internal class collecting the first FITS blocks of a stream until
+    the primary header is complete.
+    """
+
+    def __init__(self, max_blocks=200):
+        self.data = bytearray()
+        self.checked = 0
+        self.max_blocks = max_blocks
+        self.done = False
+
+    def feed(self, chunk):
+        """ Returns the primary header once it is complete, else None. """
+        if self.done:
+            return None
+        self.data += chunk[:self.max_blocks * FITS_BLOCK - len(self.data)]
+        if not self.data[:8] == b'SIMPLE  '[:len(self.data)]:
+            self.done = True
+            return None
+        n_blocks = len(self.data) // FITS_BLOCK
+        end = _header_end(self.data, self.checked)
+        if end is not None:
+            self.done = True
+            return fits.Header.fromstring(bytes(self.data[:end]))
+        self.checked = n_blocks
+        if n_blocks >= self.max_blocks:
+            self.done = True
+        return None
+
+
+def read_header(filename):
+    """
+    Read the primary FITS header of a compressed file, decompressing
+    only the beginning of the file.
+
+    Parameters
+    ----------
+    filename: str
+        path to the `.Z` or `.gz` file
+
+    Returns
+    -------
+    header: astropy.io.fits.Header
+        the primary header
+    """
+    scan = _HeaderScan()
+    for chunk in iter_decompress(filename):
+        header = scan.feed(chunk)
+        if header is not None:
+            return header
+        if scan.done:
+            break
+    raise OSError(f"No FITS header found in {filename}")
+
+
+def read_headers(filename, max_blocks=200):
+    """
+    Read the headers of all the HDUs of a compressed FITS file. The file
+    is decompressed as a stream and the data are skipped, so that the
+    memory used does not depend on the size of the file.
+
+    Parameters
+    ----------
+    filename: str
+        path to the `.Z` or `.gz` file
+    max_blocks: int
+        maximum number of FITS blocks of a header
+
+    Returns
+    -------
+    headers: list
+        the headers of the HDUs, starting with the primary header
+    """
+    headers = []
+    data = bytearray()
+    checked = skip = 0
+    for chunk in iter_decompress(filename):
+        if skip >= len(chunk):
+            skip -= len(chunk)
+            continue
+        data += memoryview(chunk)[skip:]
+        skip = 0
+        while skip == 0 and len(data) > 0:
+            if not headers and data[:8] != b'SIMPLE  '[:len(data)]:
+                raise OSError(f"{filename} is not a FITS file")
+            end = _header_end(data, checked)
+            if end is None:
+                checked = len(data) // FITS_BLOCK
+                if checked >= max_blocks:
+                    # no further HDU, e.g. trailing bytes after the last one
+                    return headers
+                break
+            header = fits.Header.fromstring(bytes(data[:end]))
+            headers.append(header)
+            n_bytes = end + _data_size(header)
+            skip = max(n_bytes - len(data), 0)
+            del data[:n_bytes]
+            checked = 0
+    if not headers:
+        raise OSError(f"No FITS header found in {filename}")
+    return headers
+
+
+def _strip_compression(filename):
+    for ext in COMPRESSED_EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def decompress_file(filename, output=None, remove=True, on_header=None):
+    """
+    Decompress a `.Z` or `.gz` file. The content is written to a
+    temporary file, which is renamed when it is complete.
+
+    Parameters
+    ----------
+    filename: str
+        path to the compressed file
+    output: str, optional
+        path to the decompressed file, by default `filename` without
+        the `.Z` or `.gz` extension
+    remove: bool
+        remove the compressed file afterwards, as `uncompress` does
+    on_header: callable, optional
+        called with `output` and the primary FITS header as soon as the
+        header is decompressed, i.e. before the file is complete
+
+    Returns
+    -------
+    output: str
+        path to the decompressed file
+    """
+    from excalibuhr.utils import atomic_write
+
+    if output is None:
+        output = _strip_compression(filename)
+        if output == filename:
+            raise ValueError(f"Unknown compression of {filename}")
+    scan = _HeaderScan() if on_header is not None else None
+    with atomic_write(output) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            for chunk in iter_decompress(filename):
+                f.write(chunk)
+                if scan is not None and not scan.done:
+                    header = scan.feed(chunk)
+                    if header is not None:
+                        on_header(output, header)
+    if remove:
+        os.remove(filename)
+    return output
+
+
+def decompress_files(files, max_workers=4, remove=True, on_header=None):
+    """
+    Decompress `.Z` and `.gz` files in parallel threads, see
+    :func:`decompress_file`. The headers passed to `on_header` are
+    scanned while the files are decompressed, so that ingesting them
+    overlaps the decompression of the data.
+
+    Parameters
+    ----------
+    files: list
+        paths to the compressed files
+    max_workers: int
+        maximum number of files decompressed at the same time
+    remove: bool
+        remove the compressed files afterwards
+    on_header: callable, optional
+        called from the threads with the path to each decompressed file
+        and its primary header
+
+    Returns
+    -------
+    outputs: list
+        paths to the decompressed files, in the order of `files`.
+        The files failing to decompress are reported and skipped.
+    """
+    if len(files) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as pool:
+        jobs = [pool.submit(decompress_file, file, remove=remove,
+                            on_header=on_header) for file in files]
+        outputs = []
+        for file, job in zip(files, jobs):
+            try:
+                outputs.append(job.result())
+            except Exception as err:
+                warnings.warn(f"Failed to decompress {file}: {err}")
+    return outputs
@@ -1,8 +1,14 @@
 # File: src/excalibuhr/data.py
-__all__ = ['SPEC', 'SERIES', 'DETECTOR']
-
+__all__ = ['SPEC', 'SERIES', 'DETECTOR', 'AsyncWriter', 'read_extr2d', 
+           'convert_extr2d', 'encode_bpm', 'read_bpm', 'read_dat', 'write_dat']
+
+import os
+import queue
+import atexit
+import weakref
+import threading
+from collections import deque
 import numpy as np 
-import matplotlib.pyplot as plt 
 from astropy.io import fits
 from astropy import stats
 from scipy.interpolate import interp1d
@@ -10,46 +16,262 @@ from scipy import ndimage, signal
 import excalibuhr.utils as su 
 import copy 
 
+# imported at the first plot
+plt = su.plt
+pd = su.lazy_import('pandas')
+
+# options of the tile compression of images, see `wfits`
+COMPRESSION = {
+    'lossless': {'compression_type': 'GZIP_2', 'quantize_level': 0.},
+    'quantized': {'compression_type': 'RICE_1', 'quantize_level': 16.,
+                  'quantize_method': 2},
+}
+
+BPM_FORMATS = ['int', 'uint8', 'packed']
+
 
 class SERIES:
     """
-    Object for spectral data in 2D shape (N_chip x N_pixel)
-    It contains the wavelength, flux, and error arrays. 
-    It has several methods for manipulating and analyzing the data.
+    Object for a time series of spectral data in 3D shape 
+    (N_frame x N_chip x N_pixel). 
+    The flux and error of all frames are kept in single arrays, and the
+    frames and slices of the series are views into these arrays. 
+    The wavelength is either shared by all frames (N_chip x N_pixel),
+    or given per frame (N_frame x N_chip x N_pixel).
+
+    A series read from a FITS file is loaded lazily: the file stays 
+    memory-mapped, and indexing a frame, e.g. ``series[i]`` or 
+    ``series[i, chips]``, only reads the data of that frame. 
+    The whole flux and error arrays are read at the first access of 
+    the attributes `flux` or `err`. The file is closed by :meth:`close`, 
+    at the end of a ``with`` block, or when the series is deleted.
     """
 
-    def __init__(self, filename=None, wlen=None, flux=None, err=None, header=None):
+    def __init__(self, filename=None, wlen=None, flux=None, err=None, header=None,
+                 lazy=True):
+        self._hdul = None
+        self._sources = None
+        self._order = None
+        self._flux, self._err = None, None
         if filename is not None:
             ext = filename.split('.')[-1]
             if ext == "fits":
-                with fits.open(filename) as hdu:
-                    self.header = hdu[0].header
-                    self.flux = hdu['FLUX'].data
-                    self.err = hdu['FLUX_ERR'].data
-                    self.wlen = hdu['WAVE'].data
+                hdu = fits.open(filename, memmap=True)
+                self.header = hdu[0].header
+                self.wlen = np.array(hdu['WAVE'].data)
+                if lazy:
+                    self._hdul = hdu
+                    self._finalizer = weakref.finalize(self, hdu.close)
+                    self._sources = (hdu['FLUX'].section, hdu['FLUX_ERR'].section 
+                                     if 'FLUX_ERR' in hdu else None)
+                    self._shape = hdu['FLUX'].shape
+                else:
+                    with hdu:
+                        self._flux = np.array(hdu['FLUX'].data)
+                        self._err = np.array(hdu['FLUX_ERR'].data)
         elif wlen is not None:
-            self.wlen = wlen
-            self.flux = flux
-            self.err = err
+            self.wlen = np.asarray(wlen)
+            self._flux = np.asarray(flux)
+            self._err = None if err is None else np.asarray(err)
             self.header = header
         
-        self.data = [SPEC(wlen=self.wlen, flux=self.flux[i], 
-                          err=self.err[i], header=self.header
-                          ) for i in range(len(self.flux))]
+        self.sort_wlen()
+
+    def close(self):
+        """ 
+        Close the file of a lazy series. The frames that have not been 
+        read can no longer be accessed.
+        """
+        if self._hdul is not None:
+            self._finalizer()
+            self._hdul = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # pickle the data instead of the file handle
+        self._flux, self._err = self.flux, self.err
+        state = self.__dict__.copy()
+        state['_hdul'] = state['_sources'] = None
+        state.pop('_finalizer', None)
+        return state
+
+    def _read(self, i, frames, chips=slice(None)):
+        # read the flux (i=0) or error (i=1) of the frames and chips 
+        # from the file, with the chips sorted by wavelength
+        src = self._sources[i]
+        if src is None:
+            return None
+        if not isinstance(frames, (int, np.integer, slice)):
+            # index arrays are read frame by frame
+            frames = np.arange(self._shape[0])[frames]
+            return np.array([self._read(i, f, chips) for f in frames])
+        if self._order is None:
+            if isinstance(chips, slice):
+                return np.asarray(src[frames, chips])
+            return np.asarray(src[frames])[..., chips, :]
+        order = self._order[frames] if self._order.ndim == 2 else self._order
+        data = np.asarray(src[frames])
+        if np.ndim(order) == 2:
+            data = np.take_along_axis(data, order[..., None], axis=-2)
+        else:
+            data = data[..., order, :]
+        return data[..., chips, :]
+
+    @property
+    def flux(self):
+        if self._flux is None and self._sources is not None:
+            self._flux = self._read(0, slice(None))
+        return self._flux
+
+    @flux.setter
+    def flux(self, value):
+        self._flux = value
+
+    @property
+    def err(self):
+        if self._err is None and self._sources is not None:
+            self._err = self._read(1, slice(None))
+        return self._err
+
+    @err.setter
+    def err(self, value):
+        self._err = value
+
+    @property
+    def Nchip(self):
+        return self.wlen.shape[-2]
+
+    def _lazy(self):
+        # whether the flux of the frames has to be read from the file
+        return self._flux is None and self._sources is not None
+
+    def _frame_wlen(self, indices):
+        if self.wlen.ndim == 3:
+            return self.wlen[indices]
+        return self.wlen
+
+    def _new(self, wlen, flux, err):
+        # a series sharing the header, without sorting again
+        series = SERIES.__new__(SERIES)
+        series._hdul = series._sources = series._order = None
+        series.wlen, series._flux, series._err = wlen, flux, err
+        series.header = self.header
+        return series
+
+    def sort_wlen(self):
+        """
+        Sort the chips of all frames by their starting wavelength. 
+        The arrays are only copied if they are not sorted yet.
+        The frames of a lazy series are sorted when they are read.
+        """
+        wmin = self.wlen[..., 0]
+        indices = np.argsort(wmin, axis=-1)
+        if np.all(indices == np.arange(indices.shape[-1])):
+            return
+        if self.wlen.ndim == 3:
+            self.wlen = np.take_along_axis(self.wlen, indices[..., None], axis=1)
+        else:
+            self.wlen = self.wlen[indices]
+        if self._lazy():
+            self._order = indices
+            return
+        if self.wlen.ndim == 3:
+            indices = indices[..., None]
+            self.flux = np.take_along_axis(self.flux, indices, axis=1)
+            if self.err is not None:
+                self.err = np.take_along_axis(self.err, indices, axis=1)
+        else:
+            self.flux = self.flux[:, indices]
+            if self.err is not None:
+                self.err = self.err[:, indices]
 
     def __iter__(self):
-        return self.data.__iter__()
+        for i in range(len(self)):
+            yield self[i]
     
 
     def __getitem__(self, indices):
-        if isinstance(indices, int):
-            return self.data[indices]
+        if isinstance(indices, tuple):
+            frames, chips = indices
         else:
-            return SERIES(specs=[self.data[ind] for ind in indices])
+            frames, chips = indices, slice(None)
+        if isinstance(chips, (int, np.integer)):
+            chips = [chips]
+
+        wlen = self._frame_wlen(frames)[..., chips, :]
+        if self._lazy():
+            flux, err = self._read(0, frames, chips), self._read(1, frames, chips)
+        else:
+            flux = self.flux[frames][..., chips, :]
+            err = None if self.err is None else self.err[frames][..., chips, :]
+
+        if isinstance(frames, (int, np.integer)):
+            return SPEC._view(wlen, flux, err, self.header)
+        else:
+            # slices give views, index arrays give copies of the frames
+            return self._new(wlen, flux, err)
 
 
     def __len__(self):
-        return len(self.data)
+        if self._lazy():
+            return self._shape[0]
+        return len(self.flux)
+
+
+    @property
+    def data(self):
+        """ list of the frames as :class:`SPEC` views """
+        return list(self)
+
+
+    def normalize(self, stat='median'):
+        """
+        Normalize each frame by the median or mean of its flux.
+
+        Parameters
+        ----------
+        stat: str
+            `median` or `mean` of the flux of all chips of a frame.
+
+        Returns
+        -------
+        series: SERIES
+            the normalized series
+        """
+        if stat == 'median':
+            norm = np.nanmedian(self.flux, axis=(1, 2), keepdims=True)
+        elif stat == 'mean':
+            norm = np.nanmean(self.flux, axis=(1, 2), keepdims=True)
+        else:
+            raise ValueError("stat must be either 'median' or 'mean'")
+        err = None if self.err is None else self.err / norm
+        return self._new(self.wlen, self.flux / norm, err)
+
+
+    def mask(self, mask):
+        """
+        Mask pixels of the series by setting them to NaN.
+
+        Parameters
+        ----------
+        mask: array
+            boolean mask, of the shape (N_chip x N_pixel) to mask the 
+            same pixels in all frames, or of the shape of the series.
+
+        Returns
+        -------
+        series: SERIES
+            the masked series
+        """
+        mask = np.broadcast_to(mask, self.flux.shape)
+        flux = np.where(mask, np.nan, self.flux)
+        err = None if self.err is None else np.where(mask, np.nan, self.err)
+        return self._new(self.wlen, flux, err)
 
 
 class SPEC:
@@ -59,21 +281,27 @@ class SPEC:
     It has several methods for manipulating and analyzing the data.
     """
 
-    def __init__(self, filename=None, wlen=None, flux=None, err=None, header=None):
+    def __init__(self, filename=None, wlen=None, flux=None, err=None, header=None,
+                 cache=False):
         """
         initilize the object either with arrays passed via variables, 
         `wlen`, `flux`, and `err`, or with data read from text files 
-        and FITS files. 
+        and FITS files. The arrays of FITS files are memory-mapped, 
+        so that only the chips which are used are read. 
         
         fmt: string
             
+        cache: bool
+            keep a binary copy of text files for faster reading, 
+            see :func:`read_dat`.
         """
         
         if filename is not None:
             ext = filename.split('.')[-1]
             if ext == "fits":
+                # the arrays stay memory-mapped, and are read when used
                 # if fmt == "ext3":
-                with fits.open(filename) as hdu:
+                with fits.open(filename, memmap=True) as hdu:
                     self.header = hdu[0].header
                     self.flux = hdu['FLUX'].data
                     self.err = hdu['FLUX_ERR'].data
@@ -91,13 +319,10 @@ class SPEC:
                 #     self.err = np.array(f_err)
                 #     self.wlen = np.array(w)
             else:
-                try:
-                    self.wlen, self.flux, self.err = \
-                        np.genfromtxt(filename, skip_header=1, unpack=True)
-                except:
-                    self.wlen, self.flux = \
-                        np.genfromtxt(filename, skip_header=1, unpack=True)
-                    self.err = None
+                columns = read_dat(filename, cache=cache)
+                self.wlen, self.flux = columns[0], columns[1]
+                self.err = columns[2] if len(columns) > 2 else None
+                self.header = None
             self.reformat_data()
         elif wlen is not None:
             self.wlen = wlen
@@ -107,6 +332,16 @@ class SPEC:
             self.reformat_data()
 
 
+    @classmethod
+    def _view(cls, wlen, flux, err=None, header=None):
+        # spectrum of already sorted arrays, without copying them
+        spec = cls.__new__(cls)
+        spec.wlen, spec.flux, spec.err = wlen, flux, err
+        spec.header = header
+        spec.Nchip = wlen.shape[0]
+        return spec
+
+
     def reformat_data(self):
         if not isinstance(self.wlen, np.ndarray):
             self.wlen = np.array(self.wlen)
@@ -130,28 +365,40 @@ class SPEC:
                 self.err = np.reshape(self.err, (Nchip, -1)) 
         elif self.wlen.ndim == 3:
             # detector x order x spec
-            self.wlen.reshape((-1, self.wlen.shape[-1]))
-            self.flux.reshape((-1, self.flux.shape[-1]))
+            self.wlen = self.wlen.reshape((-1, self.wlen.shape[-1]))
+            self.flux = self.flux.reshape((-1, self.flux.shape[-1]))
             if self.err is not None:
-                self.err.reshape((-1, self.err.shape[-1]))
+                self.err = self.err.reshape((-1, self.err.shape[-1]))
 
         wmin = self.wlen[:,0] 
         indices = np.argsort(wmin)
-        self.wlen = self.wlen[indices]
-        self.flux = self.flux[indices]
-        if self.err is not None:
-            self.err = self.err[indices]
+        # keep the (memory-mapped) arrays if they are sorted already
+        if np.any(indices != np.arange(len(indices))):
+            self.wlen = self.wlen[indices]
+            self.flux = self.flux[indices]
+            if self.err is not None:
+                self.err = self.err[indices]
         self.Nchip = self.wlen.shape[0]
 
 
-    def _copy(self, wlen=None, flux=None, err=None):
-        dt = copy.deepcopy(self)
-        if wlen is not None:
-            dt.wlen = wlen 
-        if flux is not None:
-            dt.flux = flux 
-        if err is not None:
-            dt.err = err
+    def _copy(self, wlen=None, flux=None, err=None, header=None):
+        """
+        Derive a spectrum with some of the arrays replaced. 
+        The arrays that are not replaced and the header are shared with 
+        this spectrum instead of copied. The shared arrays are read-only
+        in the derived spectrum: replace them rather than modifying 
+        them in place, e.g. ``spec._copy(flux=spec.flux/norm)``.
+        """
+        dt = copy.copy(self)
+        for key, value in [('wlen', wlen), ('flux', flux), ('err', err)]:
+            if value is not None:
+                setattr(dt, key, value)
+            elif getattr(self, key) is not None:
+                shared = getattr(self, key).view()
+                shared.flags.writeable = False
+                setattr(dt, key, shared)
+        if header is not None:
+            dt.header = header
         dt.reformat_data()
         return dt
 
@@ -182,41 +429,48 @@ class DETECTOR:
             self.load_extr2d(filename)
 
 
-    def save_extr2d(self, filename):
+    def save_extr2d(self, filename, compress=False):
         """
         Method for saving the pipeline extracted 2D spectral data to .npz files.
         The 2D data shape can vary in the spatial diemsion across different orders, 
-        therefore cannot be directly stored as numpy ndarray.
-        The data of all orders are stacked along the 0th axis and then saved as numpy arrays.   
+        therefore each detector and order of each field is saved as a separate 
+        array in the archive, together with an index of their shapes. 
+        A single order can thereby be read without loading the rest of the file, 
+        see :func:`read_extr2d`.
 
         Parameters
         ----------
         filename : str
             Path to save the 2d data as a `.npz` file. A list of 2D data 
-            (such as flux, variance, fitted spatial profile) 
-            will be be stacked and saved.
+            (such as flux, variance, fitted spatial profile) will be saved.
+        compress: bool
+            whether to compress the arrays in the archive.
 
         Returns
         -------
         NoneType
             None
         """
-        all_stacked = {}
-        for key in self.__dict__.keys() - ['Ndet', 'Norder']:
+        fields = sorted(self.__dict__.keys() - ['Ndet', 'Norder'])
+        shapes = np.zeros((self.Ndet, self.Norder, 2), dtype=int)
+        chunks = {}
+        for key in fields:
             dt = self.__getattribute__(key)
-            dt_stack, id_orders = [], []
-            for dt_per_det in dt:
-                order_stack, id_order = stack_ragged(dt_per_det)
-                dt_stack.append(order_stack)
-                id_orders.append(id_order)
-            dt_stack, id_dets = stack_ragged(dt_stack)
-            all_stacked[key] = dt_stack
-        all_stacked['id_dets'] = id_dets
-        all_stacked['id_orders'] = id_orders
-        np.savez(filename, **all_stacked)
-
-
-    def load_extr2d(self, filename):
+            for i in range(self.Ndet):
+                for o in range(self.Norder):
+                    chunk = np.asarray(dt[i][o])
+                    chunks[_chunk_name(key, i, o)] = chunk
+                    shapes[i, o] = np.shape(chunk)[-2:] if chunk.ndim > 1 \
+                                        else (0, 0)
+        chunks['fields'] = np.array(fields)
+        chunks['shapes'] = shapes
+        if compress:
+            np.savez_compressed(filename, **chunks)
+        else:
+            np.savez(filename, **chunks)
+
+
+    def load_extr2d(self, filename, fields=None):
         """
         Method for reading and unraveling the pipeline 2D extracted .npz files into arrays.
 
@@ -226,6 +480,9 @@ class DETECTOR:
             Path of the `EXTR2D` .npz file to load. The 2D data will be unraveled to the 4d 
             shape of (N_detector, N_order, N_spatial_pixel, N_dispersion_pixel), and set as
             the attributes of the class.
+        fields: list, optional
+            names of the fields to load, such as `flux`, `var` or `psf`.
+            Load all fields if None.
 
         Returns
         -------
@@ -233,18 +490,27 @@ class DETECTOR:
             None
         """
 
-        data = np.load(filename)
-        id_dets = data['id_dets']
-        id_orders = data['id_orders']
-        self.Ndet, self.Norder = id_dets.shape[0]+1, id_orders.shape[1]+1
-        for key in data.keys() - ['id_dets', 'id_orders']:
-            dt = data[key]
-            D_unravel = []
-            D_det = np.split(dt, id_dets)
-            for i in range(self.Ndet):
-                D_order = np.split(D_det[i], id_orders[i])
-                D_unravel.append(D_order)
-            setattr(self, key, D_unravel)
+        with np.load(filename) as data:
+            if 'shapes' in data:
+                shapes = data['shapes']
+                self.Ndet, self.Norder = shapes.shape[:2]
+                if fields is None:
+                    fields = list(data['fields'])
+                for key in fields:
+                    D_unravel = [[data[_chunk_name(key, i, o)] 
+                                    for o in range(self.Norder)]
+                                    for i in range(self.Ndet)]
+                    setattr(self, key, D_unravel)
+            else:
+                # files written before the chunked layout
+                id_dets = data['id_dets']
+                id_orders = data['id_orders']
+                self.Ndet, self.Norder = id_dets.shape[0]+1, id_orders.shape[1]+1
+                if fields is None:
+                    fields = data.keys() - ['id_dets', 'id_orders']
+                for key in fields:
+                    setattr(self, key, _unravel_legacy(
+                                    data[key], id_dets, id_orders))
     
     
     def plot_extr2d_model(self, savename):
@@ -273,7 +539,112 @@ class DETECTOR:
         plt.close(fig)
 
 
-def wfits(fname, ext_list: dict, header=None):
+def _dat_header_lines(fname):
+    # number of lines before the first line of numbers
+    with open(fname) as f:
+        for n, line in enumerate(f):
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            try:
+                [float(x) for x in line.split()]
+                return n
+            except ValueError:
+                continue
+    return 0
+
+
+def _dat_cache_name(fname):
+    return fname + '.npz'
+
+
+def _write_dat_cache(fname, data):
+    stat = os.stat(fname)
+    try:
+        with su.atomic_write(_dat_cache_name(fname)) as tmpname:
+            with open(tmpname, 'wb') as f:
+                np.savez(f, data=data, mtime=stat.st_mtime_ns, size=stat.st_size)
+    except OSError:
+        # e.g. a read-only directory, the cache is optional
+        pass
+
+
+def read_dat(fname, cache=False):
+    """
+    read the columns of a text file of numbers, such as the `.dat` 
+    spectra saved by the pipeline. The number of columns and any header 
+    lines are detected automatically.
+
+    Parameters
+    ----------
+    fname: str
+        path of the text file
+    cache: bool
+        keep a binary copy of the data next to the file (`fname.npz`), 
+        which is read instead of the text as long as the text file 
+        is not modified.
+
+    Returns
+    -------
+    columns: array
+        the data in the shape of (N_column, N_row)
+    """
+    if cache and os.path.isfile(_dat_cache_name(fname)):
+        stat = os.stat(fname)
+        try:
+            with np.load(_dat_cache_name(fname)) as cached:
+                if cached['mtime'] == stat.st_mtime_ns and \
+                        cached['size'] == stat.st_size:
+                    return cached['data']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    data = pd.read_csv(fname, sep=r'\s+', comment='#', header=None, 
+                       skiprows=_dat_header_lines(fname), engine='c',
+                       float_precision='round_trip').to_numpy(dtype=float).T
+    if cache:
+        _write_dat_cache(fname, data)
+    return data
+
+
+def write_dat(fname, columns, header='', fmt='%.18e', cache=False, 
+              chunk_size=10000):
+    """
+    write columns of numbers to a text file, in the same format as
+    `np.savetxt`, but formatting blocks of rows at once.
+
+    Parameters
+    ----------
+    fname: str
+        path of the text file
+    columns: list
+        the arrays of the columns, which are flattened.
+    header: str
+        header line, written after a `#`
+    fmt: str
+        format of the numbers
+    cache: bool
+        also write the binary copy used by :func:`read_dat`.
+    chunk_size: int
+        number of rows formatted at once
+    
+    Returns
+    -------
+    NoneType
+        None
+    """
+    data = np.column_stack([np.ravel(c) for c in columns])
+    row = ' '.join([fmt] * data.shape[1]) + '\n'
+    with open(fname, 'w') as f:
+        if header:
+            f.write('# ' + header.replace('\n', '\n# ') + '\n')
+        for i in range(0, len(data), chunk_size):
+            block = data[i:i+chunk_size]
+            f.write((row * len(block)) % tuple(block.ravel().tolist()))
+    if cache:
+        _write_dat_cache(fname, data.T)
+
+
+def wfits(fname, ext_list: dict, header=None, compression=None):
     """
     write data to FITS primary and extensions, overwriting any old file
     
@@ -284,8 +655,14 @@ def wfits(fname, ext_list: dict, header=None):
     ext_list: dict
         to save the data in the dictionary to FITS extension. Specify the datatype 
         (e.g.  "FLUX", "FLUX_ERR", "WAVE", and "MODEL") in the key. 
+        The values can be arrays or FITS extension HDUs, e.g. from :func:`encode_bpm`.
     header: FITS `header`
         header information to be saved
+    compression: str, optional
+        tile compression of the floating-point images: `lossless` (GZIP), 
+        or `quantized` (RICE with a quantization of 1/16 of the noise 
+        of each tile). The compressed images are decompressed 
+        transparently when reading the file with astropy.
 
     Returns
     -------
@@ -293,12 +670,286 @@ def wfits(fname, ext_list: dict, header=None):
         None
     """
 
+    if compression is not None and compression not in COMPRESSION:
+        raise ValueError(f"compression must be one of {list(COMPRESSION)}")
+
     primary_hdu = fits.PrimaryHDU(header=header)
     new_hdul = fits.HDUList([primary_hdu])
     if not ext_list is None:
         for key, value in ext_list.items():
-            new_hdul.append(fits.ImageHDU(value, name=key))
-    new_hdul.writeto(fname, overwrite=True, output_verify='ignore') 
+            if isinstance(value, fits.hdu.base.ExtensionHDU):
+                value.name = key
+                new_hdul.append(value)
+            elif compression is not None and np.ndim(value) > 1 and \
+                    np.issubdtype(np.asarray(value).dtype, np.floating):
+                new_hdul.append(fits.CompImageHDU(np.asarray(value), name=key, 
+                                                  **COMPRESSION[compression]))
+            else:
+                new_hdul.append(fits.ImageHDU(value, name=key))
+    # write to a temporary file first, so that readers never see 
+    # a partially written file
+    with su.atomic_write(fname) as tmpname:
+        new_hdul.writeto(tmpname, overwrite=True, output_verify='ignore') 
+
+
+def encode_bpm(badpix, encoding='uint8'):
+    """
+    encode a bad-pixel map for saving with :func:`wfits`.
+
+    Parameters
+    ----------
+    badpix: array
+        boolean bad-pixel map
+    encoding: str
+        `uint8` for one byte per pixel, `packed` for one bit per pixel, 
+        or `int` for the 64-bit integers of previous versions.
+
+    Returns
+    -------
+    hdu: `ImageHDU`
+        the encoded bad-pixel map, to be decoded with :func:`read_bpm`.
+    """
+    badpix = np.asarray(badpix, dtype=bool)
+    if encoding == 'int':
+        hdu = fits.ImageHDU(badpix.astype(int))
+    elif encoding == 'uint8':
+        hdu = fits.ImageHDU(badpix.astype(np.uint8))
+    elif encoding == 'packed':
+        hdu = fits.ImageHDU(np.packbits(badpix, axis=-1))
+        hdu.header['BPMPACK'] = (badpix.shape[-1], 
+                                 'bit-packed bad pixels, number of columns')
+    else:
+        raise ValueError(f"BPM encoding must be one of {BPM_FORMATS}")
+    return hdu
+
+
+def read_bpm(fname):
+    """
+    read a bad-pixel map saved in any of the encodings of :func:`encode_bpm`.
+
+    Parameters
+    ----------
+    fname: str
+        path of the bad-pixel map
+
+    Returns
+    -------
+    badpix: array
+        boolean bad-pixel map
+    """
+    with fits.open(fname) as hdul:
+        hdu = next(h for h in hdul if h.data is not None)
+        badpix = hdu.data
+        if 'BPMPACK' in hdu.header:
+            badpix = np.unpackbits(badpix, axis=-1, 
+                                   count=hdu.header['BPMPACK'])
+        return badpix.astype(bool)
+
+
+class AsyncWriter:
+    """
+    Queue of FITS files to be written by a background thread with 
+    :func:`wfits`, so that the computation overlaps with the disk I/O.
+    The writer can be pickled and passed to worker processes, which 
+    start their own thread at the first write.
+
+    Parameters
+    ----------
+    background: bool
+        If False, write the files immediately in the calling thread.
+    maxsize: int
+        maximum number of files waiting to be written. Further writes 
+        block until there is space in the queue, which bounds the memory
+        held by pending data.
+    """
+
+    def __init__(self, background=True, maxsize=4):
+        self.background = background
+        self.maxsize = maxsize
+        self._init_state()
+
+    def _init_state(self):
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._done = deque()
+
+    def __getstate__(self):
+        # pending files and the thread are not passed to other processes
+        return {'background': self.background, 'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def start(self):
+        """ Start the background thread. """
+        self._queue = queue.Queue(maxsize=self.maxsize)
+        self._thread = threading.Thread(target=self._write_loop, 
+                            name='excalibuhr-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _write_loop(self):
+        while True:
+            request = self._queue.get()
+            try:
+                if request is None:
+                    break
+                fname, ext_list, header, compression, callback = request
+                try:
+                    wfits(fname, ext_list, header=header, 
+                          compression=compression)
+                    if callback is not None:
+                        self._done.append(callback)
+                except Exception as e:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        # run the callbacks of the written files in the calling thread,
+        # and raise the errors of the background thread
+        while self._done:
+            self._done.popleft()()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, fname, ext_list: dict, header=None, compression=None, 
+              callback=None):
+        """
+        Request writing a FITS file, see :func:`wfits`. 
+        The arrays must not be modified after the request.
+
+        Parameters
+        ----------
+        fname: str
+            path and filename to which the data is saved 
+        ext_list: dict
+            data to save to the FITS extensions, keyed by the extension name.
+        header: FITS `header`
+            header information to be saved
+        compression: str, optional
+            tile compression of the images, see :func:`wfits`.
+        callback: callable, optional
+            function called without arguments once the file is written,
+            e.g. to plot the saved data. It is run in the thread calling 
+            :meth:`write` or :meth:`flush`.
+        """
+        self._check()
+        if not self.background:
+            wfits(fname, ext_list, header=header, compression=compression)
+            if callback is not None:
+                callback()
+            return
+        if self._thread is None:
+            self.start()
+        if header is not None:
+            header = header.copy()
+        self._queue.put((fname, dict(ext_list), header, compression, callback))
+
+    def flush(self):
+        """ Wait for the queued files to be written. """
+        if self._queue is not None:
+            self._queue.join()
+        self._check()
+
+    def close(self):
+        """ Wait for the queued files to be written and stop the thread. """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._queue = self._thread = None
+        atexit.unregister(self.close)
+        self._check()
+
+
+def read_extr2d(filename, field='flux', det=None, order=None):
+    """
+    read a field of a pipeline 2D extracted .npz file, without loading 
+    the other fields, detectors, or orders.
+
+    Parameters
+    ----------
+    filename: str
+        path of the `EXTR2D` .npz file
+    field: str
+        name of the field to read, such as `flux`, `var` or `psf`.
+    det: int, optional
+        index of the detector. Read all detectors if None.
+    order: int, optional
+        index of the order. Read all orders if None.
+
+    Returns
+    -------
+    data: array or list
+        the 2D array of the selected detector and order, or nested lists 
+        of 2D arrays (detector, order) if `det` or `order` is None.
+    """
+    with np.load(filename) as data:
+        if 'shapes' in data:
+            Ndet, Norder = data['shapes'].shape[:2]
+            read = lambda i, o: data[_chunk_name(field, i, o)]
+        else:
+            # files written before the chunked layout
+            id_dets, id_orders = data['id_dets'], data['id_orders']
+            Ndet, Norder = id_dets.shape[0]+1, id_orders.shape[1]+1
+            dt = _unravel_legacy(data[field], id_dets, id_orders)
+            read = lambda i, o: dt[i][o]
+
+        dets = range(Ndet) if det is None else [det]
+        orders = range(Norder) if order is None else [order]
+        result = [[read(i, o) for o in orders] for i in dets]
+
+    if order is not None:
+        result = [r[0] for r in result]
+    if det is not None:
+        result = result[0]
+    return result
+
+
+def convert_extr2d(filename, outname=None, compress=False):
+    """
+    convert a 2D extracted .npz file from the stacked layout used by 
+    previous versions to the chunked layout of :meth:`DETECTOR.save_extr2d`.
+
+    Parameters
+    ----------
+    filename: str
+        path of the `EXTR2D` .npz file to convert
+    outname: str, optional
+        path of the converted file. Overwrite `filename` if None.
+    compress: bool
+        whether to compress the arrays in the converted file.
+
+    Returns
+    -------
+    outname: str
+        path of the converted file
+    """
+    if outname is None:
+        outname = filename
+    extr2d = DETECTOR(filename=filename)
+    # write to a temporary file first, in case `outname` is the input file
+    with su.atomic_write(outname, suffix='.npz') as tmpname:
+        extr2d.save_extr2d(tmpname, compress=compress)
+    return outname
+
+
+def _chunk_name(field, det, order):
+    return f"{field}_{det}_{order}"
+
+
+def _unravel_legacy(dt, id_dets, id_orders):
+    D_unravel = []
+    D_det = np.split(dt, id_dets)
+    for i in range(len(D_det)):
+        D_order = np.split(D_det[i], id_orders[i])
+        D_unravel.append(D_order)
+    return D_unravel
 
 
 def stack_ragged(array_list, axis=0):
@@ -0,0 +1,254 @@
+# File: src/excalibuhr/library.py
+__all__ = ['CalibLibrary', 'CALIB_GROUPS']
+
+import os
+import time
+import shutil
+import hashlib
+import threading
+import contextlib
+import numpy as np
+import excalibuhr.utils as su
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+pd = su.lazy_import('pandas')
+
+
+# Calibration files produced and reused together, and the header keyword
+# of the setting they are produced for
+CALIB_GROUPS = {
+    'DARK': ('ESO DET SEQ1 DIT',
+             ['DARK_MASTER', 'DARK_RON', 'DARK_BPM']),
+    'WLEN': ('ESO INS WLEN ID',
+             ['FLAT_MASTER', 'FLAT_BPM', 'TRACE_TW', 'SLIT_TILT',
+              'INIT_WLEN', 'FLAT_NORM', 'BLAZE']),
+}
+
+INDEX_COLUMNS = ['CAL TYPE', 'GROUP', 'NIGHT', 'MJD-OBS', 'ESO INS WLEN ID',
+                 'ESO DET SEQ1 DIT', 'ESO INS SLIT1 NAME', 'FILE', 'SIZE',
+                 'SHA256', 'ADDED']
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _sha256(filename):
+    sha_file = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha_file.update(chunk)
+    return sha_file.hexdigest()
+
+
+class CalibLibrary:
+    """
+    Library of processed calibrations shared by the reductions of
+    several nights. The calibrations are stored in groups: the master
+    dark, read-out noise and bad-pixel map of a DIT (`DARK`), and the
+    master flat, traces, slit curvature, initial wavelength solution,
+    normalized flat and blaze of a wavelength setting (`WLEN`).
+    The groups are indexed in `index.txt` by the calibration type,
+    setting, and observing date, and the files of each night are kept
+    in a subfolder named by the night.
+
+    A group is reused for another night if it has the same setting
+    (DIT, or wavelength setting and slit), is observed within the
+    reuse window of the group, and all its files are present and
+    unchanged. The closest group in time is used.
+
+    Parameters
+    ----------
+    path: str
+        folder of the library, created if it does not exist
+    windows: dict, optional
+        maximum time in days between the observations of a night and
+        the calibrations reused for it, per group.
+        By default, 14 days for `DARK` and 3 days for `WLEN`.
+    reuse: str
+        `always` to reuse a matching group instead of processing the
+        raw calibrations of the night, or `missing` to only reuse
+        groups whose raw calibrations are missing.
+    verify: bool
+        check the checksum of the files before reusing them,
+        otherwise only their size is checked.
+    """
+
+    def __init__(self, path, windows=None, reuse='always', verify=True):
+        if reuse not in ('always', 'missing'):
+            raise ValueError("reuse must be either 'always' or 'missing'")
+        self.path = os.path.abspath(path)
+        self.windows = {'DARK': 14., 'WLEN': 3.}
+        if windows is not None:
+            self.windows.update(windows)
+        self.reuse = reuse
+        self.verify = verify
+        self.index_file = os.path.join(self.path, 'index.txt')
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def __repr__(self):
+        return f"CalibLibrary('{self.path}', reuse='{self.reuse}')"
+
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Internal context manager serializing the updates of the index
+        by the threads and processes sharing the library.
+        """
+        with _locks_lock:
+            lock = _locks.setdefault(self.path, threading.Lock())
+        with lock, open(os.path.join(self.path, 'index.lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def read_index(self):
+        """
+        Method for reading the index of the library.
+
+        Returns
+        -------
+        index: pandas.DataFrame
+            one row per calibration file
+        """
+        if not os.path.isfile(self.index_file):
+            return pd.DataFrame(columns=INDEX_COLUMNS)
+        return pd.read_csv(self.index_file, sep=';',
+                           dtype={'NIGHT': str, 'ESO INS WLEN ID': str})
+
+
+    def _write_index(self, index):
+        with su.atomic_write(self.index_file) as tmp_file:
+            index.to_csv(tmp_file, index=False, sep=';')
+
+
+    def _select(self, index, group, setting):
+        """
+        Internal method for selecting the rows of a group with the setting
+        given by the DIT or the wavelength setting.
+        """
+        key = CALIB_GROUPS[group][0]
+        indices = index['GROUP'] == group
+        if group == 'DARK':
+            return indices & np.isclose(
+                index[key].astype(float), float(setting), rtol=1e-6)
+        return indices & (index[key].astype(str) == str(setting))
+
+
+    def add(self, night, group, setting, files, headers):
+        """
+        Method for adding the calibration files of a group processed for
+        a night, replacing the same group of a previous run of the night.
+
+        Parameters
+        ----------
+        night: str
+            name of the night
+        group: str
+            `DARK` or `WLEN`, see :data:`CALIB_GROUPS`
+        setting: float or str
+            DIT or wavelength setting of the group
+        files: list
+            paths to the calibration files of each type in the group
+        headers: list
+            primary headers of the files, giving the observing date and
+            instrument setting
+        """
+        folder = os.path.join(self.path, night)
+        os.makedirs(folder, exist_ok=True)
+        rows = []
+        for (cal_type, file), header in zip(files, headers):
+            name = os.path.basename(file)
+            dest = os.path.join(folder, name)
+            with su.atomic_write(dest) as tmp_file:
+                shutil.copy2(file, tmp_file)
+            rows.append({
+                'CAL TYPE': cal_type, 'GROUP': group, 'NIGHT': night,
+                'MJD-OBS': header.get('MJD-OBS'),
+                'ESO INS WLEN ID': header.get('ESO INS WLEN ID'),
+                'ESO DET SEQ1 DIT': header.get('ESO DET SEQ1 DIT'),
+                'ESO INS SLIT1 NAME': header.get('ESO INS SLIT1 NAME'),
+                'FILE': os.path.join(night, name),
+                'SIZE': os.path.getsize(dest),
+                'SHA256': _sha256(dest),
+                'ADDED': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                })
+
+        with self._locked():
+            index = self.read_index()
+            old = self._select(index, group, setting) & (index['NIGHT'] == night)
+            index = pd.concat([index[~old], pd.DataFrame(rows)],
+                              ignore_index=True)
+            self._write_index(index)
+
+
+    def _valid(self, rows):
+        """
+        Internal method for checking that the files of a group are complete
+        and unchanged since they were added.
+        """
+        group = rows['GROUP'].iloc[0]
+        if not set(CALIB_GROUPS[group][1]) <= set(rows['CAL TYPE']):
+            return False
+        for _, row in rows.iterrows():
+            file = os.path.join(self.path, row['FILE'])
+            if not os.path.isfile(file) or os.path.getsize(file) != row['SIZE']:
+                return False
+            if self.verify and _sha256(file) != row['SHA256']:
+                return False
+        return True
+
+
+    def lookup(self, group, setting, mjd, slit=None, exclude_night=None):
+        """
+        Method for finding the closest valid group of calibrations
+        for an observation.
+
+        Parameters
+        ----------
+        group: str
+            `DARK` or `WLEN`, see :data:`CALIB_GROUPS`
+        setting: float or str
+            DIT or wavelength setting of the group
+        mjd: float
+            MJD of the observation
+        slit: str, optional
+            slit of the observation, required to match for `WLEN` groups
+        exclude_night: str, optional
+            night whose calibrations are not reused, e.g. the night itself
+
+        Returns
+        -------
+        match: list or None
+            types of calibrations, paths to the files, and the night of
+            the group, or None if no valid group is found.
+        """
+        index = self.read_index()
+        if len(index) == 0:
+            return None
+        indices = self._select(index, group, setting)
+        if exclude_night is not None:
+            indices &= (index['NIGHT'] != exclude_night)
+        if group == 'WLEN' and slit is not None:
+            indices &= (index['ESO INS SLIT1 NAME'].astype(str) == str(slit))
+        candidates = index[indices]
+
+        # nights ordered by their time to the observation
+        delay = candidates.groupby('NIGHT')['MJD-OBS'].mean().sub(mjd).abs()
+        for night, days in delay.sort_values().items():
+            if days > self.windows[group]:
+                break
+            rows = candidates[candidates['NIGHT'] == night]
+            if self._valid(rows):
+                return [(cal_type, os.path.join(self.path, file), night)
+                        for cal_type, file in zip(rows['CAL TYPE'], rows['FILE'])]
+        return None
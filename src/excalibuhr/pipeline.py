@@ -4,36 +4,95 @@ __all__ = ['CriresPipeline']
 
 import os
 os.environ["OMP_NUM_THREADS"] = "1"
-import sys
-import glob
 import time
+import json
+import hashlib
+import inspect
 import shutil
+import queue
 import warnings
 from pathlib import Path
 import numpy as np
-import pandas as pd
-from numpy.polynomial import polynomial as Poly
 from multiprocessing import Pool
 from astropy.io import fits
-from astroquery.eso import Eso
-import skycalc_ipy
 import excalibuhr.utils as su
-from excalibuhr.data import SPEC, SERIES, DETECTOR, wfits
-import matplotlib.pyplot as plt 
+from excalibuhr import profiling
+from excalibuhr.qaplot import QAPlotter, FileRef
+from excalibuhr.library import CalibLibrary, CALIB_GROUPS
+from excalibuhr.archive import EsoArchive, query_concurrent, download_files
+from excalibuhr.compress import decompress_files, COMPRESSED_EXTENSIONS
+from excalibuhr.data import SPEC, SERIES, DETECTOR, AsyncWriter, wfits, \
+                             encode_bpm, read_bpm, read_dat, write_dat, \
+                             COMPRESSION, BPM_FORMATS
 import functools
+import contextlib
+
+pd = su.lazy_import('pandas')
 
 
 def print_runtime(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time.time()
-        result = func(*args, **kwargs)
+        with profiling.record(func.__name__, cat='recipe'):
+            result = func(*args, **kwargs)
+            # the products must be on disk before the next recipe
+            args[0].flush_writes()
         end_time = time.time()
         print(f"\n {func.__name__} runtime: {(end_time - start_time):.1f} s \n")
         return result
     return wrapper
 
 
+def recipe(inputs=(), outputs=(), updates=()):
+    """
+    Decorator declaring the inputs and outputs of a recipe, so that the 
+    recipe is skipped in incremental mode if its inputs and parameters 
+    have not changed since the last run. 
+
+    Inputs and outputs are specified as `header` (the header_info file),
+    `raw` (all raw files), `raw:<DPR TYPE or CATG>`, `calib:<CAL TYPE>`, 
+    or `product:<CAL TYPE>`, where `{obs_mode}` is replaced by the 
+    observation mode of the pipeline. `updates` are the inputs that the 
+    recipe modifies in place, which does not invalidate the recipes 
+    that produced or consumed them earlier.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            bound = inspect.signature(func).bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = {key: value for key, value in bound.arguments.items() 
+                      if key not in ['self', 'debug']}
+            params['obs_mode'] = self.obs_mode
+            params = json.loads(json.dumps(params, default=str))
+
+            input_files = [f for spec in inputs 
+                           for f in self._recipe_files(spec)]
+            if self.incremental and self._recipe_up_to_date(
+                    func.__name__, input_files, params):
+                print(f"\n {func.__name__}: inputs unchanged, skipped \n")
+                return
+
+            # replace the registrations of a previous run
+            self._remove_registration(outputs)
+            result = func(self, *args, **kwargs)
+            self.flush_writes()
+
+            # the inputs may be renamed or created by the recipe itself
+            input_files = [f for spec in inputs 
+                           for f in self._recipe_files(spec)]
+            output_files = [f for spec in outputs 
+                            for f in self._recipe_files(spec)]
+            update_files = [f for spec in updates 
+                            for f in self._recipe_files(spec)]
+            self._record_recipe(func.__name__, input_files, output_files, 
+                                params, update_files)
+            return result
+        return wrapper
+    return decorator
+
+
 class CriresPipeline:
 
     """
@@ -54,12 +113,75 @@ class CriresPipeline:
         entire reduction.
     num_processes: int
         number of parallel processes for processing nodding and extraction
+    incremental: bool
+        Skip the calibration and preprocessing recipes whose inputs and 
+        parameters are unchanged since their last run. The state is 
+        recorded in `recipe_state.json` in the folder of the night.
+    profile: bool
+        Record the wall time, CPU time, and memory usage of each recipe, 
+        worker job, detector, and order, see :meth:`save_profile`.
+    qa_plots: str
+        Level of the quality-assessment plots: `off`, `summary` for the 
+        plots of calibrations and combined products, or `full` to also 
+        plot each frame.
+    qa_background: bool
+        Render the QA plots in a background process, so that the 
+        reduction does not wait for them. See :meth:`flush_plots`.
+    dtype: str
+        Precision of the images and errors, `float64` or `float32`. 
+        `float32` halves the memory and disk usage of the detector 
+        images, while polynomial fits and the optimal extraction are 
+        still computed in double precision.
+    async_write: bool
+        Write the FITS products in a background thread, so that the 
+        computation overlaps with the disk I/O. See :meth:`flush_writes`.
+    product_dtype: str, optional
+        Precision of the saved calibration images and frames, 
+        `float64` or `float32`. The same as `dtype` if None.
+    bpm_format: str
+        Encoding of the saved bad-pixel maps: `uint8`, `packed` for one 
+        bit per pixel, or `int` as in previous versions. The maps are 
+        decoded with :func:`excalibuhr.data.read_bpm`.
+    compression: str, optional
+        Tile compression of the saved nodding and combined frames: 
+        `lossless`, or `quantized` to 1/16 of the local noise. 
+        The frames are decompressed transparently when read with astropy.
+    pool: multiprocessing.pool.Pool, optional
+        Worker pool shared with other pipelines, e.g. by 
+        :class:`excalibuhr.batch.BatchRunner`. The jobs are submitted to 
+        this pool instead of a new pool of `num_processes` workers, and 
+        the pool is not closed by the pipeline.
+    calib_library: str or `CalibLibrary`, optional
+        Calibration library shared with other nights, see 
+        :class:`excalibuhr.library.CalibLibrary`. The :meth:`calibration` 
+        recipe reuses the matching calibrations of nearby nights from the 
+        library, and adds the calibrations it processes to the library.
+    eso_login: str, optional
+        Username of the ESO User Portal Services, used to download missing 
+        raw calibrations from the ESO archive. If None, the reduction 
+        continues without them.
+    archive: `excalibuhr.archive.Archive`, optional
+        Archive to download raw data from instead of the ESO archive, 
+        e.g. a :class:`excalibuhr.archive.LocalArchive` mirror.
     """
 
     def __init__(self, workpath, night, 
                  obs_mode = 'nod',
                  clean_start = False,
-                 num_processes = 4):
+                 num_processes = 4,
+                 incremental = True,
+                 profile = False,
+                 qa_plots = 'full',
+                 qa_background = True,
+                 dtype = 'float64',
+                 async_write = True,
+                 product_dtype = None,
+                 bpm_format = 'uint8',
+                 compression = None,
+                 pool = None,
+                 calib_library = None,
+                 eso_login = None,
+                 archive = None):
 
         self._print_section(
             f"Run pipeline for Night: {night}", bound_char="=")
@@ -67,6 +189,13 @@ class CriresPipeline:
         self.workpath = os.path.abspath(workpath)
         self.night = night
         self.num_processes = num_processes
+        self.pool = pool
+        if isinstance(calib_library, str):
+            calib_library = CalibLibrary(calib_library)
+        self.calib_library = calib_library
+        self.eso_login = eso_login
+        self.archive = archive
+        self._raw_headers = {}
         self.nightpath = os.path.join(self.workpath, self.night)
         self.rawpath = os.path.join(self.workpath, self.night, "raw")
         self.calpath = os.path.join(self.workpath, self.night, "cal")
@@ -76,6 +205,23 @@ class CriresPipeline:
         self.calib_file = os.path.join(self.nightpath, "calib_info.txt") 
         self.header_file = os.path.join(self.nightpath, "header_info.txt")
         self.product_file = os.path.join(self.nightpath, "product_info.txt")
+        self.state_file = os.path.join(self.nightpath, "recipe_state.json")
+        self.profile_path = os.path.join(self.nightpath, "profile")
+        self.incremental = incremental
+        if np.dtype(dtype) not in (np.float32, np.float64):
+            raise ValueError("dtype must be either 'float32' or 'float64'")
+        self.dtype = np.dtype(dtype)
+        if product_dtype is None:
+            product_dtype = dtype
+        if np.dtype(product_dtype) not in (np.float32, np.float64):
+            raise ValueError("product_dtype must be either 'float32' or 'float64'")
+        self.product_dtype = np.dtype(product_dtype)
+        if bpm_format not in BPM_FORMATS:
+            raise ValueError(f"bpm_format must be one of {BPM_FORMATS}")
+        self.bpm_format = bpm_format
+        if compression is not None and compression not in COMPRESSION:
+            raise ValueError(f"compression must be one of {list(COMPRESSION)}")
+        self.compression = compression
         self.gain = [2.15, 2.19, 2.0]
         self.pix_scale = 0.056 #arcsec
         self.trace_offset = 0
@@ -123,6 +269,8 @@ class CriresPipeline:
                 os.remove(self.calib_file)
             if os.path.isfile(self.product_file):
                 os.remove(self.product_file)
+            if os.path.isfile(self.state_file):
+                os.remove(self.state_file)
             if os.path.exists(self.calpath):
                 shutil.rmtree(self.calpath)
             if os.path.exists(self.outpath):
@@ -147,6 +295,15 @@ class CriresPipeline:
         if not os.path.exists(self.combpath):
             os.makedirs(self.combpath)
 
+        # Start a new profile of this session
+        if profile:
+            if os.path.exists(self.profile_path):
+                shutil.rmtree(self.profile_path)
+            profiling.enable(self.profile_path)
+
+        self.qa_plotter = QAPlotter(level=qa_plots, background=qa_background)
+        self.writer = AsyncWriter(background=async_write)
+
         # If present, read the info files
         if os.path.isfile(self.header_file):
             print("Reading header data from header_info.txt")
@@ -175,14 +332,20 @@ class CriresPipeline:
             df_prod.to_csv(self.product_file, index=False, sep=';')
 
 
-    def download_rawdata_eso(self, login, **filters):
+    def download_rawdata_eso(self, login=None, archive=None, **filters):
         """
-        Method for downloading raw data from eso archive using `astroquery`.
+        Method for downloading raw data and their associated raw 
+        calibrations from eso archive. The files are downloaded in 
+        parallel, and interrupted downloads are resumed when the method 
+        is called again, see :func:`excalibuhr.archive.download_files`.
 
         Parameters
         ----------
         login : str
             username to login to the ESO User Portal Services
+        archive: `excalibuhr.archive.Archive`, optional
+            archive to download from instead of the ESO archive, 
+            by default the `archive` of the pipeline if given.
         filters: 
             optional parameters for data filtering, e.g. `prog_id='...'`, `target='...'`
         """
@@ -193,29 +356,18 @@ class CriresPipeline:
         for key in filters.keys():
             print(key + ': '+ filters[key])
 
-        eso = Eso()
-        eso.login(login)
-        table = eso.query_instrument(
-            'crires', column_filters={'night': self.night, **filters}
-            ) 
-        data_files = eso.retrieve_data(
-            table['DP.ID'], destination=self.rawpath, 
-            continuation=False, with_calib='raw', 
-            request_all_objects=True, unzip=False)
-        os.chdir(self.rawpath)
-        for filename in glob.glob("*.xml"):
-            os.remove(filename)
-        for filename in glob.glob("*.txt"):
-            os.remove(filename)
+        archive = archive or self._get_archive(login) or EsoArchive()
+        datasets = archive.query({'night': self.night, **filters})
         try:
-            os.system("uncompress *.Z")
-        except:
-            raise OSError("uncompress not found. Please install gzip \
-                or ncompress, finish uncompress manually, and proceed \
-                to next steps.")
-        os.chdir(self.workpath)
+            datasets += archive.associated(datasets, mode='raw')
+        except Exception as err:
+            warnings.warn(f"Failed to retrieve the associated calibrations: {err}")
+        data_files = download_files(archive, datasets, self.rawpath)
+        print(f"{len(data_files)} of {len(datasets)} files downloaded")
+        self._decompress_raw(data_files)
 
 
+    @recipe(inputs=['raw'], outputs=['header'])
     def extract_header(self):
         """
         Method for extracting header information of raw data to a 
@@ -225,10 +377,26 @@ class CriresPipeline:
         self._print_section("Extracting Observation details")
 
         print("Extracting header details to `header_info.txt`")
-        keywords = self.header_keys.values() 
+
+        # Decompress the raw files copied to the folder as .Z or .gz
+        self._decompress_raw([str(f) for ext in COMPRESSED_EXTENSIONS 
+                              for f in Path(self.rawpath).glob(f"*.fits{ext}")])
         
         raw_files = sorted(Path(self.rawpath).glob("*.fits"))
 
+        # Save the header info as a csv-file
+        self.header_info = self._read_raw_headers(raw_files)
+        self.header_info.to_csv(self.header_file, index=False, sep=';')
+
+
+    def _read_raw_headers(self, raw_files):
+        """
+        Internal method for collecting the header keywords of raw files 
+        in a ``pandas.DataFrame``, renaming the files by their `ORIGFILE`.
+        """
+
+        keywords = self.header_keys.values() 
+
         # Dictionary to store the header info
         header_dict = {}
         for key_item in keywords:
@@ -236,7 +404,10 @@ class CriresPipeline:
 
         for file_item in raw_files:
 
-            header = fits.getheader(file_item)
+            # Headers scanned during the decompression are not read again
+            header = self._raw_headers.pop(os.path.abspath(file_item), None)
+            if header is None:
+                header = fits.getheader(file_item)
 
             # Rename files for better readability
             if self.key_filename in header:
@@ -250,12 +421,32 @@ class CriresPipeline:
                 else:
                     header_dict[key_item].append(None)
 
-        # Save the dictionary as a csv-file
-        self.header_info = pd.DataFrame(data=header_dict)
+        return pd.DataFrame(data=header_dict)
+
+
+    def _add_raw_files(self, files):
+        """
+        Internal method for adding the headers of new raw files, e.g. 
+        downloaded from the archive, to the header info. The rows are 
+        appended, so that the selections of the existing rows still apply.
+
+        Returns
+        -------
+        n_added: int
+            number of raw files added
+        """
+
+        names = set(self.header_info[self.key_filename])
+        new_files = [f for f in files if os.path.basename(f) not in names]
+        new_info = self._read_raw_headers(new_files)
+        new_info = new_info[~new_info[self.key_filename].isin(names)]
+        self.header_info = pd.concat([self.header_info, new_info], 
+                                     ignore_index=True)
         self.header_info.to_csv(self.header_file, index=False, sep=';')
+        return len(new_info)
 
 
-    def _add_to_calib(self, file, cal_type):
+    def _add_to_calib(self, file, cal_type, header=None):
         """
         Internal method for adding details of processed calibration files
         to the DataFrame and text file.
@@ -266,9 +457,12 @@ class CriresPipeline:
             filename to be added to the table
         cal_type: str 
             type of the calibration file, e.g. `DARK_MASTER`, `FLAT_MASTER`
+        header: FITS `header`, optional
+            primary header of the file. Read from the file if None.
         """
         print(f"{cal_type}: cal/{file}")
-        header = fits.getheader(os.path.join(self.calpath, file))
+        if header is None:
+            header = fits.getheader(os.path.join(self.calpath, file))
 
         calib_dict = {}
         keywords = self.header_keys.values()
@@ -281,13 +475,16 @@ class CriresPipeline:
         if self.calib_info is None:
             self.calib_info = calib_append
         else:
-            self.calib_info = pd.concat([self.calib_info, calib_append], 
+            # replace the registration of a previous run
+            indices = (self.calib_info[self.key_filename] == file) & \
+                      (self.calib_info[self.key_caltype] == cal_type)
+            self.calib_info = pd.concat([self.calib_info[~indices], calib_append], 
                                     ignore_index=True)
         
         self.calib_info.to_csv(self.calib_file, index=False, sep=';')
 
 
-    def _add_to_product(self, file, prod_type, snr=None):
+    def _add_to_product(self, file, prod_type, snr=None, header=None):
         """
         Internal method for adding details of data products
         to the DataFrame and text file.
@@ -298,6 +495,8 @@ class CriresPipeline:
             filename to be added to the table
         cal_type: str 
             type of the data product, e.g. `NOD_FRAME`, `Extr1D_PRIMARY`
+        header: FITS `header`, optional
+            primary header of the file. Read from the file if None.
 
         Returns
         -------
@@ -306,7 +505,9 @@ class CriresPipeline:
         """
 
         print(f"Output file -> {prod_type}: out/{file}")
-        if file[-4:] == 'fits':
+        if header is not None:
+            pass
+        elif file[-4:] == 'fits':
             header = fits.getheader(os.path.join(self.outpath, file))
         else:
             header = {}
@@ -322,6 +523,161 @@ class CriresPipeline:
         calib_append.to_csv(self.product_file, index=False, mode='a', header=False, sep=';')
         
 
+    def _recipe_files(self, spec):
+        """
+        Internal method for resolving the input or output specification 
+        of a recipe (see :func:`recipe`) to a sorted list of files.
+        """
+
+        kind, _, cal_type = spec.format(obs_mode=self.obs_mode).partition(':')
+
+        if kind == 'header':
+            files = [self.header_file] if os.path.isfile(self.header_file) else []
+        elif kind == 'raw' and not cal_type:
+            files = [str(f) for ext in ('',) + COMPRESSED_EXTENSIONS 
+                     for f in Path(self.rawpath).glob(f"*.fits{ext}")]
+        elif kind == 'raw':
+            if self.header_info is None:
+                return []
+            indices = (self.header_info[self.key_dtype] == cal_type) | \
+                      (self.header_info[self.key_catg] == cal_type)
+            files = [os.path.join(self.rawpath, f) for f in 
+                     self.header_info[indices][self.key_filename]]
+        elif kind == 'calib':
+            if self.calib_info is None:
+                return []
+            indices = self.calib_info[self.key_caltype] == cal_type
+            files = [os.path.join(self.calpath, f) for f in 
+                     self.calib_info[indices][self.key_filename]]
+        elif kind == 'product':
+            product_info = pd.read_csv(self.product_file, sep=';')
+            indices = product_info[self.key_caltype] == cal_type
+            files = [os.path.join(self.outpath, f) for f in 
+                     product_info[indices][self.key_filename]]
+        else:
+            raise ValueError(f"Unknown recipe input/output: {spec}")
+
+        return sorted(set(files))
+
+
+    def _load_state(self):
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        return {'recipes': {}, 'hashes': {}}
+
+
+    def _save_state(self, state):
+        with su.atomic_write(self.state_file) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f, indent=1)
+
+
+    def _hash_files(self, files, state):
+        """
+        Internal method for computing the content hash of each file in a list.
+        The hash of each file is memoized by its size and modification time.
+        """
+
+        hashes = {}
+        for file in files:
+            if not os.path.isfile(file):
+                hashes[file] = None
+                continue
+            stat = os.stat(file)
+            memo = state['hashes'].get(file)
+            if memo is None or memo[:2] != [stat.st_size, stat.st_mtime_ns]:
+                sha_file = hashlib.sha256()
+                with open(file, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha_file.update(chunk)
+                memo = [stat.st_size, stat.st_mtime_ns, sha_file.hexdigest()]
+                state['hashes'][file] = memo
+            hashes[file] = memo[2]
+        return hashes
+
+
+    def _recipe_up_to_date(self, name, input_files, params):
+        """
+        Internal method for checking whether the recorded run of a recipe 
+        is still valid, i.e. its inputs and parameters are unchanged and 
+        its outputs exist.
+        """
+
+        state = self._load_state()
+        record = state['recipes'].get(name)
+        if record is None or record['params'] != params:
+            return False
+        if not all(os.path.isfile(f) for f in record['outputs']):
+            return False
+        up_to_date = (record['inputs'] == self._hash_files(input_files, state))
+        self._save_state(state)
+        return up_to_date
+
+
+    def _record_recipe(self, name, input_files, output_files, params, 
+                       update_files=()):
+        """
+        Internal method for recording the inputs, parameters, and outputs
+        of a finished recipe.
+        """
+
+        state = self._load_state()
+
+        # files modified in place are taken as up to date for other recipes
+        new_hashes = self._hash_files(update_files, state)
+        for record in state['recipes'].values():
+            for file, sha in new_hashes.items():
+                if file in record['inputs']:
+                    record['inputs'][file] = sha
+
+        state['recipes'][name] = {
+            'inputs': self._hash_files(input_files, state),
+            'params': params,
+            'outputs': output_files,
+            }
+        self._save_state(state)
+
+
+    def _remove_registration(self, outputs):
+        """
+        Internal method for removing the calibration files and data products
+        of the given types from the info tables before re-running a recipe.
+        """
+
+        for spec in outputs:
+            kind, _, cal_type = spec.format(obs_mode=self.obs_mode).partition(':')
+            if kind == 'calib' and self.calib_info is not None:
+                indices = self.calib_info[self.key_caltype] == cal_type
+                self.calib_info = self.calib_info[~indices]
+                self.calib_info.to_csv(self.calib_file, index=False, sep=';')
+            elif kind == 'product':
+                product_info = pd.read_csv(self.product_file, sep=';')
+                indices = product_info[self.key_caltype] == cal_type
+                product_info[~indices].to_csv(self.product_file, index=False, sep=';')
+
+
+    def save_profile(self):
+        """
+        Method for saving the recorded timing and memory usage to 
+        `profile.json`, including a summary per step, and to 
+        `profile_trace.json` in the Chrome trace format, 
+        which can be viewed in `chrome://tracing` or https://ui.perfetto.dev.
+        """
+
+        if not os.path.exists(self.profile_path):
+            warnings.warn("No profile recorded. Set `profile=True` to enable it.")
+            return
+
+        # include the rendering of the queued plots
+        self.flush_plots()
+        profiling.export_json(os.path.join(self.nightpath, "profile.json"), 
+                              self.profile_path)
+        profiling.export_chrome_trace(
+            os.path.join(self.nightpath, "profile_trace.json"), self.profile_path)
+        print(f"Profile saved to {self.nightpath}/profile.json")
+
+
     def _print_section(self, sect_title, bound_char = "-", 
                         extra_line = True):
         """
@@ -348,8 +704,11 @@ class CriresPipeline:
 
     def _download_archive(self, dpr_type, det_dit=None):
         """
-        Internal method for downloading data from the ESO Science
-        Archive.
+        Internal method for resolving missing calibrations. The processed 
+        calibrations are first reused from the calibration library. 
+        Otherwise, if `eso_login` is given, the raw calibrations are 
+        downloaded from the ESO Science Archive, and their headers are 
+        added to `header_info`, so that the calibration can continue. 
         From pycrires (see https://pycrires.readthedocs.io)
 
 
@@ -360,29 +719,31 @@ class CriresPipeline:
         det_dit : float, None
             The detector integration time (DIT) in case
             ``dpr_type="DARK"``. Can be set to ``None`` otherwise.
-        """
 
-        from astropy import units as u
-        from astropy import time as t
-        while True:
-            if det_dit is None:
-                download = input(
-                    f"Could not find data with DPR.TYPE={dpr_type}. "
-                    f"Try to download from the ESO Science Archive "
-                    f"Facility (y/n)? "
-                )
+        Returns
+        -------
+        status: str or None
+            `reused` if the processed calibrations are reused from the 
+            library, `downloaded` if the raw calibrations are downloaded, 
+            in which case the calibration tasks need to be set up again, 
+            or None if the calibrations are not available.
+        """
 
-            else:
-                download = input(
-                    f"There is not {dpr_type} data with DIT = "
-                    f"{det_dit} s. Try to download from the "
-                    f"ESO Science Archive Facility (y/n)? "
-                )
+        if dpr_type == "DARK" and det_dit is not None:
+            if self._fetch_calib('DARK', det_dit):
+                return 'reused'
+        elif dpr_type in ["FLAT", "WAVE,FPET", "WAVE,UNE"]:
+            indices = self.header_info[self.key_catg] == "SCIENCE"
+            unique_wlen = sorted(set(self.header_info[indices][self.key_wlen]))
+            if unique_wlen and all(self._fetch_calib('WLEN', item_wlen) 
+                                   for item_wlen in unique_wlen):
+                return 'reused'
 
-            if download in ["y", "n", "Y", "N"]:
-                break
+        archive = self._get_archive()
+        if archive is not None:
+            from astropy import units as u
+            from astropy import time as t
 
-        if download in ["y", "Y"]:
             indices = self.header_info[self.key_catg] == "SCIENCE"
 
             # Wavelength setting
@@ -391,22 +752,14 @@ class CriresPipeline:
             # Observing date
             date_obs = self.header_info[indices][self.key_obsdate].iloc[0]
 
-            # Sequence of five days before and after the observation
+            # Sequence of ten days before and after the observation
             time_steps = [0.0, -1.0, 1.0, -2.0, 2, -3.0, 3.0, -4.0, 4.0, 
                           -5.0, 5.0, -6.0, 6.0, -7.0, 7.0, -8.0, 8.0,
                           -9.0, 9.0, -10.0, 10.0]
             obs_time = t.Time(date_obs) + np.array(time_steps) * u.day
 
-            # Login at ESO archive
-            user_name = input(
-                "What is your username to login to the ESO User Portal Services? "
-            )
-            eso = Eso()
-            eso.login(user_name)
-
-            # Query the ESO archive until the data is found
-            data_found = False
-
+            # Query all the days concurrently
+            filters = []
             for obs_item in obs_time:
                 column_filters = {
                     "night": obs_item.value[:10],
@@ -416,29 +769,18 @@ class CriresPipeline:
 
                 if det_dit is not None:
                     column_filters["det_dit"] = det_dit
+                filters.append(column_filters)
+            results = query_concurrent(archive, filters)
+
+            # Download the data of the closest day
+            data_found = False
+
+            for datasets in results:
+                if len(datasets) > 0:
+
+                    data_files = download_files(archive, datasets, self.rawpath)
+                    data_files = self._decompress_raw(data_files)
 
-                table = eso.query_instrument("crires", column_filters=column_filters)
-
-                if table is not None:
-
-                    data_files = eso.retrieve_data(
-                        table["DP.ID"],
-                        destination=self.rawpath,
-                        continuation=False,
-                        with_calib="none",
-                        request_all_objects=False,
-                        unzip=False,
-                    )
-
-                    os.chdir(self.rawpath)
-                    try:
-                        os.system("uncompress *.Z")
-                    except:
-                        raise OSError("uncompress not found. Please install gzip \
-                            or ncompress, finish uncompress manually, and proceed \
-                            to next steps.")
-                    os.chdir(self.workpath)
-                    
                     print("\nThe following files have been downloaded:")
                     for data_item in data_files:
                         print(f"   - {data_item}")
@@ -447,12 +789,12 @@ class CriresPipeline:
                     break
 
             if data_found:
-                print(
-                    "\nThe requested data has been successfully downloaded. "
-                    "Please rerun the pipeline with `clean_start=True` to ensure "
-                    "the new calibration data is included."
-                )
-                sys.exit(0)
+                if self._add_raw_files(data_files) > 0:
+                    print("\nThe requested data has been added to the raw frames.")
+                    return 'downloaded'
+                warnings.warn(f"The downloaded DPR.TYPE={dpr_type} data are "
+                              "already in the raw folder. "
+                              f"Continuing without the {dpr_type} data now.")
 
             else:
                 raise Exception(
@@ -462,39 +804,185 @@ class CriresPipeline:
                 )
 
         else:
+            dit = "" if det_dit is None else f" with DIT = {det_dit} s"
             warnings.warn(
                 f"For best results, please download the suggested "
-                f"DPR.TYPE={dpr_type} data from the ESO archive at "
-                f"http://archive.eso.org/wdb/wdb/eso/crires/form. "
+                f"DPR.TYPE={dpr_type} data{dit} from the ESO archive at "
+                f"http://archive.eso.org/wdb/wdb/eso/crires/form, "
+                f"or set `eso_login` or `archive` to download them automatically. "
                 f"Continuing without the {dpr_type} data now."
             )
+        return None
+
+
+    def _get_archive(self, login=None):
+        """
+        Internal method for getting the archive to download from: the 
+        `archive` of the pipeline, or the ESO archive if a login is given.
+        """
+        if self.archive is not None:
+            return self.archive
+        login = login or self.eso_login
+        if login is not None:
+            return EsoArchive(login)
+        return None
+
+
+    def _decompress_raw(self, files):
+        """
+        Internal method for decompressing the `.Z` and `.gz` raw files 
+        in parallel threads. The primary headers are kept as they are 
+        decompressed, so that `extract_header` does not read them again.
 
+        Returns
+        -------
+        files: list
+            paths to the raw files, decompressed
+        """
+        compressed = [f for f in files if f.endswith(COMPRESSED_EXTENSIONS)]
+        if len(compressed) > 0:
+            print(f"Decompressing {len(compressed)} files")
+
+        def keep_header(file, header):
+            self._raw_headers[os.path.abspath(file)] = header
 
+        outputs = decompress_files(compressed, max_workers=self.num_processes,
+                                   on_header=keep_header)
+        return [f for f in files if f not in compressed] + outputs
 
-    def _set_plot_style(self):
-        plt.rcParams.update({
-            'font.size': 12,
-            "xtick.labelsize": 12,   
-            "ytick.labelsize": 12,   
-            "xtick.direction": 'in', 
-            "ytick.direction": 'in', 
-            'ytick.right': True,
-            'xtick.top': True,
-            "xtick.minor.visible": True,
-            "ytick.minor.visible": True,
-            # "xtick.major.size": 5,
-            # "xtick.minor.size": 2.5,
-            # "xtick.major.pad": 7,
-            "lines.linewidth": 0.5,   
-            'image.origin': 'lower',
-            'image.cmap': 'cividis',
-            "savefig.dpi": 300,   
-            })
+
+    def _night_setting(self):
+        """
+        Internal method for getting the mean MJD and the slit of the 
+        science frames of the night, or of all frames if there is no 
+        science frame.
+        """
+        indices = self.header_info[self.key_catg] == "SCIENCE"
+        frames = self.header_info[indices] if np.any(indices) \
+                    else self.header_info
+        return np.nanmean(frames[self.key_mjd]), frames[self.key_slitwid].iloc[0]
 
 
-    def _plot_det_image(self, savename, title, data, tw = None, slit = None, x_fpet= None):
+    def _fetch_calib(self, group, setting):
         """
-        Internal method for plotting detector images.
+        Internal method for reusing a group of calibrations from the 
+        calibration library, see :class:`excalibuhr.library.CalibLibrary`.
+        The files are linked to the `cal` folder and registered.
+
+        Parameters
+        ----------
+        group: str
+            `DARK` or `WLEN`
+        setting: float or str
+            DIT or wavelength setting of the group
+
+        Returns
+        -------
+        reused: bool
+            True if a valid group is found in the library
+        """
+        if self.calib_library is None:
+            return False
+        mjd, slit = self._night_setting()
+        match = self.calib_library.lookup(group, setting, mjd, slit=slit, 
+                                          exclude_night=self.night)
+        if match is None:
+            return False
+
+        print(f"Reuse the {group} calibrations of {setting} "
+              f"from night {match[0][2]}")
+        for cal_type, file, _ in match:
+            name = os.path.basename(file)
+            dest = os.path.join(self.calpath, name)
+            if os.path.lexists(dest):
+                os.remove(dest)
+            try:
+                os.link(file, dest)
+            except OSError:
+                shutil.copy2(file, dest)
+            self._add_to_calib(name, cal_type)
+        return True
+
+
+    def _reuse_calib(self):
+        """
+        Internal method for reusing the calibrations of the night from the 
+        calibration library, either all matching calibrations or those 
+        whose raw frames are missing, depending on the reuse rule of the 
+        library.
+
+        Returns
+        -------
+        reused: dict
+            DITs of the reused `DARK` groups and wavelength settings of 
+            the reused `WLEN` groups
+        """
+        reused = {'DARK': set(), 'WLEN': set()}
+        if self.calib_library is None:
+            return reused
+        always = self.calib_library.reuse == 'always'
+        info = self.header_info
+
+        # Wavelength settings of the science and raw calibration frames
+        indices_sci = info[self.key_catg] == "SCIENCE"
+        cal_types = ["FLAT", "WAVE,FPET", "WAVE,UNE"]
+        indices_cal = info[self.key_dtype].isin(cal_types)
+        for item_wlen in sorted(set(info[indices_sci | indices_cal][self.key_wlen])):
+            indices_wlen = info[self.key_wlen] == item_wlen
+            complete = all(np.any(indices_wlen & (info[self.key_dtype] == t)) 
+                           for t in cal_types)
+            if (always or not complete) and self._fetch_calib('WLEN', item_wlen):
+                reused['WLEN'].add(item_wlen)
+
+        # DITs of the raw darks and science frames, and of the flats and 
+        # FPET to be processed
+        unique_dit = set(info[info[self.key_dtype] == "DARK"][self.key_DIT])
+        unique_dit |= set(info[indices_sci][self.key_DIT])
+        for item_wlen in set(info[indices_cal][self.key_wlen]) - reused['WLEN']:
+            indices_wlen = info[self.key_wlen] == item_wlen
+            indices = indices_wlen & (info[self.key_dtype] == "FLAT")
+            if np.any(indices):
+                unique_dit.add(max(info[indices][self.key_DIT]))
+            indices = indices_wlen & (info[self.key_dtype] == "WAVE,FPET")
+            if np.any(indices):
+                unique_dit.add(info[indices][self.key_DIT].iloc[0])
+
+        for dit in sorted(unique_dit):
+            has_raw = np.any((info[self.key_dtype] == "DARK") & 
+                             (info[self.key_DIT] == dit))
+            if (always or not has_raw) and self._fetch_calib('DARK', dit):
+                reused['DARK'].add(dit)
+        return reused
+
+
+    def _publish_calib(self, tasks):
+        """
+        Internal method for adding the calibrations processed by the 
+        tasks of :meth:`calibration` to the calibration library.
+        """
+        groups = [('DARK', key[1]) for key in tasks if key[0] == 'DARK'] + \
+                 [('WLEN', key[1]) for key in tasks if key[0] == 'NORM']
+        for group, setting in groups:
+            cal_types = CALIB_GROUPS[group][1]
+            indices = self.calib_info[self.key_caltype].isin(cal_types)
+            if group == 'DARK':
+                indices &= (self.calib_info[self.key_DIT] == setting)
+            else:
+                indices &= (self.calib_info[self.key_wlen] == setting)
+            rows = self.calib_info[indices].drop_duplicates(self.key_filename)
+            files = [(cal_type, os.path.join(self.calpath, file)) for cal_type, file 
+                     in zip(rows[self.key_caltype], rows[self.key_filename])]
+            headers = [fits.getheader(file) for _, file in files]
+            self.calib_library.add(self.night, group, setting, files, headers)
+            print(f"Added the {group} calibrations of {setting} to the library")
+
+
+
+    def _plot_det_image(self, savename, title, data, tw = None, slit = None, 
+                        x_fpet= None, level='summary'):
+        """
+        Internal method for requesting the plot of detector images, 
+        see :func:`excalibuhr.qaplot.plot_det_image`.
 
         Parameters
         ----------
@@ -502,183 +990,487 @@ class CriresPipeline:
             The name of the file to save the plot to.
         title : str
             The title of the plot.
-        data : numpy.ndarray
-            The 2d image to plot.
+        data : numpy.ndarray or `qaplot.FileRef`
+            The 2d image to plot, or the reference to the saved image.
         tw : list, optional
             The trace parameters for plotting the order traces.
         slit : list, optional
             The slit parameters for plotting the slit lines.
         x_fpet : list, optional
             The x-positions of the fpet line positions.
+        level : str
+            The QA plot level, `summary` or `full`, of the plot.
         """
-        
-        # check data dimension
-        data = np.array(data)
-        if data.ndim == 3:
-            Ndet = data.shape[0]
-        elif data.ndim == 2:
-            Ndet = 1
-            data = data[np.newaxis,:]
-        else:
-            raise TypeError("Invalid data dimension") 
-
-        xx = np.arange(data.shape[-1])
-
-        self._set_plot_style()
-        fig, axes = plt.subplots(nrows=1, ncols=Ndet, 
-                                figsize=(Ndet*4,4), constrained_layout=True)
-        for i in range(Ndet):
-            ax, im = axes[i], data[i]
-            nans = np.isnan(im)
-            vmin, vmax = np.percentile(im[~nans], (1, 99))
-            ax.imshow(im, vmin=vmin, vmax=vmax)
-            if not tw is None:
-                trace = tw[i]
-                yy_trace = su.trace_polyval(xx, trace)
-                trace_lower, trace_upper = yy_trace
-                for o, (yy_upper, yy_lower) in \
-                        enumerate(zip(trace_upper, trace_lower)):
-                    ax.plot(xx, yy_upper, 'r')
-                    ax.plot(xx, yy_lower, 'r')
-                    ax.text(xx[len(xx)//10], np.mean(yy_upper+yy_lower)/2., 
-                            f'Order {o}', va='center', color='white')
-            if not slit is None:
-                trace = tw[i]
-                slit_meta, x_fpets = slit[i], x_fpet[i]
-                im_subs, yy_indices = su.im_order_cut(im, trace)
-                yy_poly = su.slit_polyval(x_fpets, slit_meta)
-                for (poly, x_peak, yy) in zip(yy_poly, x_fpets, yy_indices):
-                    for x, p in zip(x_peak, poly):
-                        x_model = Poly.polyval(yy, p)
-                        ax.plot(x_model, yy, ':r', zorder=9)
-
-                # for (yy, x_model, x_peak) in zip(yy_indices, xx_shifts, x_fpets):
-                #     for x in x_peak:
-                #         xs = x - x_model
-                #         ax.plot(xs, yy, ':r', zorder=9)
-            ax.set_title(f"Detector {i}", size='large', fontweight='bold')
-
-        plt.suptitle(title)
-        plt.savefig(savename[:-4]+'png')
-        # plt.show()
-        plt.close(fig)
-
-
-    def _plot_spec_by_order(self, savename, flux, wlen=None, transm_spec=None):
-        """
-        Internal method for plotting spectra by order.
+        self.qa_plotter.submit('det_image', level, savename, title, data, 
+                               tw=tw, slit=slit, x_fpet=x_fpet)
+
+
+    def _plot_spec_by_order(self, savename, flux, wlen=None, transm_spec=None, 
+                            level='summary'):
+        """
+        Internal method for requesting the plot of spectra by order, 
+        see :func:`excalibuhr.qaplot.plot_spec_by_order`.
 
         Parameters
         ----------
         savename : str
             The name of the file to save the plot to.
-        flux : list
+        flux : list or `qaplot.FileRef`
             The list of spectra for each order and detector.
         wlen : list, optional
             The list of wavelength arrays for each order and detector.
         transm_spec : numpy.ndarray, optional
             The transmission spectrum with wavelength in the first column and flux in the second column.
+        level : str
+            The QA plot level, `summary` or `full`, of the plot.
         """
-        flux = np.array(flux)
-        Ndet, Norder, Nx = flux.shape
-        self._set_plot_style()
-        fig, axes = plt.subplots(nrows=Norder, ncols=Ndet, sharey='row',
-                        figsize=(6*Ndet,1.5*Norder), constrained_layout=True)
-        for i in range(Norder):
-            ymin, ymax = 1e8, 0
-            for d in range(Ndet):
-                ax = axes[Norder-1-i, d]
-                y = flux[d, i]
-                nans = np.isnan(y)
-                vmin, vmax = np.percentile(y[~nans], (1, 99))
-                ymin = min(vmin, ymin)
-                ymax = max(vmax, ymax)
-                if wlen is None:
-                    ax.plot(y, 'k')
-                    ax.set_xlim((0, Nx))
-                else:
-                    xx = np.array(wlen)[d, i]
-                    ax.plot(xx, y, 'k', label='CRIRES obs.')
-                    ax.set_xlim((xx[0], xx[-1]))
-                    if transm_spec is not None:
-                        indices = (transm_spec[:,0]>xx[0]) & \
-                                  (transm_spec[:,0]<xx[-1])
-                        ax.plot(transm_spec[:,0][indices], 
-                                transm_spec[:,1][indices]*vmax, 
-                                color='orange',
-                                label='Telluric template')
-            ax.set_ylim((0.8*ymin, 1.1*ymax))
-        
-        for d in range(Ndet):    
-            axes[0,d].set_title(f"Detector {d}", size='large', 
-                                fontweight='bold')
-        
-        for i in range(Norder):
-            ax = axes[Norder-1-i,-1]
-            ax.annotate(f"Order {i}", xy=(1.1,0.5),
-                    xycoords='axes fraction',
-                    xytext=(0,0), 
-                    textcoords='offset points',
-                    fontweight='bold',
-                    size='large', ha='right', va='center',
-                    rotation=90)
-        if wlen is None:
-            axes[-1,1].set_xlabel('Pixel')
-        else:
-            axes[-1,1].set_xlabel('Wavelength (nm)')
-        axes[-1,0].set_ylabel('Flux')
-        if transm_spec is not None:
-            axes[-1,-1].legend()
-        plt.savefig(savename+'.png')
-        # plt.show()
-        plt.close(fig)
+        self.qa_plotter.submit('spec_by_order', level, savename, flux, 
+                               wlen=wlen, transm_spec=transm_spec)
 
 
-    def _plot_extr2d_model(self, savename):
+    def _plot_extr2d_model(self, savename, level='full'):
         """
-        Internal method for plotting 2d intermediate data.
+        Internal method for requesting the plot of 2d intermediate data
+        saved in `savename.npz`.
 
         Parameters
         ----------
         savename : str
             The name of the file to save the plot to.
+        level : str
+            The QA plot level, `summary` or `full`, of the plot.
+        """
+        self.qa_plotter.submit('extr2d', level, savename)
+
+
+    def flush_plots(self):
+        """
+        Method for waiting until all requested QA plots are rendered.
+        """
+        self.qa_plotter.flush()
+
+
+    def flush_writes(self):
+        """
+        Method for waiting until all queued FITS products are written.
+        """
+        self.writer.flush()
+
+
+    def __getstate__(self):
+        # the shared pool is only used by the main process
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['archive'] = None
+        state['_raw_headers'] = {}
+        return state
+
+
+    @contextlib.contextmanager
+    def _worker_pool(self):
+        """
+        Internal context manager yielding the shared worker pool if given,
+        or else a new pool of `num_processes` workers closed on exit.
+        """
+        if self.pool is not None:
+            yield self.pool
+        else:
+            with Pool(processes=self.num_processes) as pool:
+                yield pool
+
+
+    def _run_job(self, func, *args):
+        """
+        Internal method for running a worker job, and waiting until 
+        its products are written before the worker returns.
+        """
+        result = func(*args)
+        self.writer.flush()
+        return result
+
+
+    def _run_tasks(self, tasks, debug=False, recipe_name=None, params=None):
+        """
+        Internal method for running a graph of independent calibration tasks
+        on `num_processes` workers. A task is submitted once all the tasks 
+        it depends on are finished, and the calibration files and headers
+        returned by each task are registered in the main process.
+
+        Parameters
+        ----------
+        tasks: dict
+            tasks keyed by name, each given by a tuple of the method, its 
+            arguments, and the names of the tasks it depends on. Dependencies 
+            not present in the graph are ignored.
+        debug: bool
+            run the tasks sequentially in the main process, e.g. for 
+            interactive debug plots.
+        recipe_name: str, optional
+            record the inputs and outputs of each task in the recipe state 
+            under this name, so that in incremental mode the tasks whose 
+            inputs and `params` are unchanged are skipped, along with the 
+            tasks depending only on skipped tasks.
+        params: dict, optional
+            parameters of the recipe shared by the tasks
+
+        Returns
+        -------
+        executed: set
+            names of the tasks that were run
+        """
+
+        pending = {key: (func, args, [d for d in deps if d in tasks]) 
+                   for key, (func, args, deps) in tasks.items()}
+        if recipe_name is not None:
+            skipped = self._up_to_date_tasks(pending, recipe_name, params)
+            for key in sorted(skipped, key=str):
+                print(f"{recipe_name} {key[0]} {key[1]}: inputs unchanged, skipped")
+                pending.pop(key)
+            done = set(skipped)
+        else:
+            done = set()
+        executed = set(pending)
+
+        def _ready():
+            return [key for key, (_, _, deps) in pending.items() 
+                    if set(deps) <= done]
+
+        def _finish(key, result):
+            for file, cal_type, header in result:
+                self._add_to_calib(file, cal_type, header)
+            if recipe_name is not None:
+                self._record_task(recipe_name, key, tasks[key][2], 
+                                  [file for file, _, _ in result], params)
+            done.add(key)
+
+        if debug or self.num_processes == 1:
+            while pending:
+                for key in _ready():
+                    func, args, _ = pending.pop(key)
+                    _finish(key, self._run_job(func, *args))
+            return executed
+
+        finished = queue.Queue()
+        n_running = 0
+        with self._worker_pool() as pool:
+            while pending or n_running > 0:
+                for key in _ready():
+                    func, args, _ = pending.pop(key)
+                    pool.apply_async(self._run_job, args=(func, *args),
+                        callback=lambda res, key=key: finished.put((key, res)),
+                        error_callback=lambda err, key=key: finished.put((key, err)))
+                    n_running += 1
+                
+                key, result = finished.get()
+                n_running -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                _finish(key, result)
+        return executed
+
+
+    def _task_inputs(self, key, deps, state, recipe_name):
+        """
+        Internal method for collecting the input files of a calibration 
+        task: its raw frames, and the calibration files of the tasks it 
+        depends on.
+        """
+
+        kind, setting = key
+        raw_types = {'DARK': ['DARK'], 'FLAT_RAW': ['FLAT'], 
+                     'SLIT': ['WAVE,FPET', 'WAVE,UNE']}.get(kind, [])
+        column = self.key_DIT if kind == 'DARK' else self.key_wlen
+        indices = self.header_info[self.key_dtype].isin(raw_types) & \
+                  (self.header_info[column] == setting)
+        files = [os.path.join(self.rawpath, f) for f in 
+                 self.header_info[indices][self.key_filename]]
+
+        for dep in deps:
+            record = state['recipes'].get(self._task_name(dep, recipe_name))
+            if record is not None:
+                files += record['outputs']
+            elif dep[0] == 'DARK' and self.calib_info is not None:
+                # darks reused from the calibration library
+                indices = self.calib_info[self.key_caltype].isin(
+                              CALIB_GROUPS['DARK'][1]) & \
+                          (self.calib_info[self.key_DIT] == dep[1])
+                files += [os.path.join(self.calpath, f) for f in 
+                          self.calib_info[indices][self.key_filename]]
+        return sorted(set(files))
+
+
+    def _task_name(self, key, recipe_name):
+        """ Internal method for naming the recipe state of a task. """
+        return f"{recipe_name}:{key[0]}:{key[1]}"
+
+
+    def _up_to_date_tasks(self, pending, recipe_name, params):
+        """
+        Internal method for finding the tasks whose recorded run is still 
+        valid, and whose dependencies are all up to date as well.
+        """
+
+        if not self.incremental:
+            return set()
+        state = self._load_state()
+        checked, up_to_date = set(), set()
+        while len(checked) < len(pending):
+            for key, (_, _, deps) in pending.items():
+                if key in checked or not set(deps) <= checked:
+                    continue
+                checked.add(key)
+                if set(deps) <= up_to_date and self._recipe_up_to_date(
+                        self._task_name(key, recipe_name), 
+                        self._task_inputs(key, deps, state, recipe_name), params):
+                    up_to_date.add(key)
+        return up_to_date
+
+
+    def _record_task(self, recipe_name, key, deps, files, params):
+        """
+        Internal method for recording the inputs, parameters, and outputs
+        of a finished calibration task.
+        """
+
+        state = self._load_state()
+        input_files = self._task_inputs(key, deps, state, recipe_name)
+        output_files = [os.path.join(self.calpath, f) for f in files]
+        # the normalization refines the trace in place
+        update_files = []
+        if key[0] == 'NORM':
+            record = state['recipes'].get(self._task_name(('TRACE', key[1]), recipe_name))
+            if record is not None:
+                update_files = record['outputs']
+        self._record_recipe(self._task_name(key, recipe_name), input_files, 
+                            output_files, params, update_files)
+
+
+    def _dark_tasks(self, clip, combine_mode, skip=()):
+        """
+        Internal method for setting up the task of combining 
+        dark frames for each unique DIT, except the DITs in `skip`.
         """
-        self._set_plot_style()
-        data = np.load(savename+'.npz')
-        D = data['data'][0]
-        P = data['data'][2]
-        id_det = data['id_det']
-        id_order = data['id_order']
-        Ndet, Norder = id_det.shape[0]+1, id_order.shape[1]+1
-        fig, axes = plt.subplots(nrows=Norder*2, ncols=Ndet, 
-                        figsize=(2*Norder, 14), sharex=True, sharey=True,  
-                        constrained_layout=True)
-        D_det = np.split(D, id_det)
-        P_det = np.split(P, id_det)
-        for i in range(Ndet):
-            D_order = np.split(D_det[i], id_order[i])
-            P_order = np.split(P_det[i], id_order[i])
-            rows_crop = 0
-            for o in range(0, 2*Norder, 2):
-                ax_d, ax_m = axes[Norder*2-o-2, i], axes[Norder*2-o-1, i] 
-                data, model = D_order[o//2], P_order[o//2]
-                rows_crop = max(data.shape[0], rows_crop)
-                if data.size != 0:
-                    nans = np.isnan(data)
-                    vmin, vmax = np.percentile(data[~nans], (5, 95))
-                    ax_d.imshow(data, vmin=vmin, vmax=vmax, aspect='auto')
-                    ax_m.imshow(model, vmin=0, vmax=np.max(model), aspect='auto')
-                ax_d.set_title(f"Order {o//2}")
-                # ax_d.set_title(r"Order {0}, $\chi_r^2$: {1:.2f}".format(
-                #                         o//2, chi2[i, o//2]))
-            axes[-1,i].set_xlabel(f"Detector {i}", size='large', fontweight='bold')
-        axes[0,0].set_ylim((0, rows_crop))
-        plt.savefig(savename+'.png')
-        # plt.show()
-        plt.close(fig)
+
+        indices = (self.header_info[self.key_dtype] == "DARK")
+
+        # Check unique DIT
+        unique_dit = set()
+        for item in self.header_info[indices][self.key_DIT]:
+            unique_dit.add(item)
+        unique_dit -= set(skip)
+
+        if len(unique_dit) == 0 and len(skip) == 0:
+            warnings.warn("No DARK frames found in the raw folder")
+            if self._download_archive("DARK", 1.427049) == 'downloaded':
+                return self._dark_tasks(clip, combine_mode, skip)
+        elif len(unique_dit) > 0:
+            print(f"DIT values for DARK: {unique_dit}\n")
+
+        return {('DARK', item): (self._process_dark, (item, clip, combine_mode), []) 
+                for item in unique_dit}
+
+
+    def _has_dark(self, dit, tasks=None):
+        """
+        Internal method for checking if a master dark with the DIT 
+        exists or is scheduled.
+        """
+        if tasks is not None and ('DARK', dit) in tasks:
+            return True
+        if self.calib_info is None:
+            return False
+        indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER") \
+                     & (self.calib_info[self.key_DIT] == dit)
+        return np.sum(indices_dark) > 0
+
+
+    def _calib_wlen(self, cal_type, tasks, task_name):
+        """
+        Internal method for collecting the wavelength settings of a 
+        calibration type that exists or is scheduled.
+        """
+        unique_wlen = set()
+        if self.calib_info is not None:
+            indices = self.calib_info[self.key_caltype] == cal_type
+            for item in self.calib_info[indices][self.key_wlen]:
+                unique_wlen.add(item)
+        for key in (tasks or {}):
+            if key[0] == task_name:
+                unique_wlen.add(key[1])
+        return unique_wlen
+
+
+    def _flat_raw_tasks(self, clip, combine_mode, scheduled=None, skip=()):
+        """
+        Internal method for setting up the task of combining 
+        flat frames for each wavelength setting, except those in `skip`.
+        """
+
+        indices = self.header_info[self.key_dtype] == "FLAT"
+
+        # Check unique WLEN setting
+        unique_wlen = set()
+        for item in self.header_info[indices][self.key_wlen]:
+            unique_wlen.add(item)
+        unique_wlen -= set(skip)
+
+        if len(unique_wlen) == 0 and len(skip) == 0:
+            warnings.warn("No FLAT frames found in the raw folder")
+            if self._download_archive("FLAT") == 'downloaded':
+                return self._flat_raw_tasks(clip, combine_mode, scheduled, skip)
+        elif len(unique_wlen) > 0:
+            print(f"Wavelength settings for FLAT: {unique_wlen}\n")
+
+        tasks = {}
+        for item_wlen in unique_wlen:
+            indices_wlen = indices & \
+                        (self.header_info[self.key_wlen] == item_wlen)
+
+            # Use the longest DIT for the master flat
+            dit = max(set(self.header_info[indices_wlen][self.key_DIT]))
+
+            if not self._has_dark(dit, scheduled):
+                warnings.warn("No DARK frame found with DIT value corresponding to that of FLAT")
+                self._download_archive("DARK", dit)
+
+            tasks[('FLAT_RAW', item_wlen)] = (self._process_flat_raw, 
+                    (item_wlen, clip, combine_mode), [('DARK', dit)])
+        return tasks
+
+
+    def _flat_trace_tasks(self, debug, scheduled=None, skip=()):
+        """
+        Internal method for setting up the task of tracing the 
+        spectral orders for each wavelength setting, except those in `skip`.
+        """
+
+        unique_wlen = self._calib_wlen("FLAT_MASTER", scheduled, 'FLAT_RAW')
+        unique_wlen -= set(skip)
+        return {('TRACE', item_wlen): (self._process_flat_trace, 
+                    (item_wlen, debug), [('FLAT_RAW', item_wlen)]) 
+                for item_wlen in unique_wlen}
+
+
+    def _slit_curve_tasks(self, debug, scheduled=None, skip=()):
+        """
+        Internal method for setting up the task of tracing the 
+        slit curvature for each wavelength setting, except those in `skip`.
+        """
+
+        # Select the Fabry-Perot etalon calibrations
+        indices_fpet = self.header_info[self.key_dtype] == "WAVE,FPET"
+        indices_une = self.header_info[self.key_dtype] == "WAVE,UNE"
+
+        # Check unique WLEN setting
+        unique_wlen = set()
+        for item in self.header_info[indices_fpet][self.key_wlen]:
+            unique_wlen.add(item)
+        unique_wlen -= set(skip)
+            
+        if len(unique_wlen) == 0 and len(skip) == 0:
+            warnings.warn("No FPET frames found in the raw folder")
+            if self._download_archive("WAVE,FPET") == 'downloaded':
+                return self._slit_curve_tasks(debug, scheduled, skip)
+
+        unique_wlen_une = set()
+        for item in self.header_info[indices_une][self.key_wlen]:
+            unique_wlen_une.add(item)
+        unique_wlen_une -= set(skip)
+
+        if len(unique_wlen_une) == 0 and len(skip) == 0:
+            warnings.warn("No UNE frames found in the raw folder")
+            if self._download_archive("WAVE,UNE") == 'downloaded':
+                return self._slit_curve_tasks(debug, scheduled, skip)
+        
+        assert unique_wlen == unique_wlen_une
+
+        tasks = {}
+        for item_wlen in unique_wlen:
+            indices = indices_fpet & \
+                    (self.header_info[self.key_wlen] == item_wlen)
+            dit = self.header_info[indices][self.key_DIT].iloc[0]
+
+            if not self._has_dark(dit, scheduled):
+                warnings.warn(f"No MASTER DARK frame found with the DIT value {dit}s corresponding to that of FPET frame")
+                self._download_archive("DARK", dit)
+
+            tasks[('SLIT', item_wlen)] = (self._process_slit_curve, 
+                    (item_wlen, debug), [('DARK', dit), ('TRACE', item_wlen)])
+        return tasks
+
+
+    def _flat_norm_tasks(self, debug, scheduled=None, skip=()):
+        """
+        Internal method for setting up the task of normalizing the 
+        flat for each wavelength setting, except those in `skip`.
+        """
+
+        unique_wlen = self._calib_wlen("FLAT_MASTER", scheduled, 'FLAT_RAW')
+        unique_wlen -= set(skip)
+        return {('NORM', item_wlen): (self._process_flat_norm, 
+                    (item_wlen, debug), [('TRACE', item_wlen), ('SLIT', item_wlen)]) 
+                for item_wlen in unique_wlen}
 
 
     @print_runtime
+    def calibration(self, clip=5, combine_mode='median', debug=False):
+        """
+        Method for running all calibration recipes, i.e. :meth:`cal_dark`, 
+        :meth:`cal_flat_raw`, :meth:`cal_flat_trace`, :meth:`cal_slit_curve`, 
+        and :meth:`cal_flat_norm`. The master darks of each DIT and the 
+        chain of flat, trace, slit curvature, and flat normalization of each 
+        wavelength setting are independent, and are processed concurrently 
+        with `num_processes` workers. In incremental mode, each dark and 
+        each step of a chain is skipped if its raw frames, the calibrations 
+        it uses, and the parameters are unchanged since its last run.
+        With a `calib_library`, the matching calibrations of nearby nights 
+        are reused instead, and the processed calibrations are added to 
+        the library.
+
+        Parameters
+        ----------
+        clip : int
+            sigma clipping threshold for rejecting bad pixels
+        combine_mode: str
+            the way of combining raw dark and flat frames by `mean` or `median`.
+        debug: bool
+            show the debug plots, in which case the tasks run sequentially.
+        """
+
+        self._print_section("Run calibration")
+
+        reused = self._reuse_calib()
+        n_raw = len(self.header_info)
+        tasks = self._calibration_tasks(clip, combine_mode, debug, reused)
+        if len(self.header_info) > n_raw:
+            # include the darks downloaded for the flat and lamp frames
+            tasks = self._calibration_tasks(clip, combine_mode, debug, reused)
+
+        params = {'clip': clip, 'combine_mode': combine_mode, 
+                  'obs_mode': self.obs_mode}
+        params = json.loads(json.dumps(params, default=str))
+        executed = self._run_tasks(tasks, debug, 'calibration', params)
+        if self.calib_library is not None:
+            self._publish_calib(executed)
+
+
+    def _calibration_tasks(self, clip, combine_mode, debug, reused):
+        """
+        Internal method for setting up the graph of calibration tasks, 
+        except the calibrations `reused` from the library.
+        """
+
+        tasks = self._dark_tasks(clip, combine_mode, reused['DARK'])
+        tasks.update(self._flat_raw_tasks(clip, combine_mode, tasks, reused['WLEN']))
+        tasks.update(self._flat_trace_tasks(debug, tasks, reused['WLEN']))
+        tasks.update(self._slit_curve_tasks(debug, tasks, reused['WLEN']))
+        tasks.update(self._flat_norm_tasks(debug, tasks, reused['WLEN']))
+        return tasks
+
+
+    @print_runtime
+    @recipe(inputs=['header', 'raw:DARK'],
+            outputs=['calib:DARK_MASTER', 'calib:DARK_RON', 'calib:DARK_BPM'])
     def cal_dark(self, clip=5, combine_mode='median'):
         """
         Method for combining dark frames per DIT while producing readout noise and bad pixel map. 
@@ -697,64 +1489,65 @@ class CriresPipeline:
 
         self._print_section("Create DARK_MASTER")
         
-        indices = (self.header_info[self.key_dtype] == "DARK")
+        self._run_tasks(self._dark_tasks(clip, combine_mode))
 
-        # Check unique DIT
-        unique_dit = set()
-        for item in self.header_info[indices][self.key_DIT]:
-            unique_dit.add(item)
 
-        if len(unique_dit) == 0:
-            warnings.warn("No DARK frames found in the raw folder")
-            self._download_archive("DARK", 1.427049)
-        else:
-            print(f"DIT values for DARK: {unique_dit}\n")
+    @profiling.timed(cat='job')
+    def _process_dark(self, item, clip, combine_mode):
+        """
+        Internal method for creating the master dark of one DIT.
 
-        # Create a master dark for each unique DIT
-        for item in unique_dit:
-            
-            indices_dit = indices & (self.header_info[self.key_DIT] == item)
-            
-            # Store each dark-observation in a list
-            dt = []
-            for file in self.header_info[indices_dit][self.key_filename]:
-                with fits.open(os.path.join(self.rawpath, file)) as hdu:
-                    hdr = hdu[0].header
-                    dt.append(np.array([hdu[i].data for i in range(1, len(hdu))]))
-            
-            # Per detector, median-combine the darks
-            # determine the bad pixels and readout noise
-            master, rons, badpix = su.util_master_dark(dt, badpix_clip=clip,
-                                    combine_mode=combine_mode)
-            
-            print("\n Output files:")
-            # Save the master dark, read-out noise, and bad-pixel maps
-            file_name = os.path.join(self.calpath, 
-                            f'DARK_MASTER_DIT{item}.fits')
-            wfits(file_name, ext_list={"FLUX": master}, header=hdr)
-            self._add_to_calib(f'DARK_MASTER_DIT{item}.fits', 
-                            "DARK_MASTER")
-            self._plot_det_image(file_name, f"DARK_MASTER, DIT={item:.1f}",
-                                 master)
-            
-            file_name = os.path.join(self.calpath, 
-                            f'DARK_RON_DIT{item}.fits')
-            wfits(file_name, ext_list={"FLUX": rons}, header=hdr)
-            self._add_to_calib(f'DARK_RON_DIT{item}.fits', 
-                            "DARK_RON")
-
-            file_name = os.path.join(self.calpath, 
-                            f'DARK_BPM_DIT{item}.fits')
-            wfits(file_name, ext_list={"FLUX": badpix.astype(int)}, header=hdr)
-            self._add_to_calib(f'DARK_BPM_DIT{item}.fits', 
-                            "DARK_BPM")
-
-            print(f"DIT {item:.1f} s -> "
-                  f"{np.sum(badpix)/badpix.size*100.:.1f}"
-                  r"% of pixels identified as bad")
+        Returns
+        -------
+        registrations: list
+            filenames and types of the calibration files 
+        """
+
+        indices_dit = (self.header_info[self.key_dtype] == "DARK") & \
+                      (self.header_info[self.key_DIT] == item)
+        
+        # Store each dark-observation in a list
+        dt = []
+        for file in self.header_info[indices_dit][self.key_filename]:
+            with fits.open(os.path.join(self.rawpath, file)) as hdu:
+                hdr = hdu[0].header
+                dt.append(np.array([hdu[i].data for i in range(1, len(hdu))], 
+                                   dtype=self.dtype))
+        
+        # Per detector, median-combine the darks
+        # determine the bad pixels and readout noise
+        master, rons, badpix = su.util_master_dark(dt, badpix_clip=clip,
+                                combine_mode=combine_mode)
+        
+        # Save the master dark, read-out noise, and bad-pixel maps
+        file_name = os.path.join(self.calpath, 
+                        f'DARK_MASTER_DIT{item}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": self._as_image(master)}, 
+                    header=hdr, callback=functools.partial(
+                        self._plot_det_image, file_name, 
+                        f"DARK_MASTER, DIT={item:.1f}", FileRef(file_name)))
+        
+        file_name = os.path.join(self.calpath, 
+                        f'DARK_RON_DIT{item}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": self._as_image(rons)}, header=hdr)
+
+        file_name = os.path.join(self.calpath, 
+                        f'DARK_BPM_DIT{item}.fits')
+        self.writer.write(file_name, 
+                    ext_list={"FLUX": encode_bpm(badpix, self.bpm_format)}, header=hdr)
+
+        print(f"DIT {item:.1f} s -> "
+              f"{np.sum(badpix)/badpix.size*100.:.1f}"
+              r"% of pixels identified as bad")
+
+        return [(f'DARK_MASTER_DIT{item}.fits', "DARK_MASTER", hdr), 
+                (f'DARK_RON_DIT{item}.fits', "DARK_RON", hdr), 
+                (f'DARK_BPM_DIT{item}.fits', "DARK_BPM", hdr)]
 
     
     @print_runtime
+    @recipe(inputs=['header', 'raw:FLAT', 'calib:DARK_MASTER', 'calib:DARK_BPM'],
+            outputs=['calib:FLAT_MASTER', 'calib:FLAT_BPM'])
     def cal_flat_raw(self, clip=5, combine_mode='median'):
         """
         Method for combining raw flat frames per wavelngth setting and producing bad pixel map.
@@ -773,79 +1566,95 @@ class CriresPipeline:
 
         self._print_section("Create FLAT_MASTER")
 
-        indices = self.header_info[self.key_dtype] == "FLAT"
+        self._run_tasks(self._flat_raw_tasks(clip, combine_mode))
 
-        # Check unique WLEN setting
-        unique_wlen = set()
-        for item in self.header_info[indices][self.key_wlen]:
-            unique_wlen.add(item)
 
-        if len(unique_wlen) == 0:
-            warnings.warn("No FLAT frames found in the raw folder")
-            self._download_archive("FLAT")
-        else:
-            print(f"Wavelength settings for FLAT: {unique_wlen}\n")
+    @profiling.timed(cat='job')
+    def _process_flat_raw(self, item_wlen, clip, combine_mode):
+        """
+        Internal method for creating the master flat of one wavelength setting.
 
-        # Create a master flat for each unique WLEN setting
-        for item_wlen in unique_wlen:
+        Returns
+        -------
+        registrations: list
+            filenames and types of the calibration files 
+        """
 
-            indices_wlen = indices & \
-                        (self.header_info[self.key_wlen] == item_wlen)
+        indices_wlen = (self.header_info[self.key_dtype] == "FLAT") & \
+                    (self.header_info[self.key_wlen] == item_wlen)
 
-            # Use the longest DIT for the master flat
-            unique_dit = set()
-            for item in self.header_info[indices_wlen][self.key_DIT]:
-                unique_dit.add(item)
+        # Use the longest DIT for the master flat
+        unique_dit = set()
+        for item in self.header_info[indices_wlen][self.key_DIT]:
+            unique_dit.add(item)
 
-            dit = max(unique_dit)
-            
-            indices_dit = indices_wlen & (self.header_info[self.key_DIT] == dit) 
-
-            # Select master dark and bad-pixel mask corresponding to DIT
-            indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER") \
-                         & (self.calib_info[self.key_DIT] == dit)
-            indices_bpm = (self.calib_info[self.key_caltype] == "DARK_BPM") \
-                        & (self.calib_info[self.key_DIT] == dit)
-            if np.sum(indices_dark) < 1:
-                warnings.warn("No DARK frame found with DIT value corresponding to that of FLAT")
-                self._download_archive("DARK", dit)
-            else:
-                file = self.calib_info[indices_dark][self.key_filename].iloc[0]
-                dark = fits.getdata(os.path.join(self.calpath, file))
-                file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-                badpix = fits.getdata(os.path.join(self.calpath, file))
-
-            # Store each flat-observation in a list
-            dt = []
-            for file in self.header_info[indices_dit][self.key_filename]:
-                with fits.open(os.path.join(self.rawpath, file)) as hdu:
-                    hdr = hdu[0].header
-                    dt.append(np.array([hdu[i].data for i in range(1, len(hdu))]))
-
-            if np.sum(indices_dark) < 1:
-                dark = np.zeros_like(dt[0])
-            # Per detector, median-combine the flats and determine the bad pixels
-            master, badpix = su.util_master_flat(dt, dark, 
-                            badpix_clip=clip, combine_mode=combine_mode)
-            
-            print(f"WLEN setting {item_wlen} -> " 
-                  f"{np.sum(badpix)/badpix.size*100.:.1f}"
-                  r"% of pixels identified as bad")
-
-            print("\n Output files:")
-            # Save the master flat and bad-pixel map
-            file_name = os.path.join(self.calpath, 
-                            f'FLAT_MASTER_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": master}, header=hdr)
-            self._add_to_calib(f'FLAT_MASTER_{item_wlen}.fits', "FLAT_MASTER")
-
-            file_name = os.path.join(self.calpath, 
-                            f'FLAT_BPM_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": badpix.astype(int)}, header=hdr)
-            self._add_to_calib(f'FLAT_BPM_{item_wlen}.fits', 
-                            "FLAT_BPM")
+        dit = max(unique_dit)
+        
+        indices_dit = indices_wlen & (self.header_info[self.key_DIT] == dit) 
+
+        # Select master dark and bad-pixel mask corresponding to DIT
+        indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER") \
+                     & (self.calib_info[self.key_DIT] == dit)
+        indices_bpm = (self.calib_info[self.key_caltype] == "DARK_BPM") \
+                    & (self.calib_info[self.key_DIT] == dit)
+        if np.sum(indices_dark) > 0:
+            file = self.calib_info[indices_dark][self.key_filename].iloc[0]
+            dark = self._read_image(os.path.join(self.calpath, file))
+            file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
+            badpix = read_bpm(os.path.join(self.calpath, file))
+
+        # Store each flat-observation in a list
+        dt = []
+        for file in self.header_info[indices_dit][self.key_filename]:
+            with fits.open(os.path.join(self.rawpath, file)) as hdu:
+                hdr = hdu[0].header
+                dt.append(np.array([hdu[i].data for i in range(1, len(hdu))], 
+                                   dtype=self.dtype))
+
+        if np.sum(indices_dark) < 1:
+            dark = np.zeros_like(dt[0])
+        # Per detector, median-combine the flats and determine the bad pixels
+        master, badpix = su.util_master_flat(dt, dark, 
+                        badpix_clip=clip, combine_mode=combine_mode)
+        
+        print(f"WLEN setting {item_wlen} -> " 
+              f"{np.sum(badpix)/badpix.size*100.:.1f}"
+              r"% of pixels identified as bad")
+
+        # Save the master flat and bad-pixel map
+        file_name = os.path.join(self.calpath, 
+                        f'FLAT_MASTER_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": self._as_image(master)}, header=hdr)
+
+        file_name = os.path.join(self.calpath, 
+                        f'FLAT_BPM_{item_wlen}.fits')
+        self.writer.write(file_name, 
+                    ext_list={"FLUX": encode_bpm(badpix, self.bpm_format)}, header=hdr)
+
+        return [(f'FLAT_MASTER_{item_wlen}.fits', "FLAT_MASTER", hdr), 
+                (f'FLAT_BPM_{item_wlen}.fits', "FLAT_BPM", hdr)]
             
 
+    def _read_image(self, filename, ext=None):
+        """
+        Internal method for reading the images of a calibration or 
+        product file in the working precision `dtype`.
+        """
+        if ext is None:
+            data = fits.getdata(filename)
+        else:
+            data = fits.getdata(filename, ext)
+        return np.asarray(data, dtype=self.dtype)
+
+
+    def _as_image(self, data):
+        """
+        Internal method for converting images and errors to the 
+        precision `product_dtype` before saving them.
+        """
+        return np.asarray(data, dtype=self.product_dtype)
+
+
     def _loop_over_detector(self, util_func, verbose, *dt_list, **kwargs):
         """
         Method for looping over detectors.
@@ -871,7 +1680,9 @@ class CriresPipeline:
         for d in range(len(dt_list[0])):
             if verbose:
                 print(f"Processing Detector {d}")
-            result = util_func(*[dt[d] for dt in dt_list], **kwargs)
+            with profiling.record(f"{util_func.__name__} detector", 
+                                  cat='detector', detector=d):
+                result = util_func(*[dt[d] for dt in dt_list], **kwargs)
             results.append(result)
         
         # swap axes of the resulting list
@@ -885,6 +1696,8 @@ class CriresPipeline:
 
 
     @print_runtime
+    @recipe(inputs=['calib:FLAT_MASTER', 'calib:FLAT_BPM'],
+            outputs=['calib:TRACE_TW'])
     def cal_flat_trace(self, debug=False):
         """
         Method for identifying traces of spectral order in the master FLAT frame.
@@ -896,44 +1709,52 @@ class CriresPipeline:
 
         self._print_section("Trace spectral orders")
 
-        indices = self.calib_info[self.key_caltype] == "FLAT_MASTER"
+        self._run_tasks(self._flat_trace_tasks(debug), debug)
 
-        # Check unique WLEN setting
-        unique_wlen = set()
-        for item in self.calib_info[indices][self.key_wlen]:
-            unique_wlen.add(item)
-        
-        # Identify the trace from the master flat of each WLEN setting
-        for item_wlen in unique_wlen:
-            indices_flat = indices & \
-                        (self.calib_info[self.key_wlen] == item_wlen)
-            indices_bpm = (self.calib_info[self.key_caltype] == "FLAT_BPM") & \
-                        (self.calib_info[self.key_wlen] == item_wlen)
 
-            file = self.calib_info[indices_flat][self.key_filename].iloc[0]
-            flat = fits.getdata(os.path.join(self.calpath, file))
-            hdr = fits.getheader(os.path.join(self.calpath, file))
-            file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-            bpm = fits.getdata(os.path.join(self.calpath, file))
-            
-            # Fit polynomials to the trace edges
-            trace = self._loop_over_detector(
-                            su.order_trace, True, flat, bpm, 
-                            slitlen=hdr[self.key_slitlen]/self.pix_scale,
-                            offset=self.trace_offset,
-                            debug=debug)
+    @profiling.timed(cat='job')
+    def _process_flat_trace(self, item_wlen, debug):
+        """
+        Internal method for tracing the spectral orders of one wavelength setting.
 
-            print("\n Output files:")
-            # Save the polynomial coefficients
-            file_name = os.path.join(self.calpath, f'TW_FLAT_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": trace}, header=hdr)
-            self._add_to_calib(f'TW_FLAT_{item_wlen}.fits', "TRACE_TW")
-            
-            self._plot_det_image(file_name, f"FLAT_MASTER_{item_wlen}", 
-                            flat, tw=trace)
+        Returns
+        -------
+        registrations: list
+            filenames and types of the calibration files 
+        """
+
+        indices_flat = (self.calib_info[self.key_caltype] == "FLAT_MASTER") & \
+                    (self.calib_info[self.key_wlen] == item_wlen)
+        indices_bpm = (self.calib_info[self.key_caltype] == "FLAT_BPM") & \
+                    (self.calib_info[self.key_wlen] == item_wlen)
+
+        file = self.calib_info[indices_flat][self.key_filename].iloc[0]
+        flat = self._read_image(os.path.join(self.calpath, file))
+        hdr = fits.getheader(os.path.join(self.calpath, file))
+        file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
+        bpm = read_bpm(os.path.join(self.calpath, file))
+        
+        # Fit polynomials to the trace edges
+        trace = self._loop_over_detector(
+                        su.order_trace, True, flat, bpm, 
+                        slitlen=hdr[self.key_slitlen]/self.pix_scale,
+                        offset=self.trace_offset,
+                        debug=debug)
+
+        # Save the polynomial coefficients
+        file_name = os.path.join(self.calpath, f'TW_FLAT_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": trace}, header=hdr)
+        
+        self._plot_det_image(file_name, f"FLAT_MASTER_{item_wlen}", 
+                        flat, tw=trace)
+
+        return [(f'TW_FLAT_{item_wlen}.fits', "TRACE_TW", hdr)]
             
 
     @print_runtime
+    @recipe(inputs=['header', 'raw:WAVE,FPET', 'raw:WAVE,UNE', 'calib:DARK_MASTER', 
+                    'calib:DARK_BPM', 'calib:TRACE_TW'],
+            outputs=['calib:SLIT_TILT', 'calib:INIT_WLEN'])
     def cal_slit_curve(self, debug=False):
         """
         Method for tracing slit curvature in the Fabry-Pérot Etalon (FPET) calibration frame.
@@ -947,119 +1768,108 @@ class CriresPipeline:
 
         self._print_section("Trace slit curvature")
 
-        # Select the Fabry-Perot etalon calibrations
-        indices_fpet = self.header_info[self.key_dtype] == "WAVE,FPET"
-        indices_une = self.header_info[self.key_dtype] == "WAVE,UNE"
+        self._run_tasks(self._slit_curve_tasks(debug), debug)
 
-        # Check unique WLEN setting
-        unique_wlen = set()
-        for item in self.header_info[indices_fpet][self.key_wlen]:
-            unique_wlen.add(item)
-            
-        if len(unique_wlen) == 0:
-            warnings.warn("No FPET frames found in the raw folder")
-            self._download_archive("WAVE,FPET")
 
-        unique_wlen_une = set()
-        for item in self.header_info[indices_une][self.key_wlen]:
-            unique_wlen_une.add(item)
+    @profiling.timed(cat='job')
+    def _process_slit_curve(self, item_wlen, debug):
+        """
+        Internal method for tracing the slit curvature of one wavelength setting.
 
-        if len(unique_wlen_une) == 0:
-            warnings.warn("No FPET frames found in the raw folder")
-            self._download_archive("WAVE,UNE")
-        
-        assert unique_wlen == unique_wlen_une
+        Returns
+        -------
+        registrations: list
+            filenames and types of the calibration files 
+        """
 
-        # Identify the slit curvature for each WLEN setting
-        for item_wlen in unique_wlen:
-            indices = indices_une & \
-                    (self.header_info[self.key_wlen] == item_wlen)
-            file_une = self.header_info[indices][self.key_filename].iloc[0]
+        indices = (self.header_info[self.key_dtype] == "WAVE,UNE") & \
+                (self.header_info[self.key_wlen] == item_wlen)
+        file_une = self.header_info[indices][self.key_filename].iloc[0]
 
-            indices = indices_fpet & \
-                    (self.header_info[self.key_wlen] == item_wlen)
-            file_fpet = self.header_info[indices][self.key_filename].iloc[0]
+        indices = (self.header_info[self.key_dtype] == "WAVE,FPET") & \
+                (self.header_info[self.key_wlen] == item_wlen)
+        file_fpet = self.header_info[indices][self.key_filename].iloc[0]
 
-            dit = self.header_info[indices][self.key_DIT].iloc[0]
-            indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER")\
-                         & (self.calib_info[self.key_DIT] == dit)
-            indices_bpm = (self.calib_info[self.key_caltype] == "DARK_BPM") \
-                         & (self.calib_info[self.key_DIT] == dit)
-            indices_tw = (self.calib_info[self.key_caltype] == "TRACE_TW") & \
-                         (self.calib_info[self.key_wlen] == item_wlen)
-
-            if np.sum(indices_dark) < 1:
-                warnings.warn(f"No MASTER DARK frame found with the DIT value {dit}s corresponding to that of FPET frame")
-                self._download_archive("DARK", dit)
-            # if np.sum(indices_tw) < 1:
-            #     raise RuntimeError(f"No order trace (TRACE_TW) found with the WLEN setting {item_wlen} corresponding to that of FPET frame") 
+        dit = self.header_info[indices][self.key_DIT].iloc[0]
+        indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER")\
+                     & (self.calib_info[self.key_DIT] == dit)
+        indices_bpm = (self.calib_info[self.key_caltype] == "DARK_BPM") \
+                     & (self.calib_info[self.key_DIT] == dit)
+        indices_tw = (self.calib_info[self.key_caltype] == "TRACE_TW") & \
+                     (self.calib_info[self.key_wlen] == item_wlen)
 
-            # Read the trace-wave, master dark and bad-pixel mask
-            file = self.calib_info[indices_tw][self.key_filename].iloc[0]
-            tw = fits.getdata(os.path.join(self.calpath, file))
+        # Read the trace-wave, master dark and bad-pixel mask
+        file = self.calib_info[indices_tw][self.key_filename].iloc[0]
+        tw = fits.getdata(os.path.join(self.calpath, file))
 
-            file = self.calib_info[indices_dark][self.key_filename].iloc[0]
-            dark = fits.getdata(os.path.join(self.calpath, file))
+        file = self.calib_info[indices_dark][self.key_filename].iloc[0]
+        dark = self._read_image(os.path.join(self.calpath, file))
 
-            file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-            bpm = fits.getdata(os.path.join(self.calpath, file))
+        file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
+        bpm = read_bpm(os.path.join(self.calpath, file))
 
-            # Dark-subtract the une lamp observation
-            with fits.open(os.path.join(self.rawpath, file_une)) as hdu:
-                hdr = hdu[0].header
-                une = np.array([hdu[i].data for i in range(1, len(hdu))]) - dark
+        # Dark-subtract the une lamp observation
+        with fits.open(os.path.join(self.rawpath, file_une)) as hdu:
+            hdr = hdu[0].header
+            une = np.array([hdu[i].data for i in range(1, len(hdu))], 
+                           dtype=self.dtype) - dark
 
-            # correct vertical strips due to readout artifacts
-            result = self._loop_over_detector(su.readout_artifact, False,
-                                une, une, bpm, tw)
-            une, _ = result 
+        # correct vertical strips due to readout artifacts
+        result = self._loop_over_detector(su.readout_artifact, False,
+                            une, une, bpm, tw)
+        une, _ = result 
 
-            wlen_mins, wlen_maxs = [], []
-            # Dark-subtract the fpet observation
-            with fits.open(os.path.join(self.rawpath, file_fpet)) as hdu:
-                hdr = hdu[0].header
-                fpet = np.array([hdu[i].data for i in range(1, len(hdu))]) - dark
-                
-                # Store the minimum and maximum wavelengths
-                # of each order {j} in each detector {i}.
-                for i in range(1, len(hdu)):
-                    wlen_min, wlen_max = [], []
-                    header = hdu[i].header
-                    for j in range(1,11): # maximum 10 orders possible
-                        # orders that largely fall out of detectors are ignored
-                        if float(header[self.key_wave_cen+str(j)]) > 80 and \
-                           float(header[self.key_wave_cen+str(j)]) < 2000:
-                            wlen_min.append(header[self.key_wave_min+str(j)])
-                            wlen_max.append(header[self.key_wave_max+str(j)])
-
-                    wlen_mins.append(wlen_min)
-                    wlen_maxs.append(wlen_max)
-
-            # Assess the slit curvature and wavelengths along the orders
-            slit = self._loop_over_detector(su.slit_curve, True,
-                            fpet, une, bpm, tw, wlen_mins, wlen_maxs,
-                            wlen_id=item_wlen,
-                            debug=debug)
-            meta, x_fpet, wlen = slit
-
-            print("\n Output files:")
-            # Save the polynomial coefficients describing the slit curvature 
-            # and an initial wavelength solution
-            file_name = os.path.join(self.calpath, 
-                            f'SLIT_TILT_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": meta}, header=hdr)
-            self._add_to_calib(f'SLIT_TILT_{item_wlen}.fits', "SLIT_TILT")
-
-            self._plot_det_image(file_name, f"FPET_{item_wlen}", 
-                            fpet, tw=tw, slit=meta, x_fpet=x_fpet)
-
-            file_name = os.path.join(self.calpath, 
-                            f'INIT_WLEN_{item_wlen}.fits')
-            wfits(file_name, ext_list={"WAVE": wlen}, header=hdr)
-            self._add_to_calib(f'INIT_WLEN_{item_wlen}.fits', "INIT_WLEN")
+        wlen_mins, wlen_maxs = [], []
+        # Dark-subtract the fpet observation
+        with fits.open(os.path.join(self.rawpath, file_fpet)) as hdu:
+            hdr = hdu[0].header
+            fpet = np.array([hdu[i].data for i in range(1, len(hdu))], 
+                            dtype=self.dtype) - dark
+            
+            # Store the minimum and maximum wavelengths
+            # of each order {j} in each detector {i}.
+            for i in range(1, len(hdu)):
+                wlen_min, wlen_max = [], []
+                header = hdu[i].header
+                for j in range(1,11): # maximum 10 orders possible
+                    # orders that largely fall out of detectors are ignored
+                    if float(header[self.key_wave_cen+str(j)]) > 80 and \
+                       float(header[self.key_wave_cen+str(j)]) < 2000:
+                        wlen_min.append(header[self.key_wave_min+str(j)])
+                        wlen_max.append(header[self.key_wave_max+str(j)])
+
+                wlen_mins.append(wlen_min)
+                wlen_maxs.append(wlen_max)
+
+        # Assess the slit curvature and wavelengths along the orders
+        slit = self._loop_over_detector(su.slit_curve, True,
+                        fpet, une, bpm, tw, wlen_mins, wlen_maxs,
+                        wlen_id=item_wlen,
+                        debug=debug)
+        meta, x_fpet, wlen = slit
+
+        # Save the polynomial coefficients describing the slit curvature 
+        # and an initial wavelength solution
+        file_name = os.path.join(self.calpath, 
+                        f'SLIT_TILT_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": meta}, header=hdr)
+
+        self._plot_det_image(file_name, f"FPET_{item_wlen}", 
+                        fpet, tw=tw, slit=meta, x_fpet=x_fpet)
+
+        file_name = os.path.join(self.calpath, 
+                        f'INIT_WLEN_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"WAVE": wlen}, header=hdr)
+
+        return [(f'SLIT_TILT_{item_wlen}.fits', "SLIT_TILT", hdr), 
+                (f'INIT_WLEN_{item_wlen}.fits', "INIT_WLEN", hdr)]
             
 
     @print_runtime
+    @recipe(inputs=['calib:FLAT_MASTER', 'calib:FLAT_BPM', 'calib:TRACE_TW', 
+                    'calib:SLIT_TILT'],
+            outputs=['calib:FLAT_NORM', 'calib:BLAZE'],
+            updates=['calib:TRACE_TW'])
     def cal_flat_norm(self, debug=False):
         """
         Method for creating normalized flat field and 
@@ -1072,65 +1882,72 @@ class CriresPipeline:
 
         self._print_section("Normalize flat; Extract blaze")
 
-        indices = self.calib_info[self.key_caltype] == "FLAT_MASTER"
+        self._run_tasks(self._flat_norm_tasks(debug), debug)
 
-        indices = self.calib_info[self.key_caltype] == "FLAT_MASTER"
 
-        # Check unique WLEN setting
-        unique_wlen = set()
-        for item in self.calib_info[indices][self.key_wlen]:
-            unique_wlen.add(item)
+    @profiling.timed(cat='job')
+    def _process_flat_norm(self, item_wlen, debug):
+        """
+        Internal method for normalizing the master flat of one wavelength setting.
+
+        Returns
+        -------
+        registrations: list
+            filenames and types of the calibration files 
+        """
+
+        indices_flat = (self.calib_info[self.key_caltype] == "FLAT_MASTER") & \
+                    (self.calib_info[self.key_wlen] == item_wlen)
+        indices_bpm = (self.calib_info[self.key_caltype] == "FLAT_BPM") & \
+                    (self.calib_info[self.key_wlen] == item_wlen)
+        indices_tw = (self.calib_info[self.key_caltype] == "TRACE_TW") & \
+                     (self.calib_info[self.key_wlen] == item_wlen)
+        indices_slit = (self.calib_info[self.key_caltype] == "SLIT_TILT") \
+                      & (self.calib_info[self.key_wlen] == item_wlen)
+
+        # Read in the trace-wave, bad-pixel, slit-curvature, and flat files
+        file = self.calib_info[indices_flat][self.key_filename].iloc[0]
+        flat = self._read_image(os.path.join(self.calpath, file))
+        hdr = fits.getheader(os.path.join(self.calpath, file))
         
-        # Identify the trace from the master flat of each WLEN setting
-        for item_wlen in unique_wlen:
-            indices_flat = indices & \
-                        (self.calib_info[self.key_wlen] == item_wlen)
-            indices_bpm = (self.calib_info[self.key_caltype] == "FLAT_BPM") & \
-                        (self.calib_info[self.key_wlen] == item_wlen)
-            indices_tw = (self.calib_info[self.key_caltype] == "TRACE_TW") & \
-                         (self.calib_info[self.key_wlen] == item_wlen)
-            indices_slit = (self.calib_info[self.key_caltype] == "SLIT_TILT") \
-                          & (self.calib_info[self.key_wlen] == item_wlen)
-
-            # Read in the trace-wave, bad-pixel, slit-curvature, and flat files
-            file = self.calib_info[indices_flat][self.key_filename].iloc[0]
-            flat = fits.getdata(os.path.join(self.calpath, file))
-            hdr = fits.getheader(os.path.join(self.calpath, file))
-            
-            file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-            bpm = fits.getdata(os.path.join(self.calpath, file))
-            
-            file = self.calib_info[indices_tw][self.key_filename].iloc[0]
-            tw = fits.getdata(os.path.join(self.calpath, file))
-            
-            file = self.calib_info[indices_slit][self.key_filename].iloc[0]
-            slit = fits.getdata(os.path.join(self.calpath, file))
-            
-            # Normalize the master flat with the order-specific blaze functions
-            result = self._loop_over_detector(su.master_flat_norm, True,
-                            flat, bpm, tw, slit, 
-                            slitlen=hdr[self.key_slitlen]/self.pix_scale,
-                            debug=debug)
-            flat_norm, blazes, trace_update = result
-
-            print("\n Output files:")
-            file_name = os.path.join(self.calpath, 
-                                    f'FLAT_NORM_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": flat_norm}, header=hdr)
-            self._add_to_calib(f'FLAT_NORM_{item_wlen}.fits', "FLAT_NORM")
-            self._plot_det_image(file_name, f"FLAT_NORM_{item_wlen}", 
-                            flat_norm, tw=trace_update)
-
-            file_name = os.path.join(self.calpath, f'BLAZE_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": blazes}, header=hdr)
-            self._add_to_calib(f'BLAZE_{item_wlen}.fits', "BLAZE")
-            self._plot_spec_by_order(file_name[:-5], blazes) 
-
-            file_name = os.path.join(self.calpath, f'TW_FLAT_{item_wlen}.fits')
-            wfits(file_name, ext_list={"FLUX": trace_update}, header=hdr)
+        file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
+        bpm = read_bpm(os.path.join(self.calpath, file))
+        
+        file = self.calib_info[indices_tw][self.key_filename].iloc[0]
+        tw = fits.getdata(os.path.join(self.calpath, file))
+        
+        file = self.calib_info[indices_slit][self.key_filename].iloc[0]
+        slit = fits.getdata(os.path.join(self.calpath, file))
+        
+        # Normalize the master flat with the order-specific blaze functions
+        result = self._loop_over_detector(su.master_flat_norm, True,
+                        flat, bpm, tw, slit, 
+                        slitlen=hdr[self.key_slitlen]/self.pix_scale,
+                        debug=debug)
+        flat_norm, blazes, trace_update = result
+
+        file_name = os.path.join(self.calpath, 
+                                f'FLAT_NORM_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": self._as_image(flat_norm)}, 
+                    header=hdr, callback=functools.partial(
+                        self._plot_det_image, file_name, f"FLAT_NORM_{item_wlen}", 
+                        FileRef(file_name), tw=trace_update))
+
+        file_name = os.path.join(self.calpath, f'BLAZE_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": blazes}, header=hdr)
+        self._plot_spec_by_order(file_name[:-5], blazes) 
+
+        file_name = os.path.join(self.calpath, f'TW_FLAT_{item_wlen}.fits')
+        self.writer.write(file_name, ext_list={"FLUX": trace_update}, header=hdr)
+
+        return [(f'FLAT_NORM_{item_wlen}.fits', "FLAT_NORM", hdr), 
+                (f'BLAZE_{item_wlen}.fits', "BLAZE", hdr)]
         
 
     @print_runtime
+    @recipe(inputs=['header', 'raw:SCIENCE', 'calib:DARK_MASTER', 'calib:DARK_RON', 
+                    'calib:FLAT_NORM', 'calib:FLAT_BPM', 'calib:TRACE_TW', 'calib:SLIT_TILT'],
+            outputs=['product:{obs_mode}_FRAME'])
     def obs_nodding(self):
         """
         Method for calibrating and processing science frames. 
@@ -1156,10 +1973,10 @@ class CriresPipeline:
         # Open the read-out noise file
         indices_ron = (self.calib_info[self.key_caltype] == "DARK_RON") 
         file_ron = self.calib_info[indices_ron][self.key_filename].iloc[0]
-        ron = fits.getdata(os.path.join(self.calpath, file_ron))
+        ron = self._read_image(os.path.join(self.calpath, file_ron))
 
         # initialize a Pool for parallel
-        with Pool(processes=self.num_processes) as pool:
+        with self._worker_pool() as pool:
             pool_jobs = []
             # Loop over each target
             for object in unique_target:
@@ -1197,9 +2014,9 @@ class CriresPipeline:
                                 & (self.calib_info[self.key_wlen] == item_wlen)
 
                     file = self.calib_info[indices_flat][self.key_filename].iloc[0]
-                    flat = fits.getdata(os.path.join(self.calpath, file))
+                    flat = self._read_image(os.path.join(self.calpath, file))
                     file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-                    bpm = fits.getdata(os.path.join(self.calpath, file))
+                    bpm = read_bpm(os.path.join(self.calpath, file))
                     file = self.calib_info[indices_tw][self.key_filename].iloc[0]
                     tw = fits.getdata(os.path.join(self.calpath, file))
                     file = self.calib_info[indices_slit][self.key_filename].iloc[0]
@@ -1234,22 +2051,25 @@ class CriresPipeline:
 
                             if np.sum(indices_dark) < 1:
                                 warnings.warn(f"No MASTER DARK frame found with the DIT value {item_dit}s corresponding to that of science data")
-                                self._download_archive("DARK", item_dit)
+                                if self._download_archive("DARK", item_dit) == 'downloaded':
+                                    self._run_tasks({('DARK', item_dit): (self._process_dark, 
+                                                    (item_dit, 5, 'median'), [])}, debug=True)
                             
                             indices_dark = (self.calib_info[self.key_caltype] == "DARK_MASTER") \
                                         & (self.calib_info[self.key_DIT] == item_dit)
                             file = self.calib_info[indices_dark][self.key_filename].iloc[0]
-                            dark = fits.getdata(os.path.join(self.calpath, file)) 
+                            dark = self._read_image(os.path.join(self.calpath, file))
 
                             indices_ron = (self.calib_info[self.key_caltype] == "DARK_RON") \
                                         & (self.calib_info[self.key_DIT] == item_dit)
                             file_ron = self.calib_info[indices_ron][self.key_filename].iloc[0]
-                            ron = fits.getdata(os.path.join(self.calpath, file_ron)) 
+                            ron = self._read_image(os.path.join(self.calpath, file_ron))
                             
                             for i in range(df_nods.shape[0]):
                                 filename = df_nods[self.key_filename].iloc[i]
-                                job = pool.apply_async(self._process_staring, 
-                                                    args=(filename, flat, bpm, 
+                                job = pool.apply_async(self._run_job, 
+                                                    args=(self._process_staring, 
+                                                        filename, flat, bpm, 
                                                         tw, dark, ron, object, item_wlen))
                                 pool_jobs.append(job)
                         else:
@@ -1262,8 +2082,9 @@ class CriresPipeline:
                                 Nexp_per_nod = int(nod_a_count//self.header_info[indices_nod_A][self.key_nabcycle].iloc[0])
                             
                             for i, row in enumerate(range(0, df_nods.shape[0], Nexp_per_nod)):
-                                job = pool.apply_async(self._process_nodding, 
-                                                    args=(df_nods, i, row, Nexp_per_nod, 
+                                job = pool.apply_async(self._run_job, 
+                                                    args=(self._process_nodding,
+                                                          df_nods, i, row, Nexp_per_nod, 
                                                           flat, bpm, tw, ron, object, item_wlen))
                                 pool_jobs.append(job)
             
@@ -1271,6 +2092,7 @@ class CriresPipeline:
                 job.get() 
 
 
+    @profiling.timed(cat='job')
     def _process_nodding(self, df_nods, i, row, Nexp_per_nod, flat, bpm, 
                              tw, ron, object, item_wlen):
         # check the nodding position of the current frame
@@ -1323,7 +2145,7 @@ class CriresPipeline:
                 ndit = hdu[0].header[self.key_NDIT]
                 # Loop over the detectors
                 for d in range(1, len(hdu)):
-                    frame.append(hdu[d].data)
+                    frame.append(hdu[d].data.astype(self.dtype))
             # Calculate the detector shot-noise 
             frame_err = su.detector_shotnoise(
                                 frame, ron, GAIN=self.gain, NDIT=ndit)
@@ -1344,11 +2166,11 @@ class CriresPipeline:
                 ndit = hdr[self.key_NDIT]
                 # Loop over the detectors
                 for d in range(1, len(hdu)):
-                    frame.append(hdu[d].data)
+                    frame.append(hdu[d].data.astype(self.dtype))
                     # Calculate the shot-noise for this detector
                     # For now only consider noise from bkg image
                     # the shot noise from target is not added.
-                    frame_err.append(np.zeros_like(hdu[d].data))
+                    frame_err.append(np.zeros_like(frame[-1]))
 
             # Subtract the nod-pair from each other
             frame_bkg_cor, err_bkg_cor = su.combine_frames(
@@ -1366,17 +2188,18 @@ class CriresPipeline:
             file_name = os.path.join(self.framepath, 
                             f"{self.obs_mode}_"+ object.replace(" ", "") + \
                             f"_{item_wlen}_{file_s}")
-            wfits(file_name, ext_list={"FLUX": frame_bkg_cor, 
-                                "FLUX_ERR": err_bkg_cor}, header=hdr)
+            self.writer.write(file_name, ext_list={"FLUX": self._as_image(frame_bkg_cor), 
+                                "FLUX_ERR": self._as_image(err_bkg_cor)}, header=hdr,
+                        compression=self.compression, callback=functools.partial(self._plot_det_image, file_name, 
+                            f"{object}_{self.obs_mode}_FRAME_{item_wlen}", 
+                            FileRef(file_name), level='full'))
 
             print(f"\nProcessed file {file_s} at nod position {pos}")
             self._add_to_product('/'.join(file_name.split('/')[-2:]), 
-                                f"{self.obs_mode}_FRAME")
-            
-            self._plot_det_image(file_name, 
-                        f"{object}_{self.obs_mode}_FRAME_{item_wlen}", frame_bkg_cor)
+                                f"{self.obs_mode}_FRAME", header=hdr)
     
 
+    @profiling.timed(cat='job')
     def _process_staring(self, file, flat, bpm, tw, dark, ron, object, item_wlen):
 
         frame, frame_err = [], []
@@ -1386,10 +2209,10 @@ class CriresPipeline:
             slitlen = hdr[self.key_slitlen]
             # Loop over the detectors
             for d in range(1, len(hdu)):
-                frame.append(hdu[d].data)
+                frame.append(hdu[d].data.astype(self.dtype))
                 # For now only consider noise from bkg image
                 # the shot noise from target is not added.
-                frame_err.append(np.zeros_like(hdu[d].data))
+                frame_err.append(np.zeros_like(frame[-1]))
 
         # Subtract dark frame
         frame_bkg_cor, err_bkg_cor = su.combine_frames(
@@ -1410,17 +2233,19 @@ class CriresPipeline:
         file_name = os.path.join(self.framepath, 
                         f"{self.obs_mode}_"+ object.replace(" ", "") + \
                         f"_{item_wlen}_{file_s}")
-        wfits(file_name, ext_list={"FLUX": frame_bkg_cor, 
-                            "FLUX_ERR": err_bkg_cor}, header=hdr)
+        self.writer.write(file_name, ext_list={"FLUX": self._as_image(frame_bkg_cor), 
+                            "FLUX_ERR": self._as_image(err_bkg_cor)}, header=hdr,
+                    compression=self.compression, callback=functools.partial(self._plot_det_image, file_name, 
+                        f"{object}_{self.obs_mode}_FRAME_{item_wlen}", 
+                        FileRef(file_name), level='full'))
 
         self._add_to_product('/'.join(file_name.split('/')[-2:]),  
-                            f"{self.obs_mode}_FRAME")
-        
-        self._plot_det_image(file_name, 
-                    f"{object}_{self.obs_mode}_FRAME_{item_wlen}", frame_bkg_cor)
+                            f"{self.obs_mode}_FRAME", header=hdr)
     
 
     @print_runtime
+    @recipe(inputs=['product:{obs_mode}_FRAME'],
+            outputs=['product:{obs_mode}_COMBINED'])
     def obs_nodding_combine(self, combine_mode='mean', clip=3):
         """
         Method for combining multiple nodding exposures at each nodding position A and B.
@@ -1494,13 +2319,12 @@ class CriresPipeline:
                             self.product_info[indices_pos][self.key_filename]):
                         with fits.open(os.path.join(self.outpath, file)) as hdu:
                             hdr = hdu[0].header
+                            dt = hdu["FLUX"].data.astype(self.dtype)
+                            dt_err = hdu["FLUX_ERR"].data.astype(self.dtype)
                             # in case of jittering
-                            if np.isclose(hdr[self.key_jitter], 0):
-                                dt, dt_err = hdu["FLUX"].data, hdu["FLUX_ERR"].data
-                            else:
+                            if not np.isclose(hdr[self.key_jitter], 0):
                                 # apply integer shift to align frames
-                                dt, dt_err = su.align_jitter(
-                                    hdu["FLUX"].data, hdu["FLUX_ERR"].data, 
+                                dt, dt_err = su.align_jitter(dt, dt_err, 
                                     int(np.round(hdr[self.key_jitter]/self.pix_scale)))
                             frames.append(dt)
                             frames_err.append(dt_err)
@@ -1531,13 +2355,13 @@ class CriresPipeline:
                     file_name = os.path.join(self.combpath, 
                             "COMBINED_"+ object.replace(" ", "") + \
                             f"_{item_wlen}_{self.obs_mode}_{pos}.fits")
-                    wfits(file_name, ext_list={"FLUX": combined, 
-                                "FLUX_ERR": combined_err}, header=hdr)
+                    self.writer.write(file_name, ext_list={"FLUX": self._as_image(combined), 
+                                "FLUX_ERR": self._as_image(combined_err)}, header=hdr,
+                        compression=self.compression, callback=functools.partial(self._plot_det_image, file_name, 
+                            f"{object}_{self.obs_mode}_{pos}_COMBINED_{item_wlen}", 
+                            FileRef(file_name)))
                     self._add_to_product('/'.join(file_name.split('/')[-2:]), 
-                            f"{self.obs_mode}_COMBINED")
-
-                    self._plot_det_image(file_name, 
-                        f"{object}_{self.obs_mode}_{pos}_COMBINED_{item_wlen}", combined)
+                            f"{self.obs_mode}_COMBINED", header=hdr)
 
                     INT_total += hdr[self.key_DIT]*hdr[self.key_NDIT]*(j+1)/3600.
                 
@@ -1618,7 +2442,7 @@ class CriresPipeline:
                 raise RuntimeError("No reduced frames to extract")
 
         # initialize a Pool for parallel
-        with Pool(processes=self.num_processes) as pool:
+        with self._worker_pool() as pool:
             pool_jobs = []
             # Loop over each target
             for object in unique_target:
@@ -1652,7 +2476,7 @@ class CriresPipeline:
                     #                (self.calib_info[self.key_wlen] == item_wlen)
 
                     file = self.calib_info[indices_bpm][self.key_filename].iloc[0]
-                    bpm = fits.getdata(os.path.join(self.calpath, file))
+                    bpm = read_bpm(os.path.join(self.calpath, file))
                     file = self.calib_info[indices_tw][self.key_filename].iloc[0]
                     tw = fits.getdata(os.path.join(self.calpath, file))
                     file = self.calib_info[indices_slit][self.key_filename].iloc[0]
@@ -1673,8 +2497,9 @@ class CriresPipeline:
                     #         pool_jobs.append(job)
                     # else:
                     for file in self.product_info[indices_wlen][self.key_filename]:
-                        job = pool.apply_async(self._process_extraction, 
-                                            args=(file, caltype.split('_')[1], 
+                        job = pool.apply_async(self._run_job, 
+                                            args=(self._process_extraction,
+                                                  file, caltype.split('_')[1], 
                                                   bpm, tw, slit, blaze, 
                                                 peak_frac, aper_prim, aper_comp, 
                                                 companion_sep, extract_2d, extr_level,
@@ -1685,6 +2510,7 @@ class CriresPipeline:
             for job in pool_jobs:
                 job.get() 
 
+    @profiling.timed(cat='job')
     def _process_extraction(self, file, filetype, bpm, tw, slit, blaze, 
                             peak_frac, aper_prim, aper_comp, 
                             companion_sep, extract_2d, extr_level,
@@ -1693,11 +2519,13 @@ class CriresPipeline:
         
         with fits.open(os.path.join(self.outpath, file)) as hdu:
             hdr = hdu[0].header
-            dt = hdu["FLUX"].data
-            dt_err = hdu["FLUX_ERR"].data
+            dt = hdu["FLUX"].data.astype(self.dtype)
+            dt_err = hdu["FLUX_ERR"].data.astype(self.dtype)
         pos = hdr[self.key_nodpos]
         slitlen = hdr[self.key_slitlen]
         ndit = hdr[self.key_NDIT]
+        # spectra of individual frames are only plotted at the `full` level
+        plot_level = 'full' if 'FRAME' in filetype else 'summary'
            
         if peak_frac is not None:
             f0 = int(peak_frac[pos]*slitlen/self.pix_scale)
@@ -1723,12 +2551,14 @@ class CriresPipeline:
         paths = file.split('/')
         paths[-1] = '_'.join(['Extr1D_PRIMARY', savename, paths[-1]])
         filename = os.path.join(self.outpath, '/'.join(paths))
-        wfits(filename, ext_list={"FLUX": flux_pri, "FLUX_ERR": err_pri}, header=hdr)
+        self.writer.write(filename, ext_list={"FLUX": flux_pri, "FLUX_ERR": err_pri}, header=hdr)
         if savename == '':
-            self._add_to_product('/'.join(paths), f'Extr1D_{filetype}_PRIMARY', snr_mid)
+            self._add_to_product('/'.join(paths), f'Extr1D_{filetype}_PRIMARY', snr_mid, 
+                                 header=hdr)
         else:
-            self._add_to_product('/'.join(paths), '_'.join(['Extr1D', filetype, savename]), snr_mid)
-        self._plot_spec_by_order(filename[:-5], flux_pri)
+            self._add_to_product('/'.join(paths), '_'.join(['Extr1D', filetype, savename]), snr_mid, 
+                                 header=hdr)
+        self._plot_spec_by_order(filename[:-5], flux_pri, level=plot_level)
         
         if extract_2d:
             paths = file.split('/')
@@ -1737,7 +2567,7 @@ class CriresPipeline:
 
             extr2d = DETECTOR(data=[D, V, P], fields=['flux', 'var', 'psf'])
             extr2d.save_extr2d(filename2d)
-            extr2d.plot_extr2d_model(filename2d)
+            self._plot_extr2d_model(filename2d)
 
             if savename == '':
                 self._add_to_product('/'.join(paths)+'.npz', f'Extr2D_{filetype}_PRIMARY')
@@ -1763,13 +2593,15 @@ class CriresPipeline:
             paths = file.split('/')
             paths[-1] = '_'.join(['Extr1D_SECONDARY', savename, paths[-1]])
             filename = os.path.join(self.outpath, '/'.join(paths))
-            wfits(filename, ext_list={"FLUX": flux_sec, 
+            self.writer.write(filename, ext_list={"FLUX": flux_sec, 
                                     "FLUX_ERR": err_sec}, header=hdr)
             if savename == '':
-                self._add_to_product('/'.join(paths), f'Extr1D_{filetype}_SECONDARY')
+                self._add_to_product('/'.join(paths), f'Extr1D_{filetype}_SECONDARY', 
+                                     header=hdr)
             else:
-                self._add_to_product('/'.join(paths), '_'.join(['Extr1D', filetype, savename]))
-            self._plot_spec_by_order(filename[:-5], flux_sec)
+                self._add_to_product('/'.join(paths), '_'.join(['Extr1D', filetype, savename]), 
+                                     header=hdr)
+            self._plot_spec_by_order(filename[:-5], flux_sec, level=plot_level)
             
             paths = file.split('/')
             paths[-1] = '_'.join(['Extr2D_SECONDARY', savename, paths[-1][:-5]])
@@ -1777,7 +2609,7 @@ class CriresPipeline:
             
             extr2d = DETECTOR(data=[D, V, P], fields=['flux', 'var', 'psf'])
             extr2d.save_extr2d(filename2d)
-            extr2d.plot_extr2d_model(filename2d)
+            self._plot_extr2d_model(filename2d)
 
             if savename == '':
                 self._add_to_product('/'.join(paths)+'.npz', f'Extr2D_{filetype}_SECONDARY')
@@ -1867,13 +2699,16 @@ class CriresPipeline:
                 file_name = os.path.join(self.calpath, f'WLEN_{item_wlen}_' \
                                         + '_'.join(target.split())+'.fits')
                 hdr[self.key_target_name] = target
-                wfits(file_name, ext_list={"WAVE": wlen_cal}, header=hdr)
+                self.writer.write(file_name, ext_list={"WAVE": wlen_cal}, header=hdr)
                 self._add_to_calib(f'WLEN_{item_wlen}_' \
-                                    + '_'.join(target.split())+'.fits', "CAL_WLEN")
+                                    + '_'.join(target.split())+'.fits', "CAL_WLEN", 
+                                    header=hdr)
 
                 self._plot_spec_by_order(file_name[:-5], dt, wlen_cal, 
                                         transm_spec=tellu_conv)
         
+        # the wavelength solutions are read back below
+        self.flush_writes()
 
         self._print_section("Save extracted spectra")
 
@@ -1992,17 +2827,16 @@ class CriresPipeline:
                         snr_mid = np.nanmean((spec_series/err_series)[:,wlens.shape[0]//2,:], axis=1)
 
 
-                    wfits(file_name+'.fits', ext_list={"FLUX": spec_series, 
+                    self.writer.write(file_name+'.fits', ext_list={"FLUX": spec_series, 
                                                 "FLUX_ERR": err_series,
                                                 "WAVE": wlens}, 
                                         header=hdr)
                     self._add_to_product('/'.join(file_name.split('/')[-2:])+'.fits', 
-                                    '_'.join(['SPEC']+label.split('_')[-2:]))
+                                    '_'.join(['SPEC']+label.split('_')[-2:]), 
+                                    header=hdr)
                     if data_type == data_comb:
-                        np.savetxt(file_name+'.dat', np.c_[wlens.flatten(), 
-                                                            spec_series.flatten(), 
-                                                            err_series.flatten()], 
-                                    header="wave flux err")
+                        write_dat(file_name+'.dat', [wlens, spec_series, err_series], 
+                                  header="wave flux err")
                     
                     if isinstance(snr_mid, float):
                         print(f"Saved target {target} {l} with wavelength coverage {unique_wlen}; ",
@@ -2034,6 +2868,7 @@ class CriresPipeline:
         indices = self.header_info[self.key_catg] == "SCIENCE"
 
         # Setup SkyCalc object
+        import skycalc_ipy
         sky_calc = skycalc_ipy.SkyCalc()
 
         wlen_id = self.header_info[indices][self.key_wlen].iloc[0]
@@ -2102,9 +2937,16 @@ class CriresPipeline:
 
 
     @print_runtime
-    def run_molecfit(self, object=None, data_type=None, wave_range=None, verbose=True):
+    def run_molecfit(self, object=None, data_type=None, wave_range=None, 
+                     warm_start=None, use_cache=True, cache_dir=None, 
+                     verbose=True):
         """
         Method for running ESO's tool for telluric correction `Molecfit`. 
+        Each fit runs in its own scratch directory inside `out/molecfit`, 
+        named by the product file, so that the spectra (or individual frames 
+        of time-series observations) are fitted concurrently with 
+        `num_processes` workers. The telluric model of each product is saved 
+        to `TELLURIC_<product>.fits`.
 
         Parameters
         ----------
@@ -2118,6 +2960,19 @@ class CriresPipeline:
         wave_range: list of tuple
             list of lower and upper limit for wavelength ranges (in um)
             for molecfit fitting
+        warm_start: str
+            Only for `SPEC_FRAME_PRIMARY`. Set to `combined` to seed the fit 
+            of every frame with the solution of the combined spectrum (which 
+            has to be fitted first), or to `previous` to seed each frame 
+            with the solution of the preceding one. The frames of one target 
+            are then fitted sequentially. The default is to fit every frame 
+            from scratch.
+        use_cache: bool
+            Reuse the stored results of fits with identical inputs 
+            instead of running `esorex` again.
+        cache_dir: str
+            the directory of the molecfit result cache. 
+            Default is `$EXCALIBUHR_CACHE` or `~/.cache/excalibuhr`.
         verbose : bool
             Print output produced by ``esorex``.
         
@@ -2126,6 +2981,10 @@ class CriresPipeline:
         :func:`excalibuhr.utils.molecfit`
         """
 
+        if warm_start not in (None, 'combined', 'previous'):
+            raise ValueError("warm_start must be None, 'combined' or 'previous', "
+                             f"not {warm_start!r}")
+
         self._print_section("Run Molecfit")
 
         # Create the molecfit directory if it does not exist yet
@@ -2133,6 +2992,9 @@ class CriresPipeline:
         if not os.path.exists(self.molpath):
             os.makedirs(self.molpath)
 
+        # Create the recipe configurations shared by all fits
+        for eso_recipe in ["molecfit_model", "molecfit_calctrans", "molecfit_correct"]:
+            su.create_eso_recipe_config(eso_recipe, self.molpath, verbose=verbose)
 
         # get updated product info
         self.product_info = pd.read_csv(self.product_file, sep=';')
@@ -2145,51 +3007,157 @@ class CriresPipeline:
             indices = indices & \
                 (self.product_info[indices][self.key_target_name] == object)
 
-        for science_file in self.product_info[indices][self.key_filename]:
-
-            name = science_file.split('/')[-1] 
-            target = name.split('_')[0]
+        cache_kwargs = {'use_cache': use_cache, 'cache_dir': cache_dir}
 
-            if data_type == 'SPEC_COMBINED_PRIMARY':
-                dt = SPEC(filename=os.path.join(self.outpath, science_file))
-                dt.wlen *= 1e-3
-                su.molecfit(self.molpath, dt, wave_range, savename=name, verbose=verbose)
-
-                
-                file_best_par = fits.getdata(os.path.join(self.molpath, 'BEST_FIT_PARAMETERS.fits'))
-                best_params = fits.getdata(file_best_par, 1)
-                np.savetxt(os.path.join(self.molpath, f'BEST_FIT_PARAMETERS_{target}.txt'), 
-                                best_params.tolist()[:-2], fmt='%s')
-
-                # save telluric model
-                tellu = fits.getdata(os.path.join(self.molpath, 'TELLURIC_DATA.fits'))
-                file_name = os.path.join(self.molpath, f'TELLURIC_{target}.fits')
-                wfits(file_name, ext_list={"WAVE":tellu['lambda']*1e3, 
-                                           "FLUX":tellu['mtrans']}, 
-                                header=dt.header)
-
-            elif data_type == 'SPEC_FRAME_PRIMARY':
-                dt_series = SERIES(filename=os.path.join(self.outpath, science_file))
-                trans_model = []
-                for dt in dt_series:
+        # initialize a Pool for parallel
+        with self._worker_pool() as pool:
+            pool_jobs = []
+            for science_file, target in zip(
+                    self.product_info[indices][self.key_filename],
+                    self.product_info[indices][self.key_target_name]):
+
+                name = science_file.split('/')[-1] 
+                # products of the same target are fitted in separate 
+                # directories named by the product file
+                stem = os.path.splitext(name)[0]
+
+                if data_type == 'SPEC_COMBINED_PRIMARY':
+                    dt = SPEC(filename=os.path.join(self.outpath, science_file))
+                    header = dt.header
                     dt.wlen *= 1e-3
-                    su.molecfit(self.molpath, dt, wave_range, savename=name, verbose=verbose)
+                    input_path = os.path.join(self.molpath, stem)
+                    jobs = [pool.apply_async(self._process_molecfit, 
+                                args=(input_path, dt, wave_range, name, None, 
+                                      cache_kwargs, verbose))]
+
+                elif data_type == 'SPEC_FRAME_PRIMARY':
+                    # the frames are read from the file as they are fitted
+                    with SERIES(filename=os.path.join(self.outpath, science_file)) \
+                            as dt_series:
+                        header = dt_series.header
+                        input_paths, dts = [], []
+                        for i, dt in enumerate(dt_series):
+                            dt.wlen = dt.wlen * 1e-3
+                            dts.append(dt)
+                            input_paths.append(os.path.join(self.molpath, 
+                                                            f'{stem}_{i:03d}'))
+
+                    init_params = None
+                    if warm_start is not None:
+                        # the fit of the combined spectrum of the target
+                        indices_comb = (self.product_info[self.key_caltype] == 
+                                            'SPEC_COMBINED_PRIMARY') & \
+                                       (self.product_info[self.key_target_name] == target)
+                        if self.key_wlen in header:
+                            indices_comb &= (self.product_info[self.key_wlen] == 
+                                             header[self.key_wlen])
+                        file_best_par = ''
+                        for comb_file in self.product_info[indices_comb][self.key_filename]:
+                            comb_stem = os.path.splitext(comb_file.split('/')[-1])[0]
+                            file_best_par = os.path.join(self.molpath, comb_stem, 
+                                                         'BEST_FIT_PARAMETERS.fits')
+                        if os.path.isfile(file_best_par):
+                            init_params = su.read_molecfit_params(file_best_par)
+                        elif warm_start == 'combined':
+                            raise RuntimeError(f"No molecfit solution found for "
+                                    f"the combined spectrum of {target}. Please run "
+                                    "`run_molecfit` on `SPEC_COMBINED_PRIMARY` first.")
+
+                    if warm_start == 'previous':
+                        jobs = [pool.apply_async(self._process_molecfit_chain, 
+                                args=(input_paths, dts, wave_range, name, 
+                                      init_params, cache_kwargs, verbose))]
+                    else:
+                        jobs = [pool.apply_async(self._process_molecfit, 
+                                args=(input_path, dt, wave_range, name, 
+                                      init_params, cache_kwargs, verbose)) 
+                                for input_path, dt in zip(input_paths, dts)]
+
+                pool_jobs.append((stem, header, jobs))
+
+            # gather the results
+            for stem, header, jobs in pool_jobs:
+                results = []
+                for job in jobs:
+                    res = job.get()
+                    if isinstance(res, list):
+                        results.extend(res)
+                    else:
+                        results.append(res)
+                wave, trans_model, best_params = zip(*results)
 
-                    tellu = fits.getdata(os.path.join(self.molpath, 'TELLURIC_DATA.fits'))
-                    trans_model.append(tellu['mtrans'])
+                if data_type == 'SPEC_COMBINED_PRIMARY':
+                    np.savetxt(os.path.join(self.molpath, f'BEST_FIT_PARAMETERS_{stem}.txt'), 
+                                    best_params[0][:-2], fmt='%s')
+                    trans_model = trans_model[0]
 
-                file_name = os.path.join(self.molpath, f'TELLURIC_{target}.fits')
-                wfits(file_name, ext_list={"WAVE": tellu['lambda']*1e3, 
+                # save telluric model
+                file_name = os.path.join(self.molpath, f'TELLURIC_{stem}.fits')
+                self.writer.write(file_name, ext_list={"WAVE": wave[0]*1e3, 
                                            "FLUX": trans_model}, 
-                                header=dt_series.header)
+                                header=header)
             
-            self._add_to_product(f'molecfit/TELLURIC_{target}.fits', "TELLU_MOLECFIT")
+                self._add_to_product(f'molecfit/TELLURIC_{stem}.fits', "TELLU_MOLECFIT", 
+                                     header=header)
+
+
+    @profiling.timed(cat='job')
+    def _process_molecfit(self, input_path, dt, wave_range, savename, 
+                          init_params, cache_kwargs, verbose):
+        """
+        Internal method for running molecfit on one spectrum in 
+        its own working directory.
+
+        Returns
+        -------
+        wave, trans: array
+            wavelength and transmission of the best-fit telluric model 
+        best_params: list
+            rows of the best-fit parameters table
+        """
+
+        if not os.path.exists(input_path):
+            os.makedirs(input_path)
+
+        su.molecfit(input_path, dt, wave_range, savename=savename, 
+                    config_path=self.molpath, init_params=init_params, 
+                    verbose=verbose, **cache_kwargs)
+
+        tellu = fits.getdata(os.path.join(input_path, 'TELLURIC_DATA.fits'))
+        best_params = fits.getdata(os.path.join(input_path, 'BEST_FIT_PARAMETERS.fits'), 1)
+
+        return tellu['lambda'], tellu['mtrans'], best_params.tolist()
+
+
+    @profiling.timed(cat='job')
+    def _process_molecfit_chain(self, input_paths, dts, wave_range, savename, 
+                                init_params, cache_kwargs, verbose):
+        """
+        Internal method for running molecfit on a sequence of spectra,
+        where each fit is warm started with the solution of the preceding one.
+
+        Returns
+        -------
+        results: list
+            outputs of :meth:`_process_molecfit` for each spectrum
+        """
+
+        results = []
+        for input_path, dt in zip(input_paths, dts):
+            res = self._process_molecfit(input_path, dt, wave_range, savename, 
+                                         init_params, cache_kwargs, verbose)
+            init_params = su.read_molecfit_params(res[-1])
+            results.append(res)
+
+        return results
 
 
 
     @print_runtime
     def spec_response_cal(self, object, temp, vsini, vsys, 
-                          mask_wave=[(2164, 2169)], debug=False
+                          mask_wave=[(2164, 2169)], 
+                          phoenix_cache=None, phoenix_dir=None,
+                          debug=False
                         ):
         """
         Method for calibrating spectral shape using standard star observations.
@@ -2209,7 +3177,13 @@ class CriresPipeline:
             list of lower and upper limit for wavelength ranges (in nm) that need to 
             be masked when estimating the isntrument response.
             They are usually Hydrogen lines of the stellar spectrum.
-
+        phoenix_cache: str
+            directory for caching the cropped PHOENIX stellar models, shared 
+            across nights. By default, `$EXCALIBUHR_CACHE/phoenix` or 
+            `~/.cache/excalibuhr/phoenix`.
+        phoenix_dir: str
+            local directory of PHOENIX HiRes models to use instead of 
+            downloading them from the Göttingen server.
         
         See Also
         --------
@@ -2254,10 +3228,13 @@ class CriresPipeline:
 
         response, tellu_std = su.instrument_response(std, tellu, 
                                         temp, vsini, vsys, 
-                                        mask_wave, debug=debug)
+                                        mask_wave, 
+                                        cache_dir=phoenix_cache,
+                                        model_dir=phoenix_dir,
+                                        debug=debug)
 
         file_name = os.path.join(self.calpath, "RESPONSE.dat")
-        np.savetxt(file_name, np.c_[np.ravel(std.wlen), response, tellu_std])
+        write_dat(file_name, [std.wlen, response, tellu_std])
 
 
 
@@ -2283,7 +3260,7 @@ class CriresPipeline:
 
         # get instrument response
         file_name = os.path.join(self.calpath, "RESPONSE.dat")
-        w_std, resp, tellu_std = np.genfromtxt(file_name, unpack=1)
+        w_std, resp, tellu_std = read_dat(file_name)
 
         # get labels containing 'SPEC'
         all_labels = self.product_info[self.key_caltype].unique()
@@ -2310,10 +3287,7 @@ class CriresPipeline:
                                     (self.product_info[self.key_target_name] == target)
                     if sum(indices_tellu) < 1:
                         raise Exception("No telluric model found")
-
-                    with fits.open(os.path.join(self.outpath, 
-                            self.product_info[indices_tellu][self.key_filename].iloc[0])) as hdu:
-                        mtrans = hdu['FLUX'].data
+                    tellu_files = list(self.product_info[indices_tellu][self.key_filename])
                 else:
                     # use standard star spectrum as telluric model
                     mtrans = tellu_std
@@ -2321,6 +3295,14 @@ class CriresPipeline:
                 indices_obj = indices & (self.product_info[self.key_target_name] == target)
 
                 for file in self.product_info[indices_obj][self.key_filename]:
+                    if use_molecift:
+                        # prefer the telluric model fitted to this spectrum
+                        tellu_file = 'molecfit/TELLURIC_' + file.split('/')[-1]
+                        if tellu_file not in tellu_files:
+                            tellu_file = tellu_files[0]
+                        with fits.open(os.path.join(self.outpath, tellu_file)) as hdu:
+                            mtrans = hdu['FLUX'].data
+
                     with fits.open(os.path.join(self.outpath, file)) as hdu:
                         specs = hdu["FLUX"].data
                         errs = hdu["FLUX_ERR"].data
@@ -2335,7 +3317,7 @@ class CriresPipeline:
                     f[mask] = np.nan
 
                     file_name = os.path.join(self.outpath, file[:-5] + "1D_TELLURIC_CORR.dat")
-                    np.savetxt(file_name, np.c_[w_std*1e-3, f, f_err], header="wave flux err")
+                    write_dat(file_name, [w_std*1e-3, f, f_err], header="wave flux err")
 
                     print(f"Telluric corrected spectra saved to {file_name.split('/')[-1]}")
 
@@ -2392,11 +3374,7 @@ class CriresPipeline:
 
         """
         self.extract_header()
-        self.cal_dark()
-        self.cal_flat_raw()
-        self.cal_flat_trace()
-        self.cal_slit_curve()
-        self.cal_flat_norm()
+        self.calibration()
         self.obs_nodding()
 
         if combine:
@@ -2429,6 +3407,10 @@ class CriresPipeline:
                                    vsys=std_prop['rv'])
             self.apply_correction()
 
+        self.flush_plots()
+        if profiling.is_enabled():
+            self.save_profile()
+
 
     def preprocessing(self, combine_mode='mean'):
         """
@@ -2442,11 +3424,7 @@ class CriresPipeline:
 
         """
         self.extract_header()
-        self.cal_dark()
-        self.cal_flat_raw()
-        self.cal_flat_trace()
-        self.cal_slit_curve()
-        self.cal_flat_norm()
+        self.calibration()
         self.obs_nodding()
 
         self.obs_nodding_combine(combine_mode=combine_mode)
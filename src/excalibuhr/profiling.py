@@ -0,0 +1,200 @@
+# File: src/excalibuhr/profiling.py
+__all__ = ['enable', 'disable', 'is_enabled', 'timed', 'record',
+           'load_events', 'summary', 'export_json', 'export_chrome_trace']
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+_lock = threading.Lock()
+_state = {'path': os.environ.get('EXCALIBUHR_PROFILE')}
+
+
+def enable(path):
+    """
+    Start recording timing and memory events to the directory `path`.
+    The setting is inherited by worker processes, which write their
+    events to separate files in the same directory.
+
+    Parameters
+    ----------
+    path: str
+        directory to save the event files
+    """
+    os.makedirs(path, exist_ok=True)
+    _state['path'] = os.path.abspath(path)
+    os.environ['EXCALIBUHR_PROFILE'] = _state['path']
+
+
+def disable():
+    """ Stop recording events. """
+    _state['path'] = None
+    os.environ.pop('EXCALIBUHR_PROFILE', None)
+
+
+def is_enabled():
+    return _state['path'] is not None
+
+
+def _rss_mb():
+    """ Current and peak resident set size of the process in MB. """
+    rss = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        peak = peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    return rss, peak
+
+
+def _write(event):
+    path = _state['path']
+    if path is None:
+        return
+    event_file = os.path.join(path, f'events_{os.getpid()}.jsonl')
+    with _lock:
+        with open(event_file, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+
+@contextlib.contextmanager
+def record(name, cat='step', **args):
+    """
+    Context manager recording the wall time, CPU time, and memory usage
+    of the enclosed code as an event in the Chrome trace format.
+    Nothing is recorded unless profiling is enabled.
+
+    Parameters
+    ----------
+    name: str
+        name of the event
+    cat: str
+        category of the event, e.g. `recipe`, `job`, `detector`, `order`,
+        or `kernel`.
+    args:
+        additional information saved with the event
+    """
+
+    if _state['path'] is None:
+        yield
+        return
+
+    t0, c0 = time.time(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.time() - t0, time.process_time() - c0
+        rss, peak = _rss_mb()
+        _write({'name': name, 'cat': cat, 'ph': 'X',
+                'ts': t0 * 1e6, 'dur': wall * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {'wall_s': wall, 'cpu_s': cpu,
+                         'rss_mb': rss, 'peak_rss_mb': peak, **args}})
+
+
+def timed(func=None, name=None, cat='kernel'):
+    """
+    Decorator recording each call of the function with :func:`record`.
+    Can be used as ``@timed`` or ``@timed(cat='job')``.
+    """
+
+    if func is None:
+        return functools.partial(timed, name=name, cat=cat)
+
+    event_name = func.__qualname__ if name is None else name
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _state['path'] is None:
+            return func(*args, **kwargs)
+        with record(event_name, cat=cat):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def load_events(path=None):
+    """
+    Read the events recorded by all processes.
+
+    Parameters
+    ----------
+    path: str
+        directory of the event files. Default is the one set by :func:`enable`.
+
+    Returns
+    -------
+    events: list
+        events sorted by start time
+    """
+
+    path = _state['path'] if path is None else path
+    events = []
+    for file in sorted(os.listdir(path)):
+        if file.startswith('events_') and file.endswith('.jsonl'):
+            with open(os.path.join(path, file)) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+    return sorted(events, key=lambda e: e['ts'])
+
+
+def summary(events):
+    """
+    Aggregate the events by category and name.
+
+    Returns
+    -------
+    stats: dict
+        number of calls, total wall and CPU time, and maximum peak RSS
+        for each `category:name`.
+    """
+
+    stats = {}
+    for e in events:
+        key = f"{e['cat']}:{e['name']}"
+        s = stats.setdefault(key, {'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                   'peak_rss_mb': 0.})
+        s['calls'] += 1
+        s['wall_s'] += e['args']['wall_s']
+        s['cpu_s'] += e['args']['cpu_s']
+        s['peak_rss_mb'] = max(s['peak_rss_mb'], e['args']['peak_rss_mb'] or 0.)
+    return dict(sorted(stats.items(), key=lambda kv: -kv[1]['wall_s']))
+
+
+def export_json(filename, path=None):
+    """
+    Save all recorded events and their summary to a JSON file.
+    """
+
+    events = load_events(path)
+    with open(filename, 'w') as f:
+        json.dump({'summary': summary(events), 'events': events}, f, indent=1)
+
+
+def export_chrome_trace(filename, path=None):
+    """
+    Save all recorded events in the Chrome trace format, which can be
+    inspected in `chrome://tracing` or https://ui.perfetto.dev.
+    """
+
+    events = load_events(path)
+    t0 = min((e['ts'] for e in events), default=0.)
+    trace = []
+    for pid in sorted(set(e['pid'] for e in events)):
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                      'args': {'name': f'excalibuhr {pid}'}})
+    for e in events:
+        trace.append({**e, 'ts': e['ts'] - t0})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,493 @@
+# File: src/excalibuhr/qaplot.py
+__all__ = ['QAPlotter', 'FileRef', 'LEVELS', 'plot_det_image',
+           'plot_spec_by_order', 'plot_extr2d_model', 'decimate_minmax']
+
+import os
+import queue
+import atexit
+import shutil
+import tempfile
+import warnings
+import multiprocessing
+from collections import namedtuple
+import numpy as np
+from numpy.polynomial import polynomial as Poly
+from astropy.io import fits
+import excalibuhr.utils as su
+from excalibuhr import profiling
+from excalibuhr.data import DETECTOR
+
+# imported at the first plot
+plt = su.plt
+
+
+# QA plots of calibrations and final products are at the `summary` level,
+# those of every individual frame at the `full` level.
+LEVELS = {'off': 0, 'summary': 1, 'full': 2}
+
+# arrays larger than this (in bytes) are passed to the renderer via files
+SPILL_SIZE = 1e6
+
+# request acknowledged by the renderer once the previous plots are rendered
+_FLUSH = 'flush'
+
+
+class FileRef(namedtuple('FileRef', ['path', 'ext', 'temporary'])):
+    """
+    Reference to the data to plot, either an extension of a FITS file
+    saved by the pipeline or a temporary `.npy` file.
+    """
+    def __new__(cls, path, ext='FLUX', temporary=False):
+        return super().__new__(cls, path, ext, temporary)
+
+    def load(self):
+        if self.path.endswith('.npy'):
+            data = np.load(self.path)
+            if self.temporary:
+                os.remove(self.path)
+            return data
+        return fits.getdata(self.path, self.ext)
+
+
+def _set_plot_style():
+    plt.rcParams.update({
+        'font.size': 12,
+        "xtick.labelsize": 12,
+        "ytick.labelsize": 12,
+        "xtick.direction": 'in',
+        "ytick.direction": 'in',
+        'ytick.right': True,
+        'xtick.top': True,
+        "xtick.minor.visible": True,
+        "ytick.minor.visible": True,
+        "lines.linewidth": 0.5,
+        'image.origin': 'lower',
+        'image.cmap': 'cividis',
+        "savefig.dpi": 300,
+        })
+
+
+def plot_det_image(savename, title, data, tw=None, slit=None, x_fpet=None):
+    """
+    Plot detector images.
+
+    Parameters
+    ----------
+    savename : str
+        The name of the file to save the plot to.
+    title : str
+        The title of the plot.
+    data : numpy.ndarray
+        The 2d image to plot.
+    tw : list, optional
+        The trace parameters for plotting the order traces.
+    slit : list, optional
+        The slit parameters for plotting the slit lines.
+    x_fpet : list, optional
+        The x-positions of the fpet line positions.
+    """
+
+    # check data dimension
+    data = np.array(data)
+    if data.ndim == 3:
+        Ndet = data.shape[0]
+    elif data.ndim == 2:
+        Ndet = 1
+        data = data[np.newaxis,:]
+    else:
+        raise TypeError("Invalid data dimension")
+
+    xx = np.arange(data.shape[-1])
+
+    _set_plot_style()
+    fig, axes = plt.subplots(nrows=1, ncols=Ndet, squeeze=False,
+                            figsize=(Ndet*4,4), constrained_layout=True)
+    for i in range(Ndet):
+        ax, im = axes[0,i], data[i]
+        nans = np.isnan(im)
+        vmin, vmax = np.percentile(im[~nans], (1, 99))
+        ax.imshow(im, vmin=vmin, vmax=vmax)
+        if not tw is None:
+            trace = tw[i]
+            yy_trace = su.trace_polyval(xx, trace)
+            trace_lower, trace_upper = yy_trace
+            for o, (yy_upper, yy_lower) in \
+                    enumerate(zip(trace_upper, trace_lower)):
+                ax.plot(xx, yy_upper, 'r')
+                ax.plot(xx, yy_lower, 'r')
+                ax.text(xx[len(xx)//10], np.mean(yy_upper+yy_lower)/2.,
+                        f'Order {o}', va='center', color='white')
+        if not slit is None:
+            trace = tw[i]
+            slit_meta, x_fpets = slit[i], x_fpet[i]
+            im_subs, yy_indices = su.im_order_cut(im, trace)
+            yy_poly = su.slit_polyval(x_fpets, slit_meta)
+            for (poly, x_peak, yy) in zip(yy_poly, x_fpets, yy_indices):
+                for x, p in zip(x_peak, poly):
+                    x_model = Poly.polyval(yy, p)
+                    ax.plot(x_model, yy, ':r', zorder=9)
+        ax.set_title(f"Detector {i}", size='large', fontweight='bold')
+
+    plt.suptitle(title)
+    plt.savefig(savename[:-4]+'png')
+    plt.close(fig)
+
+
+def decimate_minmax(x, y, n_bins=500):
+    """
+    Decimate a line for plotting, keeping the minimum and maximum of `y`
+    within each of `n_bins` bins, so that narrow features such as 
+    absorption lines and outliers remain visible.
+
+    Parameters
+    ----------
+    x, y: array
+        coordinates of the line
+    n_bins: int
+        number of bins; the decimated line has at most `2*n_bins` points.
+
+    Returns
+    -------
+    x, y: array
+        coordinates of the decimated line
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    if y.size <= 2*n_bins:
+        return x, y
+    bin_size = int(np.ceil(y.size / n_bins))
+    n_pad = (-y.size) % bin_size
+    yb = np.pad(y.astype(float), (0, n_pad), constant_values=np.nan)
+    yb = yb.reshape(-1, bin_size)
+    valid = ~np.all(np.isnan(yb), axis=1)
+    yb_fill = np.where(np.isnan(yb), np.inf, yb)
+    i_min = np.argmin(yb_fill, axis=1)
+    yb_fill = np.where(np.isnan(yb), -np.inf, yb)
+    i_max = np.argmax(yb_fill, axis=1)
+    offset = np.arange(yb.shape[0]) * bin_size
+    # keep the extrema of each bin in their original order
+    indices = np.sort(np.c_[i_min, i_max][valid], axis=1) + offset[valid, None]
+    indices = indices.ravel()
+    return x[indices], y[indices]
+
+
+# figures of `plot_spec_by_order` kept for reuse, see `_spec_figure`
+_spec_figures = {}
+
+
+def _spec_figure(Ndet, Norder, telluric):
+    """
+    Figure, axes grid, and line artists for `plot_spec_by_order`. 
+    The figure of each layout is created once and reused.
+    """
+    key = (Ndet, Norder, telluric)
+    if key in _spec_figures:
+        return _spec_figures[key]
+
+    _set_plot_style()
+    # minor ticks take most of the drawing time
+    with plt.rc_context({"xtick.minor.visible": False,
+                         "ytick.minor.visible": False}):
+        fig, axes = plt.subplots(nrows=Norder, ncols=Ndet, sharey='row',
+                    figsize=(6*Ndet,1.5*Norder), constrained_layout=True,
+                    squeeze=False)
+    lines, lines_tellu = np.empty((Ndet, Norder), dtype=object), \
+                         np.empty((Ndet, Norder), dtype=object)
+    for i in range(Norder):
+        for d in range(Ndet):
+            ax = axes[Norder-1-i, d]
+            lines[d, i], = ax.plot([], [], 'k', label='CRIRES obs.', 
+                                   rasterized=True)
+            if telluric:
+                lines_tellu[d, i], = ax.plot([], [], color='orange',
+                                        label='Telluric template',
+                                        rasterized=True)
+    for d in range(Ndet):
+        axes[0,d].set_title(f"Detector {d}", size='large',
+                            fontweight='bold')
+    for i in range(Norder):
+        axes[Norder-1-i,-1].annotate(f"Order {i}", xy=(1.1,0.5),
+                xycoords='axes fraction',
+                xytext=(0,0),
+                textcoords='offset points',
+                fontweight='bold',
+                size='large', ha='right', va='center',
+                rotation=90)
+    axes[-1,0].set_ylabel('Flux')
+    if telluric:
+        axes[-1,-1].legend()
+    _spec_figures[key] = (fig, axes, lines, lines_tellu)
+    return _spec_figures[key]
+
+
+def plot_spec_by_order(savename, flux, wlen=None, transm_spec=None, 
+                       fast=True, n_bins=500, dpi=None):
+    """
+    Plot spectra by order.
+
+    Parameters
+    ----------
+    savename : str
+        The name of the file to save the plot to.
+    flux : list
+        The list of spectra for each order and detector.
+    wlen : list, optional
+        The list of wavelength arrays for each order and detector.
+    transm_spec : numpy.ndarray, optional
+        The transmission spectrum with wavelength in the first column
+        and flux in the second column.
+    fast : bool
+        If True, decimate the lines with :func:`decimate_minmax`, 
+        reuse the figure and layout of previous calls with the same 
+        number of detectors and orders, and omit the minor ticks.
+    n_bins : int
+        The number of bins of the decimated lines.
+    dpi : float
+        The resolution of the saved plot. Default is 100 in the fast 
+        mode and 300 otherwise.
+    """
+    flux = np.array(flux)
+    Ndet, Norder, Nx = flux.shape
+    if wlen is None:
+        wlen = np.broadcast_to(np.arange(Nx, dtype=float), flux.shape)
+        xlim = np.broadcast_to([0, Nx], (Ndet, Norder, 2))
+        xlabel = 'Pixel'
+    else:
+        wlen = np.array(wlen)
+        xlim = wlen[..., [0, -1]]
+        xlabel = 'Wavelength (nm)'
+    telluric = transm_spec is not None
+
+    # the 1 and 99 percentiles of all panels at once
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        vmins, vmaxs = np.nanpercentile(flux, (1, 99), axis=-1)
+
+    if fast:
+        fig, axes, lines, lines_tellu = _spec_figure(Ndet, Norder, telluric)
+    else:
+        _set_plot_style()
+        fig, axes = plt.subplots(nrows=Norder, ncols=Ndet, sharey='row',
+                    figsize=(6*Ndet,1.5*Norder), constrained_layout=True,
+                    squeeze=False)
+
+    for i in range(Norder):
+        for d in range(Ndet):
+            ax = axes[Norder-1-i, d]
+            xx, y = wlen[d, i], flux[d, i]
+            if fast:
+                lines[d, i].set_data(*decimate_minmax(xx, y, n_bins))
+            else:
+                ax.plot(xx, y, 'k', label='CRIRES obs.')
+            ax.set_xlim(xlim[d, i])
+            if telluric:
+                indices = (transm_spec[:,0]>xx[0]) & \
+                          (transm_spec[:,0]<xx[-1])
+                xt, yt = transm_spec[:,0][indices], \
+                         transm_spec[:,1][indices]*vmaxs[d, i]
+                if fast:
+                    lines_tellu[d, i].set_data(*decimate_minmax(xt, yt, n_bins))
+                else:
+                    ax.plot(xt, yt, color='orange', label='Telluric template')
+        ax.set_ylim((0.8*np.min(vmins[:, i]), 1.1*np.max(vmaxs[:, i])))
+
+    if not fast:
+        for d in range(Ndet):
+            axes[0,d].set_title(f"Detector {d}", size='large',
+                                fontweight='bold')
+        for i in range(Norder):
+            axes[Norder-1-i,-1].annotate(f"Order {i}", xy=(1.1,0.5),
+                    xycoords='axes fraction',
+                    xytext=(0,0),
+                    textcoords='offset points',
+                    fontweight='bold',
+                    size='large', ha='right', va='center',
+                    rotation=90)
+        axes[-1,0].set_ylabel('Flux')
+        if telluric:
+            axes[-1,-1].legend()
+    axes[-1,Ndet//2].set_xlabel(xlabel)
+    if dpi is None:
+        dpi = 100 if fast else 300
+    fig.savefig(savename+'.png', dpi=dpi)
+    if fast:
+        # keep the layout of the first plot for the next ones
+        fig.set_layout_engine('none')
+    else:
+        plt.close(fig)
+
+
+def plot_extr2d_model(savename):
+    """
+    Plot the 2D data and the fitted spatial profile saved in
+    `savename.npz` by :meth:`excalibuhr.data.DETECTOR.save_extr2d`.
+    """
+    DETECTOR(filename=savename+'.npz').plot_extr2d_model(savename)
+
+
+RENDERERS = {
+    'det_image': plot_det_image,
+    'spec_by_order': plot_spec_by_order,
+    'extr2d': plot_extr2d_model,
+}
+
+
+def _resolve(value):
+    if isinstance(value, FileRef):
+        return value.load()
+    return value
+
+
+def _render(kind, args, kwargs):
+    args = [_resolve(a) for a in args]
+    kwargs = {k: _resolve(v) for k, v in kwargs.items()}
+    with profiling.record(kind, cat='plot'):
+        RENDERERS[kind](*args, **kwargs)
+
+
+def _render_loop(plot_queue, done_queue):
+    """ 
+    Render the queued plot requests until receiving `None`, 
+    and acknowledge each flush request on `done_queue`.
+    """
+    plt.switch_backend('Agg')
+    while True:
+        request = plot_queue.get()
+        if request is None:
+            break
+        if request == _FLUSH:
+            done_queue.put(_FLUSH)
+            continue
+        kind, args, kwargs = request
+        try:
+            _render(kind, args, kwargs)
+        except Exception as e:
+            warnings.warn(f"QA plot {kind} for {args[0]} failed: {e}")
+        finally:
+            # clean up temporary data of the failed plots
+            for v in list(args) + list(kwargs.values()):
+                if isinstance(v, FileRef) and v.temporary and \
+                        os.path.isfile(v.path):
+                    os.remove(v.path)
+
+
+class QAPlotter:
+    """
+    Queue of quality-assessment plots, rendered by a background process
+    so that the reduction never waits for matplotlib.
+    The renderer is started at the first plot, or when the plotter is 
+    pickled and passed to worker processes, which share the queue of 
+    the main process.
+
+    Parameters
+    ----------
+    level: str
+        `off` for no plots, `summary` for the plots of calibrations and
+        combined products, or `full` to include the plots of each frame.
+    background: bool
+        If False, render the plots immediately in the calling process.
+    """
+
+    def __init__(self, level='full', background=True):
+        if level not in LEVELS:
+            raise ValueError(f"QA plot level must be one of {list(LEVELS)}")
+        self.level = level
+        self.background = background
+        self.queue = None
+        self.scratch = None
+        self._done = None
+        self._manager = None
+        self._process = None
+
+    def __getstate__(self):
+        # the worker processes only need the queue of the renderer
+        if self._pending_start():
+            self.start()
+        state = self.__dict__.copy()
+        state['_done'] = None
+        state['_manager'] = None
+        state['_process'] = None
+        return state
+
+    def _pending_start(self):
+        return self.background and LEVELS[self.level] > 0 and \
+               self.queue is None
+
+    def start(self):
+        """ Start the background renderer. """
+        self._manager = multiprocessing.Manager()
+        self.queue = self._manager.Queue()
+        self._done = self._manager.Queue()
+        self.scratch = tempfile.mkdtemp(prefix='excalibuhr_qa_')
+        self._process = multiprocessing.Process(target=_render_loop,
+                            args=(self.queue, self._done), 
+                            name='excalibuhr-qaplot')
+        self._process.start()
+        atexit.register(self.close)
+
+    def wants(self, level):
+        """ Whether plots at `level` are made. """
+        return 0 < LEVELS[level] <= LEVELS[self.level]
+
+    def _spill(self, value):
+        # pass large arrays to the renderer via temporary files
+        if isinstance(value, (list, np.ndarray)):
+            try:
+                arr = np.asarray(value)
+            except ValueError: # ragged lists, e.g. of traces
+                return value
+            if arr.dtype != object and arr.nbytes > SPILL_SIZE:
+                fd, path = tempfile.mkstemp(suffix='.npy', dir=self.scratch)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, arr)
+                return FileRef(path, temporary=True)
+        return value
+
+    def submit(self, kind, level, *args, **kwargs):
+        """
+        Request a plot.
+
+        Parameters
+        ----------
+        kind: str
+            `det_image`, `spec_by_order`, or `extr2d`, see the
+            functions `plot_*` of this module for their arguments.
+        level: str
+            `summary` or `full`; the plot is skipped if it is above
+            the level of the plotter.
+        args, kwargs:
+            arguments of the plotting function. Data can be given as
+            :class:`FileRef` to avoid copying them to the renderer.
+        """
+        if not self.wants(level):
+            return
+        if self._pending_start():
+            self.start()
+        if self.queue is None:
+            _render(kind, args, kwargs)
+            return
+        args = [self._spill(a) for a in args]
+        kwargs = {k: self._spill(v) for k, v in kwargs.items()}
+        self.queue.put((kind, args, kwargs))
+
+    def flush(self):
+        """ Wait for the queued plots to be rendered. """
+        if self._process is None:
+            return
+        self.queue.put(_FLUSH)
+        while self._process.is_alive():
+            try:
+                self._done.get(timeout=1)
+                return
+            except queue.Empty:
+                pass
+
+    def close(self):
+        """ Wait for the queued plots to be rendered and stop the renderer. """
+        if self._process is None:
+            return
+        self.queue.put(None)
+        self._process.join()
+        self._manager.shutdown()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+        self._process = self._manager = self.queue = self._done = None
+        atexit.unregister(self.close)
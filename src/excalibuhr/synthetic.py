@@ -0,0 +1,370 @@
+# File: src/excalibuhr/synthetic.py
+__all__ = ['make_night', 'make_transmission', 'OrderLayout']
+
+import os
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+from scipy import special
+from .data import wfits
+
+
+class OrderLayout:
+    """
+    Geometry and wavelength solution of the spectral orders on the
+    three detectors of a synthetic CRIRES+ observation.
+
+    Parameters
+    ----------
+    wlen_id: str
+        name of the wavelength setting written to the headers
+    n_pixel: int
+        number of pixels along each axis of the detectors. The orders
+        are packed closer on detectors smaller than 584 pixels, so
+        that there are always at least two orders.
+    slitlen: float
+        length of the slit in arcsec
+    pix_scale: float
+        plate scale in arcsec per pixel
+    wlen_center: float
+        central wavelength (in nm) of the middle order
+    n_det: int
+        number of detectors
+    """
+
+    def __init__(self, wlen_id='K2166', n_pixel=2048, slitlen=10.,
+                 pix_scale=0.056, wlen_center=2150., n_det=3):
+        self.wlen_id = wlen_id
+        self.n_pixel = n_pixel
+        self.n_det = n_det
+        self.slitlen = slitlen
+        self.slitlen_pix = slitlen / pix_scale
+        # at least two orders with a gap between them, which is used
+        # to correct the readout artifacts
+        self.pitch = min(292., n_pixel / 2.)
+        if self.pitch < self.slitlen_pix + 40.:
+            raise ValueError("n_pixel is too small to fit two orders: "
+                             f"the minimum is {int(2 * (self.slitlen_pix + 40.)) + 1}")
+        self.n_order = int(n_pixel // self.pitch)
+
+        # order centers at the middle of the detector and curvature
+        self.ycen = self.pitch * (np.arange(self.n_order) + 0.5) + \
+                    (n_pixel - self.n_order * self.pitch) / 2.
+        self.curv = [0.02, 1.5e-5 * (2048. / n_pixel)]
+
+        # wavelength coverage of each order and detector
+        dlam_order = 0.035 * wlen_center
+        dlam_det = 0.3 * dlam_order
+        self.wlen_begin = np.zeros((n_det, self.n_order))
+        self.wlen_end = np.zeros((n_det, self.n_order))
+        for o in range(self.n_order):
+            lam_c = wlen_center + (self.n_order // 2 - o) * dlam_order
+            for d in range(n_det):
+                lam_d = lam_c + (d - (n_det - 1) / 2.) * 1.1 * dlam_det
+                self.wlen_begin[d, o] = lam_d - dlam_det / 2.
+                self.wlen_end[d, o] = lam_d + dlam_det / 2.
+
+        self.xx = np.arange(n_pixel, dtype=float)
+
+    def trace(self, o):
+        """ y-coordinate of the center of order `o` along the detector """
+        x = self.xx - self.n_pixel / 2.
+        return self.ycen[o] + self.curv[0] * x + self.curv[1] * x**2
+
+    def tilt(self):
+        """ slope of the slit image along the detector """
+        return 0.05 + 0.02 * (self.xx - self.n_pixel / 2.) / self.n_pixel
+
+    def wavelength(self, d, o, x=None):
+        """ wavelength (in nm) of pixel columns `x` """
+        x = self.xx if x is None else x
+        u = x / (self.n_pixel - 1.)
+        # slightly non-linear dispersion
+        u = u + 0.05 * u * (1. - u)
+        return self.wlen_begin[d, o] + \
+                (self.wlen_end[d, o] - self.wlen_begin[d, o]) * u
+
+    def det_header(self, d):
+        """ detector extension header with the wavelength setting """
+        hdr = fits.Header()
+        hdr['EXTNAME'] = f'CHIP{d+1}.INT1'
+        for j in range(1, 11):
+            o = j - 1
+            if o < self.n_order:
+                hdr[f'HIERARCH ESO INS WLEN BEGIN{j}'] = self.wlen_begin[d, o]
+                hdr[f'HIERARCH ESO INS WLEN END{j}'] = self.wlen_end[d, o]
+                hdr[f'HIERARCH ESO INS WLEN CENY{j}'] = self.ycen[o]
+            else:
+                # orders falling out of the detector
+                hdr[f'HIERARCH ESO INS WLEN BEGIN{j}'] = 0.
+                hdr[f'HIERARCH ESO INS WLEN END{j}'] = 0.
+                hdr[f'HIERARCH ESO INS WLEN CENY{j}'] = -1.
+        return hdr
+
+
+def _slit_illumination(s, slitlen_pix, edge=1.5):
+    """ illumination of the slit with smooth edges """
+    half = slitlen_pix / 2.
+    return 0.5 * (special.erf((half - s) / edge) + special.erf((half + s) / edge))
+
+
+def _line_spectrum(x, centers, amps, sigma):
+    """ Gaussian emission or absorption lines at pixel positions """
+    spec = np.zeros_like(x)
+    for c, a in zip(centers, amps):
+        sel = slice(max(int(c - 6 * sigma), 0), max(int(c + 6 * sigma) + 1, 0))
+        spec[sel] += a * np.exp(-0.5 * ((x[sel] - c) / sigma)**2)
+    return spec
+
+
+def _render(layout, d, spectra, profile=None, tilt=True):
+    """
+    Render 2D images of the orders on detector `d`, given the 1D
+    spectrum of each order (on the pixel grid) and the spatial profile
+    along the slit.
+    """
+
+    n = layout.n_pixel
+    im = np.zeros((n, n))
+    yy = np.arange(n, dtype=float)
+    t = layout.tilt() if tilt else np.zeros(n)
+    half = layout.slitlen_pix / 2. + 5
+    for o in range(layout.n_order):
+        yc = layout.trace(o)
+        y0 = max(int(np.floor(yc.min() - half)), 0)
+        y1 = min(int(np.ceil(yc.max() + half)) + 1, n)
+        s = yy[y0:y1, None] - yc[None, :]
+        # shift the spectrum along the slit following the tilt
+        x_eff = layout.xx[None, :] - t[None, :] * s
+        flux = np.interp(x_eff, layout.xx, spectra[o])
+        weight = _slit_illumination(s, layout.slitlen_pix)
+        if profile is not None:
+            weight = weight * profile(s)
+        im[y0:y1] += flux * weight
+    return im
+
+
+def _telluric_lines(layout, seed):
+    """ centers (in nm) and depths of the telluric absorption lines """
+    rng = np.random.default_rng(seed + 2)
+    wmin = layout.wlen_begin.min() - 5.
+    wmax = layout.wlen_end.max() + 5.
+    n_lines = int(1.5 * (wmax - wmin))
+    return rng.uniform(wmin, wmax, n_lines), rng.uniform(0.02, 0.5, n_lines)
+
+
+def _transmission(wave, lines, sigma):
+    """ telluric transmission at wavelengths `wave` (in nm, sorted) """
+    tau = np.zeros_like(wave)
+    for c, a in zip(*lines):
+        i0, i1 = np.searchsorted(wave, [c - 6 * sigma, c + 6 * sigma])
+        tau[i0:i1] += a * np.exp(-0.5 * ((wave[i0:i1] - c) / sigma)**2)
+    return np.exp(-tau)
+
+
+def _blaze(layout):
+    u = (layout.xx - layout.n_pixel / 2.) / layout.n_pixel
+    return 0.4 + 0.6 * np.cos(0.9 * np.pi * u)**2
+
+
+class _Detector:
+    """ dark current, hot pixels, pixel response, and read noise """
+
+    def __init__(self, layout, seed):
+        rng = np.random.default_rng(seed)
+        shape = (layout.n_det, layout.n_pixel, layout.n_pixel)
+        self.ron = 6.
+        self.gain = 2.1
+        self.prnu = 1. + 0.01 * rng.standard_normal(shape)
+        self.hot = np.zeros(shape)
+        hot = rng.random(shape) < 1e-3
+        self.hot[hot] = rng.uniform(50., 500., np.sum(hot))
+        self.bias = 0.5 * np.sin(np.arange(layout.n_pixel) / 3.)
+
+    def expose(self, signal, dit, rng):
+        """ counts of a raw frame, given the signal (in counts/s) """
+        counts = (signal * self.prnu + 0.05 + self.hot) * dit
+        noise = np.sqrt(np.clip(counts, 0, None) / self.gain + self.ron**2)
+        counts = counts + noise * rng.standard_normal(counts.shape)
+        return (counts + self.bias[None, None, :]).astype(np.float32)
+
+
+def _primary_header(layout, filename, dpr_type, dpr_catg, dit, ndit, mjd,
+                    target='', nodpos=None, nexp=1, nabcycles=0):
+    hdr = fits.Header()
+    hdr['ORIGFILE'] = filename
+    hdr['OBJECT'] = target if target else dpr_type
+    hdr['MJD-OBS'] = mjd
+    hdr['DATE-OBS'] = Time(mjd, format='mjd').isot
+    hdr['RA'] = 150.0
+    hdr['DEC'] = -30.0
+    hdr['HIERARCH ESO DPR TYPE'] = dpr_type
+    hdr['HIERARCH ESO DPR CATG'] = dpr_catg
+    hdr['HIERARCH ESO TEL AIRM END'] = 1.1
+    hdr['HIERARCH ESO TEL AMBI FWHM END'] = 0.8
+    hdr['HIERARCH ESO DET SEQ1 DIT'] = dit
+    hdr['HIERARCH ESO DET NDIT'] = ndit
+    if nodpos is not None:
+        hdr['HIERARCH ESO SEQ NODPOS'] = nodpos
+    hdr['HIERARCH ESO SEQ NEXPO'] = nexp
+    hdr['HIERARCH ESO SEQ NABCYCLES'] = nabcycles
+    hdr['HIERARCH ESO SEQ JITTERVAL'] = 0.
+    hdr['HIERARCH ESO INS SLIT1 LEN'] = layout.slitlen
+    hdr['HIERARCH ESO INS SLIT1 NAME'] = 'w_0.2'
+    hdr['HIERARCH ESO INS WLEN ID'] = layout.wlen_id
+    return hdr
+
+
+def make_night(rawpath, wlen_id='K2166', n_pixel=2048,
+               target='SYNTH 1', n_cycles=2, dit=30., ndit=1,
+               n_dark=3, n_flat=3, dit_flat=2., dit_fpet=10.,
+               peak_frac={'A':0.3, 'B':0.7}, seed=0):
+    """
+    Write synthetic CRIRES+ raw frames of one night to `rawpath`:
+    darks for each DIT, flats, FPET and UNe lamp frames, and an ABBA
+    nodding sequence of a point source. The headers carry the ESO
+    keywords used by the pipeline.
+
+    Parameters
+    ----------
+    rawpath: str
+        the `raw` folder of the night
+    wlen_id: str
+        name of the wavelength setting
+    n_pixel: int
+        number of pixels along each axis of the detectors. Smaller
+        detectors have fewer orders, which is useful for quick runs;
+        the minimum is 438 pixels, which fit two orders.
+    target: str
+        name of the science target
+    n_cycles: int
+        number of ABBA nodding cycles
+    dit, ndit: float, int
+        integration time and number of integrations of the science frames
+    n_dark, n_flat: int
+        number of dark frames per DIT and of flat frames
+    dit_flat, dit_fpet: float
+        integration time of the flat and lamp frames
+    peak_frac: dict
+        position of the target along the slit at nod position A and B
+    seed: int
+        seed of the random numbers
+
+    Returns
+    -------
+    layout: OrderLayout
+        the geometry and wavelength solution of the synthetic data
+    """
+
+    os.makedirs(rawpath, exist_ok=True)
+    layout = OrderLayout(wlen_id=wlen_id, n_pixel=n_pixel)
+    detector = _Detector(layout, seed)
+    rng = np.random.default_rng(seed + 1)
+    blaze = _blaze(layout)
+    mjd = 60000.1
+    counter = [0]
+
+    def write(dpr_type, dpr_catg, signal, exptime, **kwargs):
+        counter[0] += 1
+        filename = f'CRIRES_SPEC_{dpr_type.replace(",", "_")}_{counter[0]:04d}.fits'
+        frame_rng = np.random.default_rng(seed + 100 + counter[0])
+        data = detector.expose(signal, exptime, frame_rng)
+        hdr = _primary_header(layout, filename, dpr_type, dpr_catg, exptime,
+                              kwargs.pop('n_int', 1),
+                              mjd + counter[0] * 2e-3, **kwargs)
+        hdul = fits.HDUList([fits.PrimaryHDU(header=hdr)] + \
+                [fits.ImageHDU(data[d], header=layout.det_header(d))
+                 for d in range(layout.n_det)])
+        hdul.writeto(os.path.join(rawpath, filename), overwrite=True)
+
+    zero = np.zeros((layout.n_det, n_pixel, n_pixel))
+
+    # darks for each DIT
+    for exptime in sorted({dit, dit_flat, dit_fpet}):
+        for _ in range(n_dark):
+            write('DARK', 'CALIB', zero, exptime)
+
+    # flats
+    flat = np.array([_render(layout, d, [8000. * blaze] * layout.n_order,
+                     tilt=False) for d in range(layout.n_det)])
+    for _ in range(n_flat):
+        write('FLAT', 'CALIB', flat, dit_flat)
+
+    # Fabry-Perot etalon, lines equally spaced in frequency
+    fpet, une = [], []
+    for d in range(layout.n_det):
+        spec_fpet, spec_une = [], []
+        for o in range(layout.n_order):
+            wave = layout.wavelength(d, o)
+            nu = 1. / wave
+            n_lines = int(layout.n_pixel / 65.)
+            nu_lines = np.linspace(nu[0], nu[-1], n_lines + 2)[1:-1]
+            x_lines = np.interp(-nu_lines, -nu, layout.xx)
+            spec_fpet.append(30. + _line_spectrum(layout.xx, x_lines,
+                                [600.] * n_lines, 2.8) * blaze)
+            x_une = rng.uniform(20, layout.n_pixel - 20, 15)
+            spec_une.append(5. + _line_spectrum(layout.xx, x_une,
+                                rng.uniform(100., 2000., 15), 1.5))
+        fpet.append(_render(layout, d, spec_fpet))
+        une.append(_render(layout, d, spec_une))
+    write('WAVE,FPET', 'CALIB', np.array(fpet), dit_fpet)
+    write('WAVE,UNE', 'CALIB', np.array(une), dit_fpet)
+
+    # science: point source with absorption lines seen through the
+    # telluric transmission, and sky emission lines
+    tellu_lines = _telluric_lines(layout, seed)
+    star, sky = [], []
+    for d in range(layout.n_det):
+        spec_star, spec_sky = [], []
+        for o in range(layout.n_order):
+            x_abs = rng.uniform(0, layout.n_pixel, 60)
+            depth = _line_spectrum(layout.xx, x_abs, rng.uniform(0.05, 0.6, 60), 2.)
+            tellu = _transmission(layout.wavelength(d, o), tellu_lines, 0.011)
+            spec_star.append(50. * blaze * np.exp(-depth) * tellu)
+            x_sky = rng.uniform(0, layout.n_pixel, 10)
+            spec_sky.append(blaze * (1. + _line_spectrum(layout.xx, x_sky,
+                                            rng.uniform(5., 50., 10), 1.5)))
+        star.append(spec_star)
+        sky.append(_render(layout, d, spec_sky))
+    sky = np.array(sky)
+
+    sigma = 0.8 / 2.355 / 0.056
+    for cycle in range(n_cycles):
+        for pos in 'ABBA':
+            s0 = (peak_frac[pos] - 0.5) * layout.slitlen_pix
+            def profile(s):
+                return np.exp(-0.5 * ((s - s0) / sigma)**2) / np.sqrt(2*np.pi) / sigma
+            signal = np.array([_render(layout, d, star[d], profile)
+                               for d in range(layout.n_det)]) + sky
+            write('OBJECT', 'SCIENCE', signal, dit, n_int=ndit, target=target,
+                  nodpos=pos, nexp=1, nabcycles=n_cycles)
+
+    return layout
+
+
+def make_transmission(filename, layout, seed=0):
+    """
+    Write the telluric transmission seen in the science frames of
+    :func:`make_night` at a resolution of about 2e5, in the format of
+    :meth:`excalibuhr.pipeline.CriresPipeline.run_skycalc`. Saved as
+    `TRANSM_SPEC.fits` in the `cal` folder of the night, it replaces
+    the SkyCalc model in
+    :meth:`~excalibuhr.pipeline.CriresPipeline.refine_wlen_solution`.
+
+    Parameters
+    ----------
+    filename: str
+        path to the output file
+    layout: OrderLayout
+        the geometry and wavelength solution returned by :func:`make_night`
+    seed: int
+        the seed passed to :func:`make_night`
+    """
+
+    lines = _telluric_lines(layout, seed)
+    wmin = layout.wlen_begin.min() - 5.
+    wmax = layout.wlen_end.max() + 5.
+    # sampling at a resolution of 5e5, as the SkyCalc model
+    wave = np.exp(np.arange(np.log(wmin), np.log(wmax), 1. / 5e5))
+    transm = _transmission(wave, lines, 0.006)
+    wfits(filename, ext_list={"FLUX": np.column_stack((wave, transm))})
@@ -3,21 +3,99 @@
 import numpy as np
 from astropy.io import fits
 from astropy import stats
-from astropy import constants as const
-from astropy.modeling import models, fitting
 from numpy.polynomial import polynomial as Poly
-from scipy import ndimage, signal, optimize
+from scipy import ndimage, signal, optimize, special
 from scipy.interpolate import interp1d, InterpolatedUnivariateSpline
 from scipy.sparse import csc_matrix
-import matplotlib.pyplot as plt 
-plt.rc('image', interpolation='nearest', origin='lower')
 import warnings
 import os
+import re
+import hashlib
+import fnmatch
+import functools
+import importlib
 import shutil
 import subprocess
-import requests
+import threading
+import contextlib
+from excalibuhr.profiling import timed, record
 
 
+_lazy_lock = threading.RLock()
+
+
+def _reset_lazy_lock():
+    # a process forked while another thread imports must not inherit the lock
+    global _lazy_lock
+    _lazy_lock = threading.RLock()
+
+os.register_at_fork(after_in_child=_reset_lazy_lock)
+
+
+class _LazyModule:
+    """
+    Proxy of a module, which is imported at the first access to its 
+    attributes. `setup` is called with the module after importing it.
+    The import is serialized, so that threads do not see a partially 
+    initialized module.
+    """
+
+    def __init__(self, name, setup=None):
+        self.__dict__['_name'] = name
+        self.__dict__['_setup'] = setup
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with _lazy_lock:
+                module = self._module
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    if self._setup is not None:
+                        self._setup(module)
+                        self.__dict__['_setup'] = None
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
+
+
+def lazy_import(name, setup=None):
+    """
+    Import a module lazily, to keep heavy and optional dependencies 
+    (e.g. plotting) from slowing down the import of excalibuhr.
+
+    Parameters
+    ----------
+    name: str
+        full name of the module, e.g. `matplotlib.pyplot`
+    setup: callable
+        function to call with the module after it is imported
+
+    Returns
+    -------
+    module: 
+        proxy of the module, importing it at the first attribute access
+    """
+    return _LazyModule(name, setup)
+
+
+def _setup_pyplot(plt):
+    plt.rc('image', interpolation='nearest', origin='lower')
+
+# pyplot is only needed for QA and debug plots
+plt = lazy_import('matplotlib.pyplot', setup=_setup_pyplot)
+
+
+@timed
 def util_master_dark(dt, combine_mode='median', badpix_clip=5):
     """
     combine dark frames; generate bad pixel map and readout noise frame
@@ -45,7 +123,7 @@ def util_master_dark(dt, combine_mode='median', badpix_clip=5):
     
     # Calculate the read-out noise as the stddev, scaled by 
     # the square-root of the number of observations
-    rons = np.nanstd(dt, axis=0)/np.sqrt(len(dt))
+    rons = np.nanstd(dt, axis=0)/len(dt)**0.5
 
     # Apply a sigma-clip to identify the bad pixels
     badpix = np.zeros_like(master).astype(bool)
@@ -57,6 +135,7 @@ def util_master_dark(dt, combine_mode='median', badpix_clip=5):
     return master, rons, badpix
 
 
+@timed
 def util_master_flat(dt, dark, combine_mode='median', badpix_clip=5):
     """
     combine flat frames; generate bad pixel map
@@ -100,6 +179,7 @@ def util_master_flat(dt, dark, combine_mode='median', badpix_clip=5):
 
     return master, badpix
 
+@timed
 def combine_frames(dt, err, collapse='mean', clip=3, weights=None):
     """
     combine multiple images or spectra with error propogation 
@@ -121,6 +201,7 @@ def combine_frames(dt, err, collapse='mean', clip=3, weights=None):
         combined data and its error
     """
 
+    dt = np.asarray(dt)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
 
@@ -145,6 +226,10 @@ def combine_frames(dt, err, collapse='mean', clip=3, weights=None):
             master = np.ma.average(dt_masked, axis=0, weights=weights).data
             master_err = np.sqrt(np.nansum(np.square(err), axis=0))/np.sum(~(dt_masked.mask), axis=0)
 
+    # keep the precision of the input data
+    dtype = np.result_type(dt, np.float32)
+    master = np.asarray(master, dtype=dtype)
+    master_err = np.asarray(master_err, dtype=dtype)
 
     return master, master_err
 
@@ -281,6 +366,7 @@ def align_jitter(dt, err, pix_shift, tw=None, debug=False):
     return dt_shift, err_shift
 
 
+@timed
 def order_trace(det, badpix, slitlen, sub_factor=64, 
                 poly_order=2, offset=0, debug=False):
     """
@@ -466,6 +552,8 @@ def measure_Gaussian_center(y, peaks, width):
     # avoid the peaks near the edges
     peaks = peaks[(peaks<(len(xx)-width)) & (peaks>(width))]
 
+    from astropy.modeling import models, fitting
+
     gg_init = models.Gaussian1D(amplitude=1, mean=0, stddev=1.) \
                 + models.Const1D(amplitude=0)
     fitter = fitting.LevMarLSQFitter()
@@ -484,6 +572,7 @@ def measure_Gaussian_center(y, peaks, width):
         # plt.show()
     return center
 
+@timed
 def slit_curve(fpet, une, badpix, trace, wlen_min, wlen_max, 
                sub_factor=16, une_xcorr=False, wlen_id=None, 
                debug=False):
@@ -896,6 +985,7 @@ def slit_polyval(xx, meta):
     return slit
 
 
+@timed
 def spectral_rectify_interp(im_list, badpix, trace, slit_meta, reverse=False, debug=False):
     """
     Correct for the slit-tilt by interpolating to a pixel-grid
@@ -989,6 +1079,7 @@ def spectral_rectify_interp(im_list, badpix, trace, slit_meta, reverse=False, de
 
 
 
+@timed
 def trace_rectify_interp(im_list, trace, debug=False):
     """
     Correct for the curvature of traces by interpolating to a pixel-grid
@@ -1038,6 +1129,7 @@ def trace_rectify_interp(im_list, trace, debug=False):
     return im_rect
 
 
+@timed
 def master_flat_norm(det, badpix, trace, slit_meta, slitlen=None, debug=False):
     """
     normalize master flat frame and extract balze function
@@ -1150,6 +1242,7 @@ def extract_blaze(im, badpix, trace, f0=0.5, fw=0.48, sigma=3):
 
 
 
+@timed
 def readout_artifact(det, det_err, badpix, trace, Nborder=20, sigma=3, debug=False):
     """
     Correct for readout noise artifacts that appear like vertical strips 
@@ -1199,7 +1292,7 @@ def readout_artifact(det, det_err, badpix, trace, Nborder=20, sigma=3, debug=Fal
     err_col = np.sqrt(np.ma.sum(im_err**2, axis=0)) / np.sum(~im.mask, axis=0)
     
     det -= ron_col
-    det_err = np.sqrt(det_err**2+err_col**2)
+    det_err = np.sqrt(det_err**2+err_col**2).astype(det.dtype, copy=False)
 
     if debug:
         plt.imshow(det, vmin=-20, vmax=20)
@@ -1399,6 +1492,7 @@ def remove_starlight(D_full, V_full, spec_star, cen0_p, cen1_p,
 
 
 
+@timed
 def extract_spec(det, det_err, badpix, trace, slit, blaze, gain, NDIT=1, 
                     cen0=90, 
                     companion_sep=None, 
@@ -1519,14 +1613,15 @@ def extract_spec(det, det_err, badpix, trace, slit, blaze, gain, NDIT=1,
             obj_cen -= companion_sep
 
         # Extract a 1D spectrum using the optimal extraction algorithm
-        f_opt, f_err, D_sub, V_sub, P_sub = optimal_extraction(
-                                im_sub.T, im_err_sub.T**2, bpm_sub.T, 
-                                obj_cen=int(np.round(obj_cen)), 
-                                aper_half=aper_half, 
-                                filter_mode=filter_mode,
-                                remove_bkg=remove_star_bkg,
-                                extr_level=extr_level,
-                                gain=gain, NDIT=NDIT, debug=debug) 
+        with record('extract_spec order', cat='order', order=o):
+            f_opt, f_err, D_sub, V_sub, P_sub = optimal_extraction(
+                                    im_sub.T, im_err_sub.T**2, bpm_sub.T, 
+                                    obj_cen=int(np.round(obj_cen)), 
+                                    aper_half=aper_half, 
+                                    filter_mode=filter_mode,
+                                    remove_bkg=remove_star_bkg,
+                                    extr_level=extr_level,
+                                    gain=gain, NDIT=NDIT, debug=debug) 
 
         flux.append(f_opt/blaze[o])
         err.append(f_err/blaze[o])
@@ -1537,6 +1632,7 @@ def extract_spec(det, det_err, badpix, trace, slit, blaze, gain, NDIT=1,
     return flux, err, D, V, P 
 
         
+@timed
 def optimal_extraction(D_full, V_full, bpm_full, obj_cen, 
                        aper_half=20, filter_mode='poly',
                        badpix_clip=5, filter_width=121,
@@ -1578,15 +1674,20 @@ def optimal_extraction(D_full, V_full, bpm_full, obj_cen,
         modeled slit function and reduced chi2 of the model (for plotting)
     """
 
-    D = D_full[:,obj_cen-aper_half:obj_cen+aper_half+1] # Observation
-    V = V_full[:,obj_cen-aper_half:obj_cen+aper_half+1] # Variance
+    # the sums of the normal equations are accumulated in float64,
+    # the 2D outputs are returned in the precision of the input image
+    dtype = np.result_type(D_full, np.float32)
+    D = np.array(D_full[:,obj_cen-aper_half:obj_cen+aper_half+1], 
+                 dtype=np.float64) # Observation
+    V = np.array(V_full[:,obj_cen-aper_half:obj_cen+aper_half+1], 
+                 dtype=np.float64) # Variance
     bpm = bpm_full[:,obj_cen-aper_half:obj_cen+aper_half+1]
 
     if D.size == 0:
         # print("Trace falls outside of the detector")
         return np.zeros(D.shape[0]), np.zeros(D.shape[0]), \
-                np.zeros(D.T.shape), np.zeros(D.T.shape), \
-                np.zeros(D.T.shape)
+                np.zeros(D.T.shape, dtype), np.zeros(D.T.shape, dtype), \
+                np.zeros(D.T.shape, dtype)
 
     D = np.nan_to_num(D, nan=etol)
     V = np.nan_to_num(V, nan=1./etol)
@@ -1774,7 +1875,8 @@ def optimal_extraction(D_full, V_full, bpm_full, obj_cen,
     # Optimally extracted spectrum
     f_opt = np.sum(M_bp*P*D/V_new, axis=1) / (np.sum(M_bp*P*P/V_new, axis=1) + etol)
 
-    return f_opt, np.sqrt(var), D.T, V_new.T, P.T
+    return f_opt, np.sqrt(var), D.T.astype(dtype), \
+            V_new.T.astype(dtype), P.T.astype(dtype)
 
 
 
@@ -1811,6 +1913,7 @@ def func_wlen_optimization(poly, *args):
     return correlation
 
 
+@timed
 def wlen_solution(fluxes, errs, w_init, transm_spec, order=2,
                   p_range=[0.5, 0.05, 0.01],
                 cont_smooth_len=101,
@@ -1884,11 +1987,12 @@ def wlen_solution(fluxes, errs, w_init, transm_spec, order=2,
         if np.std(transm_spec[:,1][index_o]) > minimum_strength: 
             
             # Use scipy.optimize to find the best-fitting coefficients
-            res = optimize.minimize(
-                        func_wlen_optimization, 
-                        args=(w, f, template_interp_func), 
-                        x0=np.zeros(order+1), method='Nelder-Mead', tol=1e-8, 
-                        bounds=bound) 
+            with record('wlen_solution order', cat='order', order=o):
+                res = optimize.minimize(
+                            func_wlen_optimization, 
+                            args=(w, f, template_interp_func), 
+                            x0=np.zeros(order+1), method='Nelder-Mead', tol=1e-8, 
+                            bounds=bound) 
             poly_opt = res.x
 
             result = [f'{item:.6f}' for item in poly_opt]
@@ -1932,7 +2036,8 @@ def SpecConvolve(in_wlen, in_flux, out_res, in_res=1e6, verbose=False):
     in_wlen: array 
         input wavelength array 
     in_flux: array
-        input flux at high resolution
+        input flux at high resolution, either 1D or a batch of spectra 
+        in 2D shape (N_spec x N_pixel)
     out_res: int
         output resolution (low)
     in_res: int 
@@ -1945,22 +2050,19 @@ def SpecConvolve(in_wlen, in_flux, out_res, in_res=1e6, verbose=False):
 
     flux_LSF: array
         Convolved spectrum
+
+    See Also
+    --------
+    :func:`excalibuhr.utils.convolve_loglambda`
     """
     
-    # delta lambda of resolution element is FWHM of the LSF's standard deviation:
-    sigma_LSF = np.sqrt(1./out_res**2-1./in_res**2)/(2.*np.sqrt(2.*np.log(2.)))
-
-    spacing = np.mean(2.*np.diff(in_wlen)/ \
-      (in_wlen[1:]+in_wlen[:-1]))
-
-    # Calculate the sigma to be used in the gauss filter in pixels
-    sigma_LSF_gauss_filter = sigma_LSF/spacing
+    flux_LSF = convolve_loglambda(in_wlen, in_flux, out_res, in_res=in_res)
 
-    flux_LSF = ndimage.gaussian_filter(in_flux, \
-                               sigma = sigma_LSF_gauss_filter, \
-                               mode = 'nearest')
     if verbose:
-        print("Guassian filter sigma = {} pix".format(sigma_LSF_gauss_filter))
+        # delta lambda of resolution element is FWHM of the LSF's standard deviation:
+        sigma_LSF = np.sqrt(1./out_res**2-1./in_res**2)/(2.*np.sqrt(2.*np.log(2.)))
+        spacing = np.median(np.diff(np.log(in_wlen)))
+        print("Guassian filter sigma = {} pix".format(sigma_LSF/spacing))
     return flux_LSF
 
 
@@ -1975,47 +2077,29 @@ def SpecConvolve_GL(in_wlen, in_flux, out_res, gamma, in_res=1e6):
     in_wlen: array 
         input wavelength array 
     in_flux: array
-        input flux at high resolution
+        input flux at high resolution, either 1D or a batch of spectra 
+        in 2D shape (N_spec x N_pixel)
     out_res: int
         output resolution (low)
     gamma: float
-        the scale parameter of a Lorentzian profile 
+        the scale parameter of a Lorentzian profile in pixels
     in_res: int 
         input resolution (high) R~w/dw
-    verbose: bool
-        if True, print out the sigma of Gaussian filter used
     
     Returns
     ----------
 
     flux_V: array
         Convolved spectrum
-    """
 
-    def G(x, sigma):
-        """ Return Gaussian line shape wth sigma """
-        return 1./ np.sqrt(2. * np.pi) / sigma\
-                                * np.exp(-(x / sigma)**2 / 2.)
-
-    def L(x, gamma):
-        """ Return Lorentzian line shape at x with HWHM gamma """
-        return gamma / np.pi / (x**2 + gamma**2)
+    See Also
+    --------
+    :func:`excalibuhr.utils.convolve_loglambda`
+    """
 
-    sigma_LSF = np.sqrt(1./out_res**2-1./in_res**2)/(2.*np.sqrt(2.*np.log(2.)))
     spacing = np.mean(2.*np.diff(in_wlen)/ (in_wlen[1:]+in_wlen[:-1]))
-
-    # Calculate the sigma to be used in the gauss filter in pixels
-    sigma_LSF_gauss_filter = sigma_LSF/spacing
-    # print(sigma_LSF_gauss_filter, out_res, in_res)
-    
-    xx = np.arange(-int(20*sigma_LSF_gauss_filter), int(20*sigma_LSF_gauss_filter+1), 1)
-    win_G = G(xx, sigma_LSF_gauss_filter)
-    if np.isclose(gamma, 0):
-        win_V = win_G
-    else:
-        win_L = L(xx, gamma)
-        win_V = signal.convolve(win_L, win_G, mode='same') / sum(win_G)
-    flux_V = signal.convolve(in_flux, win_V, mode='same') / sum(win_V)
+    flux_V = convolve_loglambda(in_wlen, in_flux, out_res, in_res=in_res, 
+                                gamma=gamma*spacing)
 
     return flux_V
 
@@ -2055,7 +2139,8 @@ def PolyfitClip(x, y, order, mask=None, clip=4., max_iter=20):
         mask = np.ones_like(x_mean, dtype=bool)
 
     x_use = x_mean[mask]
-    y_use = np.array(y)[mask]
+    # solve the normal equations in double precision
+    y_use = np.array(y, dtype=np.float64)[mask]
 
     for i in range(max_iter):
         A_matrix = np.vander(x_use, order)
@@ -2152,9 +2237,374 @@ def rot_int_cmj(wave, flux, vsini, epsilon=0.6, nr=10, ntheta=100, dif = 0.0):
 	return ns/tarea
 
 
-def get_PHOENIX_stellar_model(temp, wave_cut, logg=4.0):
+def _resample_loglambda(wave, flux, oversample=1.):
+    """
+    Resample spectra onto a uniform grid in log-wavelength
+
+    Parameters
+    ----------
+    wave: array
+        input wavelength array (monotonically increasing)
+    flux: array
+        input flux, either 1D or a batch of spectra in 2D shape
+        (N_spec x N_pixel) sharing the same wavelength grid
+    oversample: float
+        oversampling factor relative to the median log-spacing of the input
+
+    Returns
+    -------
+    lnw: array
+        uniform log-wavelength grid
+    dlnw: float
+        spacing of the log-wavelength grid
+    flux_ln: array
+        flux resampled onto the log-wavelength grid
+    """
+
+    lnw_in = np.log(wave)
+    dlnw = np.median(np.diff(lnw_in)) / oversample
+    N = int(np.floor((lnw_in[-1] - lnw_in[0]) / dlnw)) + 1
+    lnw = lnw_in[0] + np.arange(N) * dlnw
+
+    flux = np.asarray(flux)
+    if flux.ndim == 1:
+        flux_ln = np.interp(lnw, lnw_in, flux)
+    else:
+        flux_ln = np.array([np.interp(lnw, lnw_in, f) for f in flux])
+    return lnw, dlnw, flux_ln
+
+
+def _interp_from_loglambda(lnw_out, lnw, flux_ln):
+    """ Interpolate (a batch of) spectra from the log-wavelength grid
+    back to the wavelength grid `lnw_out` in log scale. """
+    if flux_ln.ndim == 1:
+        return np.interp(lnw_out, lnw, flux_ln)
+    return np.array([np.interp(lnw_out, lnw, f) for f in flux_ln])
+
+
+def _convolve_edge(flux, kernel):
+    """
+    Convolve (a batch of) spectra with a symmetric kernel along the last 
+    axis, padding the edges with the outermost values. The convolution is
+    carried out via overlap-add for kernels much shorter than the spectra,
+    and via a single FFT otherwise.
+    """
+    N_half = len(kernel)//2
+    pad = [(0, 0)] * (flux.ndim - 1) + [(N_half, N_half)]
+    flux_pad = np.pad(flux, pad, mode='edge')
+    kernel = np.reshape(kernel, (1,) * (flux.ndim - 1) + (-1,))
+    if kernel.shape[-1] * 50 < flux.shape[-1]:
+        return signal.oaconvolve(flux_pad, kernel, mode='valid', axes=-1)
+    else:
+        return signal.fftconvolve(flux_pad, kernel, mode='valid', axes=-1)
+
+
+def lsf_kernel(sigma, gamma=0., width=20.):
+    """
+    Gaussian or Voigt line spread function sampled on a pixel grid.
+
+    Parameters
+    ----------
+    sigma: float
+        standard deviation of the Gaussian in pixels
+    gamma: float
+        half width at half maximum of the Lorentzian in pixels. 
+        A Voigt profile is used if `gamma` > 0.
+    width: float
+        half width of the kernel in units of `sigma` (or `gamma` if larger)
+
+    Returns
+    -------
+    kernel: array
+        normalized kernel with an odd number of pixels
+    """
+
+    N_half = max(int(width * max(sigma, gamma)), 1)
+    xx = np.arange(-N_half, N_half+1, dtype=float)
+    if np.isclose(gamma, 0):
+        kernel = np.exp(-(xx / sigma)**2 / 2.)
+    else:
+        kernel = special.voigt_profile(xx, sigma, gamma)
+    return kernel / np.sum(kernel)
+
+
+@timed
+def convolve_loglambda(in_wlen, in_flux, out_res, in_res=1e6, gamma=0., 
+                       oversample=1., chunk_size=8192):
+    """
+    Convolve spectra to a lower resolution with a Gaussian or Voigt kernel.
+    The input, possibly irregular, wavelength grid is resampled to a uniform 
+    log-wavelength grid, on which the kernel is applied via FFT/overlap-add.
+    A wavelength-dependent resolution is handled by convolving chunks of 
+    `chunk_size` pixels with the kernel evaluated at the center of each 
+    chunk (overlap-save).
+
+    Parameters
+    ----------
+    in_wlen: array
+        input wavelength array (monotonically increasing)
+    in_flux: array
+        input flux at high resolution, either 1D or a batch of spectra 
+        in 2D shape (N_spec x N_pixel), e.g. a telluric grid or a template bank
+    out_res: float, array, or callable
+        output resolution R~w/dw. It can vary with wavelength, given 
+        either as an array evaluated at `in_wlen` or a function of wavelength.
+    in_res: float
+        input resolution (high)
+    gamma: float
+        half width at half maximum of the Lorentzian component in units 
+        of dw/w. A Voigt kernel is used if `gamma` > 0.
+    oversample: float
+        oversampling factor of the log-wavelength grid relative to 
+        the median spacing of the input
+    chunk_size: int
+        number of pixels per chunk for a wavelength-dependent resolution
+
+    Returns
+    -------
+    flux_conv: array
+        convolved spectra on the input wavelength grid
+    """
+
+    lnw, dlnw, flux_ln = _resample_loglambda(in_wlen, in_flux, 
+                                             oversample=oversample)
+
+    if callable(out_res):
+        res = np.asarray(out_res(np.exp(lnw)), dtype=float)
+    elif np.ndim(out_res) > 0:
+        res = np.interp(lnw, np.log(in_wlen), out_res)
+    else:
+        res = float(out_res)
+
+    # standard deviation of the LSF in pixels of the log-wavelength grid
+    sigma = np.sqrt(1./res**2-1./in_res**2)/(2.*np.sqrt(2.*np.log(2.)))/dlnw
+    gamma = gamma / dlnw
+
+    if np.ndim(sigma) == 0 or np.allclose(sigma, sigma[0]):
+        kernel = lsf_kernel(np.max(sigma), gamma)
+        flux_conv = _convolve_edge(flux_ln, kernel)
+    else:
+        flux_conv = np.empty_like(flux_ln, dtype=np.float64)
+        N = flux_ln.shape[-1]
+        kernel_max = lsf_kernel(np.max(sigma), gamma)
+        N_pad = len(kernel_max)//2
+        pad = [(0, 0)] * (flux_ln.ndim - 1) + [(N_pad, N_pad)]
+        flux_pad = np.pad(flux_ln, pad, mode='edge')
+        for i0 in range(0, N, chunk_size):
+            i1 = min(i0 + chunk_size, N)
+            kernel = lsf_kernel(sigma[(i0+i1)//2], gamma)
+            N_half = len(kernel)//2
+            segment = flux_pad[..., i0+N_pad-N_half:i1+N_pad+N_half]
+            kernel = np.reshape(kernel, (1,) * (flux_ln.ndim - 1) + (-1,))
+            flux_conv[..., i0:i1] = signal.fftconvolve(segment, kernel, 
+                                            mode='valid', axes=-1)
+
+    return _interp_from_loglambda(np.log(in_wlen), lnw, flux_conv)
+
+
+def rot_kernel(dlnw, vsini, epsilon=0.6):
+    """
+    Analytic rotational broadening kernel with linear limb darkening
+    (Gray 2005), integrated over the pixels of a uniform log-wavelength grid.
+
+    Parameters
+    ----------
+    dlnw: float
+        spacing of the log-wavelength grid
+    vsini: float
+        projected rotational velocity in km/s
+    epsilon: float
+        the coefficient of the linear limb darkening law
+
+    Returns
+    -------
+    kernel: array
+        normalized kernel with an odd number of pixels
+    """
+
+    def cdf(x):
+        """ Cumulative distribution of the kernel for x = v / vsini in [-1, 1] """
+        x = np.clip(x, -1., 1.)
+        c1 = 2. * (1. - epsilon) / (np.pi * (1. - epsilon/3.))
+        c2 = epsilon / (2. * (1. - epsilon/3.))
+        return c1 * (x * np.sqrt(1. - x**2) + np.arcsin(x)) / 2. \
+                + c2 * (x - x**3 / 3.) + 0.5
+
+    from astropy import constants as const
+
+    # kernel half width in units of pixels
+    x_max = vsini / const.c.to("km/s").value / dlnw
+    N_half = int(np.ceil(x_max - 0.5))
+    pix = np.arange(-N_half, N_half+1)
+    kernel = cdf((pix + 0.5) / x_max) - cdf((pix - 0.5) / x_max)
+    return kernel / np.sum(kernel)
+
+
+@timed
+def rot_broaden(wave, flux, vsini, epsilon=0.6, dif=0.0, oversample=1.):
     """
-    Get the PHOENIX stellar model.
+    Rotationally broaden a spectrum. For rigid rotation, the spectrum is
+    resampled to a uniform log-wavelength grid and convolved with the
+    analytic limb-darkened rotation kernel via FFT. With differential
+    rotation (`dif != 0`), it falls back to the disk integration
+    in `rot_int_cmj`.
+
+    Parameters
+    ----------
+    wave: array
+        wavelength array of the input spectrum
+    flux: array
+        input flux, either 1D or a batch of spectra in 2D shape
+        (N_spec x N_pixel) sharing the same wavelength grid
+    vsini: float
+        projected rotational velocity in km/s
+    epsilon: float
+        the coefficient of the linear limb darkening law
+    dif: float
+        the differential rotation coefficient, see `rot_int_cmj`
+    oversample: float
+        oversampling factor of the log-wavelength grid relative to
+        the median spacing of the input
+
+    Returns
+    -------
+    flux_rot: array
+        rotationally broadened spectrum on the input wavelength grid
+    """
+
+    if dif != 0:
+        if np.ndim(flux) == 1:
+            return rot_int_cmj(wave, flux, vsini, epsilon=epsilon, dif=dif)
+        return np.array([rot_int_cmj(wave, f, vsini, epsilon=epsilon, dif=dif)
+                         for f in flux])
+
+    lnw, dlnw, flux_ln = _resample_loglambda(wave, flux, oversample=oversample)
+    kernel = rot_kernel(dlnw, vsini, epsilon=epsilon)
+    if len(kernel) == 1:
+        # broadening narrower than one pixel
+        return np.array(flux, dtype=float)
+
+    flux_conv = _convolve_edge(flux_ln, kernel)
+    return _interp_from_loglambda(np.log(wave), lnw, flux_conv)
+
+
+PHOENIX_URL = 'https://phoenix.astro.physik.uni-goettingen.de/data/v2.0/HiResFITS/'
+PHOENIX_WAVE_FILE = 'WAVE_PHOENIX-ACES-AGSS-COND-2011.fits'
+
+# wavelength ranges (in nm) of the cropped PHOENIX models cached per band
+PHOENIX_BANDS = {
+    'Y': (850., 1250.),
+    'J': (1000., 1500.),
+    'H': (1350., 1950.),
+    'K': (1750., 2650.),
+    'L': (2650., 4300.),
+    'M': (3950., 5400.),
+}
+
+
+def get_cache_dir(cache_dir=None, subdir=None):
+    """
+    Get the directory for cached files of excalibuhr, which is 
+    `cache_dir` if given, otherwise the `EXCALIBUHR_CACHE` environment 
+    variable or `~/.cache/excalibuhr`. The directory is created if needed.
+
+    Parameters
+    ----------
+    cache_dir: str
+        path of the cache directory
+    subdir: str
+        name of the subdirectory inside the cache directory
+
+    Returns
+    -------
+    path: str
+        path of the cache directory
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('EXCALIBUHR_CACHE', 
+                    os.path.join(os.path.expanduser('~'), '.cache', 'excalibuhr'))
+    path = cache_dir if subdir is None else os.path.join(cache_dir, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def atomic_write(filename, suffix=''):
+    """
+    Context manager yielding a temporary path, unique to the process 
+    and thread, which is renamed to `filename` at the end of the block, 
+    so that concurrent readers never see a partially written file.
+    The temporary file or directory is removed if the block or the 
+    renaming fails.
+
+    Parameters
+    ----------
+    filename: str
+        path of the file or directory to write
+    suffix: str
+        extension of the temporary path, for writers appending one
+
+    Yields
+    ------
+    tmp_file: str
+        path to write to
+    """
+    tmp_file = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+    try:
+        yield tmp_file
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.isdir(tmp_file):
+            shutil.rmtree(tmp_file, ignore_errors=True)
+        elif os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _save_npy_atomic(filename, array):
+    """ Save an array to .npy via a temporary file, so that concurrent
+    readers never see a partially written file. """
+    with atomic_write(filename) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+
+
+def _get_PHOENIX_file(filename, cache_dir, model_dir=None, subpath=''):
+    """
+    Locate a PHOENIX file in the local model directory, or download it 
+    from the Göttingen server to the cache directory if not present.
+    """
+
+    if model_dir is not None:
+        for path in [os.path.join(model_dir, filename), 
+                     os.path.join(model_dir, subpath, filename)]:
+            if os.path.isfile(path):
+                return path
+        raise FileNotFoundError(
+            f"PHOENIX file {filename} not found in the model directory {model_dir}")
+
+    file_local = os.path.join(cache_dir, filename)
+    if not os.path.isfile(file_local):
+        import requests
+
+        print(f"Downloading {filename}")
+        r = requests.get(PHOENIX_URL + subpath + filename)
+        r.raise_for_status()
+        with atomic_write(file_local) as tmp_file:
+            with open(tmp_file, "wb") as f:
+                f.write(r.content)
+        print("[DONE]")
+    return file_local
+
+
+def get_PHOENIX_stellar_model(temp, wave_cut, logg=4.0, 
+                              cache_dir=None, model_dir=None):
+    """
+    Get the PHOENIX stellar model. 
+    
+    The HiRes model is cropped to the band covering `wave_cut` and cached 
+    as float32 arrays in `cache_dir`, which are memory-mapped in 
+    subsequent calls. 
 
     Parameters
     ----------
@@ -2164,6 +2614,12 @@ def get_PHOENIX_stellar_model(temp, wave_cut, logg=4.0):
         The wavelength range to use for the stellar model.
     logg: float
         The surface gravity of the standard star.
+    cache_dir: str
+        Path of the cache directory. By default, it is 
+        `$EXCALIBUHR_CACHE/phoenix` or `~/.cache/excalibuhr/phoenix`.
+    model_dir: str
+        Local directory containing the PHOENIX HiRes models and the
+        wavelength file, used instead of downloading from the server.
 
     Returns
     -------
@@ -2173,28 +2629,52 @@ def get_PHOENIX_stellar_model(temp, wave_cut, logg=4.0):
         The flux of the stellar model.
     """
 
-    src_path = os.path.dirname(os.path.abspath(__file__))
-    wave_file = os.path.join(src_path, '../../data/WAVE_PHOENIX-ACES-AGSS-COND-2011.fits')
-    wave = fits.getdata(wave_file) * 1e-1 #nm
-
-    url = 'https://phoenix.astro.physik.uni-goettingen.de/data/v2.0/HiResFITS/PHOENIX-ACES-AGSS-COND-2011/Z-0.0/' 
-    filename = f'lte{temp:05d}-{logg:.2f}-0.0.PHOENIX-ACES-AGSS-COND-2011-HiRes.fits'
-    if not os.path.isfile(filename):
-        print(f"Downloading PHOENIX stellar model T={temp} K")
-        r = requests.get(url+filename)
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        print("[DONE]")
-    flux = fits.getdata(filename)  #'erg/s/cm^2/cm'
-    indices = (wave > wave_cut[0]) & (wave < wave_cut[1])
-    f = flux[indices]/np.median(flux[indices])
-    w = wave[indices]
+    cache_dir = get_cache_dir(cache_dir, 'phoenix')
+
+    # find the band containing the requested wavelength range
+    band = None
+    for key, (w0, w1) in PHOENIX_BANDS.items():
+        if wave_cut[0] >= w0 and wave_cut[1] <= w1:
+            if band is None or (w1-w0) < np.diff(PHOENIX_BANDS[band])[0]:
+                band = key
+    if band is None:
+        w0 = np.floor(wave_cut[0]/100.)*100.
+        w1 = np.ceil(wave_cut[1]/100.)*100.
+        band = f"{w0:.0f}-{w1:.0f}"
+    else:
+        w0, w1 = PHOENIX_BANDS[band]
+
+    name = f'lte{temp:05d}-{logg:.2f}-0.0.PHOENIX-ACES-AGSS-COND-2011-HiRes'
+    wave_cache = os.path.join(cache_dir, f'WAVE_{band}.npy')
+    flux_cache = os.path.join(cache_dir, f'{name}_{band}.npy')
+
+    if not (os.path.isfile(wave_cache) and os.path.isfile(flux_cache)):
+        wave_file = _get_PHOENIX_file(PHOENIX_WAVE_FILE, cache_dir, model_dir)
+        wave = fits.getdata(wave_file) * 1e-1 #nm
+        indices = (wave > w0) & (wave < w1)
+        if not os.path.isfile(wave_cache):
+            _save_npy_atomic(wave_cache, wave[indices].astype(np.float64))
+
+        model_file = _get_PHOENIX_file(f'{name}.fits', cache_dir, model_dir, 
+                            subpath='PHOENIX-ACES-AGSS-COND-2011/Z-0.0/')
+        flux = fits.getdata(model_file)  #'erg/s/cm^2/cm'
+        _save_npy_atomic(flux_cache, flux[indices].astype(np.float32))
+
+    wave = np.load(wave_cache, mmap_mode='r')
+    flux = np.load(flux_cache, mmap_mode='r')
+
+    i0 = np.searchsorted(wave, wave_cut[0], side='right')
+    i1 = np.searchsorted(wave, wave_cut[1], side='left')
+    f = flux[i0:i1]/np.median(flux[i0:i1])
+    w = np.array(wave[i0:i1])
 
     return w, f
 
 
+@timed
 def instrument_response(std, tellu, temp, vsini, vsys=0., 
-                        mask_wave=[], debug=False):
+                        mask_wave=[], cache_dir=None, model_dir=None, 
+                        debug=False):
     """
     Method for calibrating spectral shape using standard star observations.
 
@@ -2214,15 +2694,23 @@ def instrument_response(std, tellu, temp, vsini, vsys=0.,
         list of lower and upper limit for wavelength ranges (in nm) that need to 
         be masked when estimating the isntrument response.
         They are usually Hydrogen lines of the stellar spectrum.
+    cache_dir: str
+        cache directory of the PHOENIX models, see `get_PHOENIX_stellar_model`
+    model_dir: str
+        local directory of the PHOENIX models, see `get_PHOENIX_stellar_model`
     """
 
+    from astropy import constants as const
+
     wave, flux, _ = std.get_spec1d()
     tellu = interp1d(tellu[:,0], tellu[:,1])(wave)
 
     # get phoenix stellar model
-    wave_model, flux_model = get_PHOENIX_stellar_model(temp, wave_cut=[wave[0]-100, wave[-1]+100])
+    wave_model, flux_model = get_PHOENIX_stellar_model(temp, 
+                                wave_cut=[wave[0]-100, wave[-1]+100],
+                                cache_dir=cache_dir, model_dir=model_dir)
     # rotationally broaden and rv shift
-    flux_model = rot_int_cmj(wave_model, flux_model, vsini)
+    flux_model = rot_broaden(wave_model, flux_model, vsini)
     w_shift = wave * (1. - vsys/const.c.to("km/s").value)
     flux_model_interp = interp1d(wave_model, flux_model)(w_shift)
 
@@ -2471,9 +2959,182 @@ def create_eso_recipe_config(eso_recipe, outpath, verbose):
             print(" [DONE]")
 
 
-def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
+def read_molecfit_params(best_params):
     """
-    A wrapper of molecfit for telluric correction
+    Collect the best-fit parameters of a molecfit run into a dictionary.
+
+    Parameters
+    ----------
+    best_params : str or list
+        the `BEST_FIT_PARAMETERS.fits` file written by `molecfit_model`,
+        or the rows of its table.
+
+    Returns
+    -------
+    params: dict
+        best-fit value of each parameter, keyed by parameter name.
+    """
+
+    if isinstance(best_params, str):
+        best_params = fits.getdata(best_params, 1).tolist()
+
+    params = {}
+    for row in best_params:
+        try:
+            params[str(row[0]).strip()] = float(row[1])
+        except (TypeError, ValueError):
+            continue
+    return params
+
+
+def warm_start_config(config_file, params, outfile):
+    """
+    Write a `molecfit_model` configuration seeded with the best-fit 
+    parameters of a previous fit. The relative molecular columns start 
+    from the previous solution and the line spread function is fixed 
+    to the previous kernel, so that the fit only needs to adjust 
+    the molecular abundances and continuum.
+
+    Parameters
+    ----------
+    config_file : str
+        the default `molecfit_model.rc` file.
+    params: dict
+        best-fit parameters of the previous fit, 
+        see :func:`read_molecfit_params`.
+    outfile : str
+        path to save the seeded configuration.
+
+    Returns
+    -------
+    NoneType
+        None
+    """
+
+    with open(config_file, "r", encoding="utf-8") as open_config:
+        config_text = open_config.read()
+
+    def _set(key, value):
+        return re.sub(rf"^((?:\S+\.)?{key})=.*$", rf"\g<1>={value}", 
+                      config_text, flags=re.MULTILINE)
+
+    # seed the relative column densities
+    list_molec = re.search(r"^(?:\S+\.)?LIST_MOLEC=(.*)$", 
+                           config_text, flags=re.MULTILINE)
+    if list_molec is not None:
+        molecs = list_molec.group(1).strip().split(',')
+        rel_col = [params.get(f"rel_mol_col_{mol}", 1.0) for mol in molecs]
+        config_text = _set("REL_COL", ",".join(f"{c:.6g}" for c in rel_col))
+
+    # fix the kernel to the previous solution
+    for key, par in zip(["RES_GAUSS", "RES_LORENTZ"], 
+                        ["gaussfwhm", "lorentzfwhm"]):
+        if par in params:
+            config_text = _set(key, f"{params[par]:.6g}")
+            config_text = _set(f"FIT_{key}", "FALSE")
+
+    with open(outfile, "w", encoding="utf-8") as open_config:
+        open_config.write(config_text)
+
+
+MOLECFIT_CACHE_SIZE = 2000 # MB
+
+# Files written by the molecfit recipes, which are stored in the cache
+MOLECFIT_OUTPUTS = ['ATM_PARAMETERS.fits', 'MODEL_MOLECULES.fits', 
+                    'BEST_FIT_*.fits', 'LBLRTM_RESULTS.fits', 'TELLURIC_*.fits', 
+                    'SCIENCE_TELLURIC_CORR_*.fits', 'SPECTRUM_TELLURIC_CORR_*.fits']
+
+
+@functools.lru_cache(maxsize=None)
+def _esorex_version():
+    """ Version string of the installed `EsoRex`. """
+    out = subprocess.run(["esorex", "--version"], capture_output=True, text=True)
+    return out.stdout.strip()
+
+
+def _molecfit_cache_key(spec, wave_range, config_files):
+    """
+    Hash of everything that determines the result of a molecfit run: 
+    the input spectrum, the fitted wavelength ranges, the recipe 
+    configurations, and the version of `EsoRex`.
+    """
+
+    sha = hashlib.sha256()
+    for arr in [spec.wlen, spec.flux, spec.err]:
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    if spec.header is not None:
+        sha.update(spec.header.tostring().encode())
+    sha.update(repr(wave_range).encode())
+    for config_file in config_files:
+        with open(config_file, "rb") as open_config:
+            sha.update(open_config.read())
+    sha.update(_esorex_version().encode())
+    return sha.hexdigest()
+
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def _evict_cache(cache_path, max_size):
+    """
+    Remove the least recently used entries of the cache 
+    until its total size is below `max_size` (in MB).
+    """
+
+    entries = []
+    for key in os.listdir(cache_path):
+        path = os.path.join(cache_path, key)
+        if os.path.isdir(path) and not key.endswith('.tmp'):
+            entries.append((os.path.getmtime(path), _dir_size(path), path))
+    total = sum(e[1] for e in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size * 1e6:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _molecfit_cache_load(cache_path, key, input_path):
+    """ Copy the cached molecfit outputs to `input_path` if available. """
+
+    entry = os.path.join(cache_path, key)
+    if not os.path.isdir(entry):
+        return False
+    for f in os.listdir(entry):
+        shutil.copy(os.path.join(entry, f), input_path)
+    # mark the entry as recently used
+    os.utime(entry)
+    return True
+
+
+def _molecfit_cache_store(cache_path, key, files, max_size):
+    """ Store the molecfit outputs in the cache and apply the size limit. """
+
+    entry = os.path.join(cache_path, key)
+    if os.path.isdir(entry):
+        return
+    try:
+        with atomic_write(entry) as tmp_entry:
+            os.makedirs(tmp_entry, exist_ok=True)
+            for f in files:
+                shutil.copy(f, tmp_entry)
+    except OSError:
+        # stored concurrently by another process
+        pass
+    _evict_cache(cache_path, max_size)
+
+
+@timed
+def molecfit(input_path, spec, wave_range=None, savename=None, 
+             config_path=None, init_params=None, use_cache=True, 
+             cache_dir=None, cache_size=MOLECFIT_CACHE_SIZE, verbose=False):
+    """
+    A wrapper of molecfit for telluric correction. All input and output 
+    files are written to `input_path`, so that fits in different working 
+    directories can run concurrently.
 
     Parameters
     ----------
@@ -2485,6 +3146,21 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
         list of wavelength regions to be indcluded for the telluric fitting
     savename : str
         the filename for the input files and fitting results.
+    config_path : str
+        the directory of the recipe configuration files, which are created 
+        if not existing. By default, the same as `input_path`.
+    init_params : dict
+        best-fit parameters of a previous fit used to warm start 
+        the fitting, see :func:`warm_start_config`.
+    use_cache : bool
+        Reuse the outputs of a previous run with identical input spectrum, 
+        `wave_range`, recipe configurations and `EsoRex` version.
+    cache_dir : str
+        the cache directory, see :func:`get_cache_dir`. 
+        Results are stored in its `molecfit` subfolder. 
+    cache_size : float
+        size limit of the cache in MB. The least recently used results 
+        are removed when the limit is exceeded.
     verbose : bool
         Print output produced by ``esorex``.
 
@@ -2496,6 +3172,27 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
     
     if savename is None:
         savename = "SCIENCE.fits"
+    if config_path is None:
+        config_path = input_path
+
+    config_files = {}
+    for eso_recipe in ["molecfit_model", "molecfit_calctrans", "molecfit_correct"]:
+        create_eso_recipe_config(eso_recipe, config_path, verbose=verbose)
+        config_files[eso_recipe] = os.path.join(config_path, f"{eso_recipe}.rc")
+    if init_params is not None:
+        config_file = os.path.join(input_path, "molecfit_model_init.rc")
+        warm_start_config(config_files["molecfit_model"], init_params, config_file)
+        config_files["molecfit_model"] = config_file
+
+    if use_cache:
+        cache_path = get_cache_dir(cache_dir, 'molecfit')
+        cache_key = _molecfit_cache_key(spec, wave_range, config_files.values())
+        if _molecfit_cache_load(cache_path, cache_key, input_path):
+            print("Molecfit results loaded from cache")
+            return
+        # files of earlier runs left in the folder are not cached
+        files_before = {f: os.path.getmtime(os.path.join(input_path, f)) 
+                        for f in os.listdir(input_path)}
 
     primary_hdu = fits.PrimaryHDU(header=spec.header)
 
@@ -2589,8 +3286,7 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
         sof_open.write(f'{file_science} SCIENCE\n')
         sof_open.write(f'{file_wave_inc} WAVE_INCLUDE\n')
 
-    create_eso_recipe_config("molecfit_model", input_path, verbose=verbose)
-    config_file = os.path.join(input_path, "molecfit_model.rc")
+    config_file = config_files["molecfit_model"]
 
     esorex = [
         "esorex",
@@ -2624,8 +3320,7 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
         sof_open.write(f'{file_mol} MODEL_MOLECULES\n')
         sof_open.write(f'{file_best_par} BEST_FIT_PARAMETERS\n')
 
-    create_eso_recipe_config("molecfit_calctrans", input_path, verbose=verbose)
-    config_file = os.path.join(input_path, "molecfit_calctrans.rc")
+    config_file = config_files["molecfit_calctrans"]
 
     esorex = [
         "esorex",
@@ -2654,8 +3349,7 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
         sof_open.write(f"{file_map_corr} MAPPING_CORRECT\n")
         sof_open.write(f"{file_tellu_corr} TELLURIC_CORR\n")
 
-    create_eso_recipe_config("molecfit_correct", input_path, verbose=verbose)
-    config_file = os.path.join(input_path, "molecfit_correct.rc")
+    config_file = config_files["molecfit_correct"]
 
     esorex = [
         "esorex",
@@ -2676,6 +3370,12 @@ def molecfit(input_path, spec, wave_range=None, savename=None, verbose=False):
     if not verbose:
         print(" [DONE]")
 
+    if use_cache:
+        file_outputs = [os.path.join(input_path, f) for f in os.listdir(input_path)
+                        if any(fnmatch.fnmatch(f, p) for p in MOLECFIT_OUTPUTS) and 
+                        files_before.get(f) != os.path.getmtime(os.path.join(input_path, f))]
+        _molecfit_cache_store(cache_path, cache_key, file_outputs, cache_size)
+
 
 
 
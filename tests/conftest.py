@@ -0,0 +1,63 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# run the tests against the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+def _lzw_compress(data, maxbits=16, block_mode=True, clear_after=None):
+    """
+    Reference encoder of the unix `compress` format: LZW codes growing
+    from 9 to `maxbits` bits, written in groups of 8 codes padded when
+    the width changes or the table is cleared. In block mode, the table
+    is cleared after every `clear_after` codes.
+    """
+    first = 257 if block_mode else 256
+    segments, codes = [], []
+    table = {bytes([i]): i for i in range(256)}
+    n_bits, free, n_codes = 9, first, 0
+    w = data[:1]
+    for b in data[1:]:
+        wc = w + bytes([b])
+        if wc in table:
+            w = wc
+            continue
+        codes.append(table[w])
+        n_codes += 1
+        if free < (1 << maxbits):
+            table[wc] = free
+            free += 1
+        w = bytes([b])
+        if block_mode and clear_after is not None and n_codes % clear_after == 0:
+            codes.append(256)
+            segments.append((n_bits, codes))
+            codes = []
+            table = {bytes([i]): i for i in range(256)}
+            n_bits, free = 9, first
+        elif free > (1 << n_bits) and n_bits < maxbits:
+            segments.append((n_bits, codes))
+            codes = []
+            n_bits += 1
+    if w:
+        codes.append(table[w])
+    segments.append((n_bits, codes))
+
+    bits = []
+    for i, (n_bits, codes) in enumerate(segments):
+        codes = np.array(codes, dtype=np.int64)
+        seg = ((codes[:, None] >> np.arange(n_bits)) & 1).astype(np.uint8).ravel()
+        if i < len(segments) - 1:
+            # the rest of the group of 8 codes is skipped
+            seg = np.append(seg, np.zeros(-len(seg) % (8 * n_bits), np.uint8))
+        bits.append(seg)
+    bits = np.concatenate(bits)
+    bits = np.append(bits, np.zeros(-len(bits) % 8, np.uint8))
+    body = np.packbits(bits, bitorder='little').tobytes()
+    return bytes([0x1f, 0x9d, (0x80 if block_mode else 0) | maxbits]) + body
+
+
+@pytest.fixture
+def lzw_compress():
+    return _lzw_compress
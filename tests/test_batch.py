@@ -0,0 +1,67 @@
+import io
+import sys
+import gzip
+import json
+import numpy as np
+import pytest
+from astropy.io import fits
+from excalibuhr.batch import BatchRunner, estimate_memory
+
+
+def _raw_bytes(shape=(32, 48)):
+    # primary header without data, and one extension per detector
+    hdul = fits.HDUList([fits.PrimaryHDU()] +
+                        [fits.ImageHDU(np.zeros(shape, dtype=np.float32),
+                                       name=f'CHIP{i}.INT1')
+                         for i in range(1, 4)])
+    f = io.BytesIO()
+    hdul.writeto(f)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('ext', ['.fits', '.fits.Z', '.fits.gz'])
+def test_estimate_memory(tmp_path, lzw_compress, ext):
+    content = _raw_bytes()
+    for i in range(2):
+        filename = tmp_path / f'CRIRE.{i}{ext}'
+        if ext == '.fits.Z':
+            filename.write_bytes(lzw_compress(content))
+        elif ext == '.fits.gz':
+            filename.write_bytes(gzip.compress(content))
+        else:
+            filename.write_bytes(content)
+    memory = estimate_memory(str(tmp_path), max_stack=16, overhead=6)
+    assert memory == pytest.approx(3 * 32 * 48 * 8 * (2 + 6) / 1024**3)
+
+
+def test_estimate_memory_fallback(tmp_path):
+    (tmp_path / 'CRIRE.0.fits.Z').write_bytes(b'\x1f\x9d\x90corrupt')
+    with pytest.warns(UserWarning, match="Cannot read the size"):
+        memory = estimate_memory(str(tmp_path), n_pixel=2048, n_det=3)
+    assert memory == pytest.approx(3 * 2048**2 * 8 * (1 + 6) / 1024**3)
+    # no frames yet
+    memory = estimate_memory(str(tmp_path / 'missing'))
+    assert memory == pytest.approx(3 * 2048**2 * 8 * (16 + 6) / 1024**3)
+
+
+def test_batch_output(tmp_path):
+    stdin = sys.stdin
+    seen = []
+
+    def step(ppl):
+        seen.append(sys.stdin)
+        print(f"reducing {ppl.night}")
+
+    for night in ['night1', 'night2']:
+        (tmp_path / night / 'raw').mkdir(parents=True)
+    runner = BatchRunner(str(tmp_path), ['night1', 'night2'], steps=[step],
+                         num_processes=1, max_nights=2, qa_plots='off')
+    results = runner.run()
+    assert [res['status'] for res in results] == ['done', 'done']
+    # the input of the host program is left untouched
+    assert seen == [stdin, stdin] and sys.stdin is stdin
+    for night in ['night1', 'night2']:
+        with open(tmp_path / night / 'batch.log') as f:
+            assert f"reducing {night}" in f.read()
+    with open(tmp_path / 'batch_summary.json') as f:
+        assert len(json.load(f)['nights']) == 2
@@ -0,0 +1,146 @@
+import io
+import gzip
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from astropy.io import fits
+import excalibuhr.compress as cp
+
+
+def _text(n_words=20000, seed=0):
+    # compressible data mixed with random bytes, giving long and short strings
+    rng = np.random.default_rng(seed)
+    words = [bytes(rng.integers(97, 123, rng.integers(2, 8), dtype=np.uint8))
+             for _ in range(300)]
+    text = b' '.join(words[i] for i in rng.integers(0, 300, n_words))
+    return text + rng.integers(0, 256, 5000, dtype=np.uint8).tobytes()
+
+
+def _fits_bytes():
+    data = np.arange(64 * 64, dtype=np.float32).reshape(64, 64)
+    primary = fits.PrimaryHDU()
+    primary.header['OBJECT'] = 'TEST'
+    hdul = fits.HDUList([primary, fits.ImageHDU(data, name='CHIP1.INT1')])
+    f = io.BytesIO()
+    hdul.writeto(f)
+    return f.getvalue()
+
+
+# widths from 9 to 12 bits then a full table; 9 and 10 bits then a full
+# table; widths up to 16 bits; the table cleared in block mode; no block mode
+LZW_CASES = [dict(maxbits=12), dict(maxbits=10), dict(maxbits=16),
+             dict(maxbits=16, clear_after=3000),
+             dict(maxbits=12, clear_after=5000),
+             dict(maxbits=12, block_mode=False)]
+
+
+@pytest.mark.parametrize('kwargs', LZW_CASES)
+def test_lzw_roundtrip(tmp_path, monkeypatch, lzw_compress, kwargs):
+    data = _text()
+    filename = tmp_path / 'file.Z'
+    filename.write_bytes(lzw_compress(data, **kwargs))
+    assert b''.join(cp.iter_decompress(str(filename))) == data
+    # the codes decoded in several batches give the same content
+    monkeypatch.setattr(cp, 'CODE_BATCH', 1000)
+    chunks = list(cp.iter_decompress(str(filename)))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == data
+
+
+@pytest.mark.skipif(shutil.which('gzip') is None, reason="no gzip")
+@pytest.mark.parametrize('kwargs', LZW_CASES)
+def test_lzw_reference(lzw_compress, kwargs):
+    # the fixtures are checked against an independent decoder
+    data = _text()
+    out = subprocess.run(['gzip', '-dc'], input=lzw_compress(data, **kwargs),
+                         capture_output=True, check=True).stdout
+    assert out == data
+
+
+def test_lzw_corrupt():
+    with pytest.raises(ValueError):
+        list(cp._iter_lzw(b'\x1f\x9d\x90' + bytes([0xff, 0xff, 0xff])))
+    with pytest.raises(ValueError):
+        list(cp._iter_lzw(b'\x1f\x9d\x91\x00'))
+
+
+def test_gzip_multi_member(tmp_path, monkeypatch):
+    data = _text()
+    filename = tmp_path / 'file.gz'
+    filename.write_bytes(gzip.compress(data[:50000]) +
+                         gzip.compress(data[50000:]))
+    monkeypatch.setattr(cp, 'CHUNK_SIZE', 4096)
+    assert b''.join(cp.iter_decompress(str(filename))) == data
+
+
+@pytest.mark.parametrize('ext', ['.Z', '.gz'])
+def test_read_header(tmp_path, lzw_compress, ext):
+    content = _fits_bytes()
+    filename = tmp_path / f'raw.fits{ext}'
+    if ext == '.Z':
+        filename.write_bytes(lzw_compress(content))
+    else:
+        filename.write_bytes(gzip.compress(content))
+    header = cp.read_header(str(filename))
+    assert header['OBJECT'] == 'TEST'
+    assert header['NAXIS'] == 0
+
+    not_fits = tmp_path / 'text.gz'
+    not_fits.write_bytes(gzip.compress(b'no header'))
+    with pytest.raises(OSError):
+        cp.read_header(str(not_fits))
+
+
+@pytest.mark.parametrize('ext', ['.Z', '.gz'])
+def test_read_headers(tmp_path, monkeypatch, lzw_compress, ext):
+    content = _fits_bytes()
+    filename = tmp_path / f'raw.fits{ext}'
+    if ext == '.Z':
+        filename.write_bytes(lzw_compress(content))
+    else:
+        filename.write_bytes(gzip.compress(content))
+    # headers and data split over several chunks
+    monkeypatch.setattr(cp, 'CODE_BATCH', 100)
+    monkeypatch.setattr(cp, 'CHUNK_SIZE', 100)
+    headers = cp.read_headers(str(filename))
+    assert [h.get('EXTNAME') for h in headers] == [None, 'CHIP1.INT1']
+    assert headers[1]['NAXIS1'] == 64
+
+
+def test_decompress_files(tmp_path, lzw_compress):
+    content = _fits_bytes()
+    good = [tmp_path / 'a.fits.Z', tmp_path / 'b.fits.gz']
+    good[0].write_bytes(lzw_compress(content))
+    good[1].write_bytes(gzip.compress(content))
+    bad = tmp_path / 'c.fits.Z'
+    bad.write_bytes(b'not compressed')
+
+    headers = {}
+    def on_header(output, header):
+        headers[output] = header['OBJECT']
+
+    files = [str(good[0]), str(bad), str(good[1])]
+    with pytest.warns(UserWarning, match="Failed to decompress"):
+        outputs = cp.decompress_files(files, on_header=on_header)
+    assert outputs == [str(tmp_path / 'a.fits'), str(tmp_path / 'b.fits')]
+    assert headers == {output: 'TEST' for output in outputs}
+    for output in outputs:
+        with open(output, 'rb') as f:
+            assert f.read() == content
+    # the compressed files are removed, except the failing one
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['a.fits', 'b.fits', 'c.fits.Z']
+
+
+def test_decompress_file_keep(tmp_path):
+    content = _fits_bytes()
+    filename = tmp_path / 'a.fits.gz'
+    filename.write_bytes(gzip.compress(content))
+    output = cp.decompress_file(str(filename), output=str(tmp_path / 'b.fits'),
+                                remove=False)
+    assert filename.exists()
+    with open(output, 'rb') as f:
+        assert f.read() == content
+    with pytest.raises(ValueError):
+        cp.decompress_file(str(tmp_path / 'b.fits'))
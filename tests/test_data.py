@@ -0,0 +1,60 @@
+import gc
+import mmap
+import numpy as np
+import pytest
+from excalibuhr.data import SERIES, SPEC, wfits
+
+
+@pytest.fixture
+def series_file(tmp_path):
+    """ series of 5 frames with the chips unsorted, and their sorted data """
+    rng = np.random.default_rng(0)
+    order = [2, 0, 3, 1]
+    wlen = 1000. + 50. * np.arange(4)[:, None] + np.linspace(0, 40, 30)[None]
+    flux = rng.normal(size=(5, 4, 30))
+    err = rng.uniform(0.1, 0.2, size=(5, 4, 30))
+    filename = str(tmp_path / 'series.fits')
+    wfits(filename, ext_list={'FLUX': flux[:, order], 'FLUX_ERR': err[:, order],
+                              'WAVE': wlen[order]})
+    return filename, wlen, flux, err
+
+
+@pytest.mark.parametrize("lazy", [True, False])
+def test_series_frames(series_file, lazy):
+    filename, wlen, flux, err = series_file
+    with SERIES(filename=filename, lazy=lazy) as series:
+        assert len(series) == 5
+        np.testing.assert_array_equal(series.wlen, wlen)
+        for i in range(5):
+            np.testing.assert_array_equal(series[i].flux, flux[i])
+            np.testing.assert_array_equal(series[i].err, err[i])
+        spec = series[3, [2, 0]]
+        np.testing.assert_array_equal(spec.flux, flux[3, [2, 0]])
+        np.testing.assert_array_equal(spec.wlen, wlen[[2, 0]])
+        spec = series[1, 3]
+        np.testing.assert_array_equal(spec.err, err[1, [3]])
+        sub = series[1:4, 1:3]
+        np.testing.assert_array_equal(sub.flux, flux[1:4, 1:3])
+        np.testing.assert_array_equal(series.flux, flux)
+
+
+def test_series_closed_when_deleted(series_file):
+    series = SERIES(filename=series_file[0])
+    hdul = series._hdul
+    series[0]
+    del series
+    gc.collect()
+    assert hdul._file.closed
+
+
+def test_spec_memory_mapped(tmp_path):
+    wlen = 1000. + 50. * np.arange(3)[:, None] + np.linspace(0, 40, 30)[None]
+    filename = str(tmp_path / 'spec.fits')
+    wfits(filename, ext_list={'FLUX': np.ones((3, 30)), 
+                              'FLUX_ERR': np.ones((3, 30)), 'WAVE': wlen})
+    spec = SPEC(filename=filename)
+    base = spec.flux
+    while isinstance(base, np.ndarray):
+        base = base.base
+    assert isinstance(base, mmap.mmap)
+    np.testing.assert_array_equal(spec.wlen, wlen)
@@ -0,0 +1,44 @@
+import os
+import shutil
+import pandas as pd
+import pytest
+from astropy.io import fits
+import matplotlib
+matplotlib.use('Agg')
+from excalibuhr.synthetic import make_night
+from excalibuhr.archive import LocalArchive
+from excalibuhr.pipeline import CriresPipeline
+
+
+@pytest.fixture
+def ppl(tmp_path):
+    mirror = str(tmp_path / 'mirror')
+    make_night(mirror, n_pixel=512, n_cycles=1, seed=3)
+
+    # the night lacks the darks of the lamp frames
+    rawpath = tmp_path / 'work' / 'night' / 'raw'
+    rawpath.mkdir(parents=True)
+    for file in os.listdir(mirror):
+        header = fits.getheader(os.path.join(mirror, file))
+        if header['HIERARCH ESO DPR TYPE'] == 'DARK' and \
+                header['HIERARCH ESO DET SEQ1 DIT'] == 10.:
+            continue
+        shutil.copy(os.path.join(mirror, file), rawpath)
+
+    ppl = CriresPipeline(str(tmp_path / 'work'), 'night', num_processes=1,
+                         qa_plots='off', archive=LocalArchive(mirror))
+    ppl.extract_header()
+    return ppl
+
+
+def test_missing_darks_downloaded(ppl):
+    n_raw = len(ppl.header_info)
+    ppl.calibration()
+
+    # the darks are added to the raw frames and processed in the same run
+    assert len(ppl.header_info) == n_raw + 3
+    assert len(pd.read_csv(ppl.header_file, sep=';')) == n_raw + 3
+    cal_types = ppl.calib_info[ppl.key_caltype]
+    assert 10. in set(ppl.calib_info[cal_types == 'DARK_MASTER'][ppl.key_DIT])
+    assert 'SLIT_TILT' in set(cal_types)
+    assert 'FLAT_NORM' in set(cal_types)
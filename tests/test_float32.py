@@ -0,0 +1,56 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from astropy.io import fits
+import matplotlib
+matplotlib.use('Agg')
+from excalibuhr.synthetic import make_night
+from excalibuhr.pipeline import CriresPipeline
+
+STEPS = ['extract_header', 'calibration', 'obs_nodding',
+         'obs_nodding_combine', 'obs_extract']
+
+# relative precision of the float32 mode, see docs/getstarted.rst
+RTOL = 1e-5
+
+
+@pytest.fixture(scope='module')
+def workpath(tmp_path_factory):
+    workpath = tmp_path_factory.mktemp('work')
+    rawpath = str(workpath / 'raw')
+    make_night(rawpath, n_pixel=768, n_cycles=1, seed=2)
+    for dtype in ['float64', 'float32']:
+        shutil.copytree(rawpath, str(workpath / dtype / 'raw'))
+        ppl = CriresPipeline(str(workpath), dtype, num_processes=1,
+                             qa_plots='off', dtype=dtype)
+        for step in STEPS:
+            getattr(ppl, step)()
+    return str(workpath)
+
+
+def _products(workpath, night, prefix):
+    folder = os.path.join(workpath, night, 'out', 'combined')
+    return sorted(f for f in os.listdir(folder) if f.startswith(prefix))
+
+
+def test_float32_frames(workpath):
+    files = _products(workpath, 'float32', 'COMBINED_')
+    assert len(files) == 2
+    for file in files:
+        with fits.open(os.path.join(workpath, 'float32', 'out', 'combined', file)) as hdu:
+            assert hdu[1].data.dtype.newbyteorder('=') == np.float32
+
+
+def test_float32_spectra_agree(workpath):
+    files = _products(workpath, 'float64', 'Extr1D_')
+    assert len(files) == 2
+    assert files == _products(workpath, 'float32', 'Extr1D_')
+    for file in files:
+        with fits.open(os.path.join(workpath, 'float64', 'out', 'combined', file)) as ref, \
+             fits.open(os.path.join(workpath, 'float32', 'out', 'combined', file)) as hdu:
+            for ext in ['FLUX', 'FLUX_ERR']:
+                expected, actual = ref[ext].data, hdu[ext].data
+                assert np.all(np.isfinite(expected) == np.isfinite(actual))
+                np.testing.assert_allclose(actual, expected, rtol=RTOL,
+                            atol=RTOL * np.nanmax(np.abs(expected)))
@@ -0,0 +1,52 @@
+import os
+import pytest
+from astropy.io import fits
+import matplotlib
+matplotlib.use('Agg')
+from excalibuhr.synthetic import make_night
+from excalibuhr.pipeline import CriresPipeline
+
+
+@pytest.fixture(scope='module')
+def night(tmp_path_factory):
+    workpath = tmp_path_factory.mktemp('work')
+    make_night(str(workpath / 'night' / 'raw'), n_pixel=512, n_cycles=1, seed=1)
+    return str(workpath)
+
+
+def _run(workpath):
+    ppl = CriresPipeline(workpath, 'night', num_processes=2, qa_plots='off')
+    ppl.extract_header()
+    ppl.calibration()
+    return ppl
+
+
+def _mtimes(ppl):
+    return {f: os.stat(os.path.join(ppl.calpath, f)).st_mtime_ns 
+            for f in os.listdir(ppl.calpath)}
+
+
+def test_calibration_rebuilds_only_changed_tasks(night):
+    ppl = _run(night)
+    recipes = ppl._load_state()['recipes']
+    for key in ['DARK:2.0', 'DARK:10.0', 'DARK:30.0', 'FLAT_RAW:K2166', 
+                'TRACE:K2166', 'SLIT:K2166', 'NORM:K2166']:
+        assert f'calibration:{key}' in recipes
+
+    # nothing changed
+    before = _mtimes(ppl)
+    ppl = _run(night)
+    assert _mtimes(ppl) == before
+
+    # a dark of a DIT used by no other calibration
+    info = ppl.header_info
+    indices = (info['ESO DPR TYPE'] == 'DARK') & (info['ESO DET SEQ1 DIT'] == 30.)
+    file = os.path.join(ppl.rawpath, info[indices]['ORIGFILE'].iloc[0])
+    with fits.open(file, mode='update') as hdu:
+        hdu[1].data[0, 0] += 5.
+    ppl = _run(night)
+    after = _mtimes(ppl)
+    changed = {f for f in after if after[f] != before.get(f)}
+    assert changed == {'DARK_MASTER_DIT30.0.fits', 'DARK_RON_DIT30.0.fits', 
+                       'DARK_BPM_DIT30.0.fits'}
+    assert len(ppl.calib_info) == len(ppl.calib_info.drop_duplicates())
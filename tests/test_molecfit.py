@@ -0,0 +1,169 @@
+import os
+import sys
+import stat
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.io import fits
+import matplotlib
+matplotlib.use('Agg')
+import excalibuhr.utils as su
+from excalibuhr.data import wfits
+from excalibuhr.pipeline import CriresPipeline
+
+
+# Stand-in for `esorex`: writes the outputs of the molecfit recipes,
+# with a transmission equal to the median flux of the input spectrum
+STUB_ESOREX = '''#!{python}
+import os, sys, numpy as np
+from astropy.io import fits
+args = sys.argv[1:]
+if args[0] == '--version':
+    print('esorex stub 1.0')
+    sys.exit()
+if args[0].startswith('--create-config'):
+    open(args[0].split('=')[1], 'w').write(
+        "LIST_MOLEC=H2O,CH4\\nREL_COL=1.0,1.0\\nFIT_RES_GAUSS=TRUE\\n"
+        "RES_GAUSS=1.0\\nFIT_RES_LORENTZ=TRUE\\nRES_LORENTZ=1.0\\n")
+    sys.exit()
+config = [a for a in args if a.startswith('--recipe-config')][0].split('=')[1]
+recipe = [a for a in args if not a.startswith('-')][0]
+sof = open(args[-1]).read().split()
+with fits.open(sof[0]) as hdu:
+    wave = np.concatenate([h.data['WAVE'] for h in hdu[1:]])
+    level = np.nanmedian(np.concatenate([h.data['FLUX'] for h in hdu[1:]]))
+if recipe == 'molecfit_model':
+    with open('model_used.rc', 'w') as f:
+        f.write(open(config).read())
+    for name in ['ATM_PARAMETERS', 'MODEL_MOLECULES']:
+        fits.PrimaryHDU().writeto(name + '.fits', overwrite=True)
+    table = fits.BinTableHDU.from_columns([
+        fits.Column(name='parameter', format='20A',
+                    array=['rel_mol_col_H2O', 'gaussfwhm', 'lorentzfwhm', 'chi2']),
+        fits.Column(name='value', format='D', array=[level, 2.5, 0.3, 0.])])
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(
+        'BEST_FIT_PARAMETERS.fits', overwrite=True)
+elif recipe == 'molecfit_calctrans':
+    fits.BinTableHDU.from_columns([
+        fits.Column(name='lambda', format='D', array=wave),
+        fits.Column(name='mtrans', format='D', array=np.full_like(wave, level))]
+        ).writeto('TELLURIC_DATA.fits', overwrite=True)
+    fits.PrimaryHDU().writeto('TELLURIC_CORR.fits', overwrite=True)
+elif recipe == 'molecfit_correct':
+    fits.PrimaryHDU().writeto('SCIENCE_TELLURIC_CORR.fits', overwrite=True)
+'''
+
+
+@pytest.fixture
+def esorex(tmp_path, monkeypatch):
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    stub = bindir / 'esorex'
+    stub.write_text(STUB_ESOREX.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    su._esorex_version.cache_clear()
+    yield stub
+    su._esorex_version.cache_clear()
+
+
+def _add_spectrum(ppl, folder, name, cal_type, level, wlen, nframe=None):
+    """ Write a spectrum product with a flat flux of `level`. """
+    header = fits.Header()
+    header['OBJECT'] = 'HD 1234'
+    header['HIERARCH ESO INS WLEN ID'] = wlen
+    wave = np.linspace(1950., 2000., 40)[None] + 60. * np.arange(3)[:, None]
+    flux = np.full(wave.shape, level)
+    if nframe is not None:
+        flux = np.stack([flux * (1 + 0.01 * i) for i in range(nframe)])
+    wfits(os.path.join(ppl.outpath, folder, name), header=header,
+          ext_list={'FLUX': flux, 'FLUX_ERR': 0.01 * flux, 'WAVE': wave})
+    ppl._add_to_product(f'{folder}/{name}', cal_type, header=header)
+
+
+@pytest.fixture
+def ppl(tmp_path):
+    ppl = CriresPipeline(str(tmp_path / 'work'), 'night', num_processes=2,
+                         qa_plots='off', async_write=False)
+    _add_spectrum(ppl, 'combined', 'SPEC_HD1234_K2166.fits',
+                  'SPEC_COMBINED_PRIMARY', 0.5, 'K2166')
+    _add_spectrum(ppl, 'combined', 'SPEC_HD1234_K2192.fits',
+                  'SPEC_COMBINED_PRIMARY', 0.8, 'K2192')
+    return ppl
+
+
+def test_concurrent_fits_do_not_collide(esorex, ppl):
+    ppl.run_molecfit(use_cache=False, verbose=False)
+
+    # one scratch directory and result per product of the same target
+    for stem, level in [('SPEC_HD1234_K2166', 0.5), ('SPEC_HD1234_K2192', 0.8)]:
+        assert os.path.isfile(os.path.join(ppl.molpath, stem, 'TELLURIC_DATA.fits'))
+        tellu = fits.getdata(os.path.join(ppl.molpath, f'TELLURIC_{stem}.fits'), 'FLUX')
+        np.testing.assert_allclose(tellu, level)
+        best = np.loadtxt(os.path.join(ppl.molpath, f'BEST_FIT_PARAMETERS_{stem}.txt'),
+                          dtype=str)
+        assert np.isclose(float(best[0][1]), level)
+
+    product_info = pd.read_csv(ppl.product_file, sep=';')
+    assert np.sum(product_info['CAL TYPE'] == 'TELLU_MOLECFIT') == 2
+
+
+def test_frames_fitted_separately(esorex, ppl):
+    _add_spectrum(ppl, 'frame', 'SPEC_SERIES_HD1234_K2166.fits',
+                  'SPEC_FRAME_PRIMARY', 0.5, 'K2166', nframe=3)
+    ppl.run_molecfit(data_type='SPEC_FRAME_PRIMARY', use_cache=False, verbose=False)
+
+    stem = 'SPEC_SERIES_HD1234_K2166'
+    for i in range(3):
+        assert os.path.isdir(os.path.join(ppl.molpath, f'{stem}_{i:03d}'))
+    tellu = fits.getdata(os.path.join(ppl.molpath, f'TELLURIC_{stem}.fits'), 'FLUX')
+    np.testing.assert_allclose(tellu[:, 0], 0.5 * (1 + 0.01 * np.arange(3)))
+
+
+def test_warm_start_from_combined(esorex, ppl):
+    ppl.run_molecfit(use_cache=False, verbose=False)
+    _add_spectrum(ppl, 'frame', 'SPEC_SERIES_HD1234_K2192.fits',
+                  'SPEC_FRAME_PRIMARY', 0.8, 'K2192', nframe=2)
+    ppl.run_molecfit(data_type='SPEC_FRAME_PRIMARY', warm_start='combined',
+                     use_cache=False, verbose=False)
+
+    # seeded with the solution of the combined spectrum of the same setting
+    with open(os.path.join(ppl.molpath, 'SPEC_SERIES_HD1234_K2192_001',
+                           'model_used.rc')) as f:
+        config = f.read()
+    assert 'REL_COL=0.8,1' in config
+    assert 'FIT_RES_GAUSS=FALSE' in config
+
+
+@pytest.mark.parametrize("warm_start", ['combine', 'first', True])
+def test_invalid_warm_start(ppl, warm_start):
+    with pytest.raises(ValueError):
+        ppl.run_molecfit(data_type='SPEC_FRAME_PRIMARY', warm_start=warm_start)
+
+
+def test_cache_stores_only_molecfit_outputs(esorex, tmp_path):
+    from excalibuhr.data import SPEC
+    input_path = tmp_path / 'fit'
+    input_path.mkdir()
+    # unrelated and stale files in the working directory
+    fits.PrimaryHDU().writeto(input_path / 'other.fits')
+    fits.PrimaryHDU().writeto(input_path / 'TELLURIC_old.fits')
+
+    wave = np.linspace(1950., 2000., 40)[None] + 60. * np.arange(3)[:, None]
+    spec = SPEC(wlen=wave * 1e-3, flux=np.full(wave.shape, 0.7),
+                err=np.full(wave.shape, 0.01))
+    su.molecfit(str(input_path), spec, cache_dir=str(tmp_path / 'cache'))
+
+    entries = os.listdir(tmp_path / 'cache' / 'molecfit')
+    assert len(entries) == 1
+    cached = set(os.listdir(tmp_path / 'cache' / 'molecfit' / entries[0]))
+    assert cached == {'ATM_PARAMETERS.fits', 'MODEL_MOLECULES.fits',
+                      'BEST_FIT_PARAMETERS.fits', 'TELLURIC_DATA.fits',
+                      'TELLURIC_CORR.fits'}
+
+    # a second run in a new folder is served from the cache
+    other_path = tmp_path / 'fit2'
+    other_path.mkdir()
+    su.molecfit(str(other_path), spec, cache_dir=str(tmp_path / 'cache'))
+    assert cached <= set(os.listdir(other_path))
+    assert not os.path.exists(other_path / "other.fits")
@@ -0,0 +1,47 @@
+import os
+import pickle
+import numpy as np
+from excalibuhr.qaplot import QAPlotter
+
+
+def test_renderer_started_at_first_plot(tmp_path):
+    plotter = QAPlotter(level='full')
+    assert plotter._process is None
+    try:
+        # the plot of a detector image is named after its FITS file
+        plotter.submit('det_image', 'summary', str(tmp_path / 'image.fits'),
+                       'test', np.ones((3, 16, 16)))
+        process = plotter._process
+        assert process is not None and process.is_alive()
+
+        # flushing waits for the plot without restarting the renderer
+        plotter.flush()
+        assert os.path.isfile(tmp_path / 'image.png')
+        assert plotter._process is process
+
+        plotter.submit('det_image', 'summary', str(tmp_path / 'image2.fits'),
+                       'test', np.ones((3, 16, 16)))
+        plotter.flush()
+        assert os.path.isfile(tmp_path / 'image2.png')
+        assert plotter._process is process
+    finally:
+        plotter.close()
+    assert not process.is_alive()
+
+
+def test_renderer_started_for_workers():
+    plotter = QAPlotter(level='summary')
+    try:
+        # the copy of a worker shares the queue of the renderer
+        copy = pickle.loads(pickle.dumps(plotter))
+        assert plotter._process is not None
+        assert copy.queue is not None and copy._process is None
+    finally:
+        plotter.close()
+
+
+def test_no_renderer_without_plots():
+    plotter = QAPlotter(level='off')
+    plotter.submit('det_image', 'summary', 'unused', 'test', np.ones((16, 16)))
+    plotter.flush()
+    assert plotter._process is None
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import excalibuhr.utils as su
+
+
+@pytest.fixture
+def spectrum():
+    # absorption lines on a continuum, sampled finely in K band
+    wave = np.linspace(2300., 2310., 20000)
+    rng = np.random.default_rng(0)
+    flux = np.ones_like(wave)
+    for center in rng.uniform(2301., 2309., 40):
+        depth = 0.5 * rng.uniform(0.2, 1.)
+        flux -= depth * np.exp(-0.5 * ((wave - center) / 0.02)**2)
+    return wave, flux
+
+
+@pytest.mark.parametrize("vsini", [5., 10., 20.])
+def test_fft_matches_disk_integration(spectrum, vsini):
+    wave, flux = spectrum
+    fft = su.rot_broaden(wave, flux, vsini)
+    disk = su.rot_int_cmj(wave, flux, vsini)
+    # exclude the edges, where the two paths pad differently
+    inner = slice(2000, -2000)
+    assert np.max(np.abs(fft[inner] - flux[inner])) > 0.1
+    np.testing.assert_allclose(fft[inner], disk[inner], atol=6e-4)
+
+
+def test_differential_rotation_uses_disk_integration(spectrum):
+    wave, flux = spectrum
+    np.testing.assert_allclose(su.rot_broaden(wave, flux, 10., dif=0.23),
+                               su.rot_int_cmj(wave, flux, 10., dif=0.23))
+
+
+def test_kernel_normalized():
+    kernel = su.rot_kernel(1e-6, 20.)
+    assert kernel.size % 2 == 1
+    assert np.isclose(np.sum(kernel), 1.)
+    np.testing.assert_allclose(kernel, kernel[::-1])
@@ -0,0 +1,45 @@
+import os
+import pytest
+import excalibuhr.utils as su
+
+
+def test_atomic_write(tmp_path):
+    filename = str(tmp_path / 'state.json')
+    with su.atomic_write(filename) as tmp_file:
+        assert tmp_file != filename
+        with open(tmp_file, 'w') as f:
+            f.write('new')
+        assert not os.path.exists(filename)
+    with open(filename) as f:
+        assert f.read() == 'new'
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_atomic_write_failure(tmp_path):
+    filename = str(tmp_path / 'state.json')
+    with open(filename, 'w') as f:
+        f.write('old')
+    with pytest.raises(RuntimeError):
+        with su.atomic_write(filename) as tmp_file:
+            with open(tmp_file, 'w') as f:
+                f.write('partial')
+            raise RuntimeError
+    # the previous file is kept, and the temporary file removed
+    with open(filename) as f:
+        assert f.read() == 'old'
+    assert os.listdir(tmp_path) == ['state.json']
+
+
+def test_atomic_write_directory(tmp_path):
+    entry = str(tmp_path / 'entry')
+    with su.atomic_write(entry, suffix='.npz') as tmp_entry:
+        assert tmp_entry.endswith('.npz')
+        os.makedirs(tmp_entry)
+        open(os.path.join(tmp_entry, 'file'), 'w').close()
+    assert os.listdir(entry) == ['file']
+    # an existing directory is not replaced
+    with pytest.raises(OSError):
+        with su.atomic_write(entry) as tmp_entry:
+            os.makedirs(tmp_entry)
+            open(os.path.join(tmp_entry, 'file'), 'w').close()
+    assert os.listdir(tmp_path) == ['entry']